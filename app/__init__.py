@@ -31,6 +31,10 @@ def create_app(config_class=Config):
     # Initialize Proxmox API connection pool
     from app.proxmox.api import init_proxmox_api
     init_proxmox_api(app)
+    
+    # Keep folder VM locations in step with the cluster inventory
+    from app.views.folder_api import start_folder_reconciler
+    start_folder_reconciler(app)
 
     # Register VM API blueprint
     from app.views.vm_api import bp as vm_api_bp
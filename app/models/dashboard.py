@@ -0,0 +1,116 @@
+GB = 1024 ** 3
+
+
+def format_uptime(uptime_seconds):
+    """Format an uptime in seconds as e.g. '3d 4h 12m'"""
+    if not uptime_seconds or uptime_seconds <= 0:
+        return "N/A"
+
+    days, remainder = divmod(uptime_seconds, 86400)
+    hours, remainder = divmod(remainder, 3600)
+    minutes, seconds = divmod(remainder, 60)
+
+    if days > 0:
+        return f"{int(days)}d {int(hours)}h {int(minutes)}m"
+    elif hours > 0:
+        return f"{int(hours)}h {int(minutes)}m"
+    return f"{int(minutes)}m {int(seconds)}s"
+
+
+class DashboardAggregator:
+    """
+    Computes every dashboard figure from one fetch of cluster data.
+
+    VMs, nodes and storage are each walked exactly once. Nothing is memoized:
+    a version of the data would cost a pass over it too, and unchanged
+    payloads are already answered from conditional_json's cache.
+    """
+
+    def summarize(self, vms, node_status, storage_status=None):
+        """
+        Build the dashboard summary
+
+        Args:
+            vms: VMs/containers visible to the user (from cluster/resources)
+            node_status: Output of get_node_status()
+            storage_status: Output of get_storage_status() (optional)
+
+        Returns:
+            Dictionary with cluster totals, formatted nodes and formatted storage
+        """
+        return self._aggregate(vms, node_status, storage_status or [])
+
+    def _aggregate(self, vms, node_status, storage_status):
+        """Compute the summary in a single pass over each input list"""
+        # VM counts per node
+        vm_counts = {}
+        running_counts = {}
+        running_total = 0
+        for vm in vms:
+            node_name = vm.get('node')
+            vm_counts[node_name] = vm_counts.get(node_name, 0) + 1
+            if vm.get('status') == 'running':
+                running_counts[node_name] = running_counts.get(node_name, 0) + 1
+                running_total += 1
+
+        # Node formatting and cluster totals
+        nodes = []
+        online_count = 0
+        cpu_total = cpu_used = 0
+        mem_total = mem_used = 0
+        for node in node_status:
+            cpu = node.get('cpu', 0)
+            maxcpu = node.get('maxcpu', 0)
+            mem = node.get('mem', 0)
+            maxmem = node.get('maxmem', 0)
+
+            if node.get('online'):
+                online_count += 1
+                cpu_total += maxcpu
+                cpu_used += cpu * maxcpu
+                mem_total += maxmem
+                mem_used += mem
+
+            node_name = node.get('node')
+            nodes.append({
+                **node,
+                'uptime_formatted': format_uptime(node.get('uptime', 0)),
+                'cpu_percent': round(cpu * 100, 1),
+                'mem_total': round(maxmem / GB, 1),
+                'mem_used': round(mem / GB, 1),
+                'mem_percent': round((mem / maxmem * 100) if maxmem > 0 else 0, 1),
+                'vm_count': vm_counts.get(node_name, 0),
+                'running_count': running_counts.get(node_name, 0)
+            })
+
+        # Storage formatting
+        storage = []
+        for entry in storage_status:
+            total = entry.get('total', 0)
+            used = entry.get('used', 0)
+            storage.append({
+                **entry,
+                'total': round(total / GB, 1),
+                'used': round(used / GB, 1),
+                'avail': round(entry.get('avail', 0) / GB, 1),
+                'usage_percent': round((used / total * 100) if total > 0 else 0, 1)
+            })
+
+        return {
+            'vm_count': len(vms),
+            'running_vm_count': running_total,
+            'node_count': len(node_status),
+            'online_node_count': online_count,
+            'nodes': nodes,
+            'storage': storage,
+            'cluster_cpu_total': cpu_total,
+            'cluster_cpu_used': round(cpu_used, 1),
+            'cluster_cpu_percent': round((cpu_used / cpu_total * 100) if cpu_total > 0 else 0, 1),
+            'cluster_mem_total': round(mem_total / GB, 1),
+            'cluster_mem_used': round(mem_used / GB, 1),
+            'cluster_mem_percent': round((mem_used / mem_total * 100) if mem_total > 0 else 0, 1)
+        }
+
+
+# Shared aggregator used by the dashboard views
+dashboard_aggregator = DashboardAggregator()
@@ -1,19 +1,96 @@
 import os
 import json
+import sqlite3
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from types import MappingProxyType
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are serialized
+    fcntl = None
 from flask import current_app
 import time
 
-class FolderManager:
-    """Manages VM folders and organization"""
+# Shared FolderManager instances, one per data directory and backend
+_managers = {}
+_managers_lock = threading.Lock()
+
+# Short keys of the VM fields in the JSON tree, in the order of FolderManager._vm_row:
+# i=vmid, n=name, s=status, o=node, t=type, m=memory percent (f=folder is always appended)
+TREE_FIELDS = ('i', 'n', 's', 'o', 't', 'm')
+
+# Per-folder aggregates (including subfolders), see FolderManager.get_folder_stats
+ROLLUP_FIELDS = ('vm_count', 'running_count', 'cpus', 'cpu_used', 'maxmem', 'mem')
+
+# Distinct sets of visible VMs (roughly: permission groups) with kept totals
+MAX_ROLLUP_SCOPES = 32
+
+GB = 1024 ** 3
+
+def get_folder_manager(data_dir='app/data', backend=None):
+    """
+    Get the shared FolderManager for a data directory
+    
+    Args:
+        data_dir: Directory holding the folder data
+        backend: 'json' or 'sqlite'; defaults to the FOLDER_BACKEND environment
+                 variable, then 'json'
+    """
+    backend = backend or os.environ.get('FOLDER_BACKEND', 'json')
+    with _managers_lock:
+        manager = _managers.get((data_dir, backend))
+        if manager is None:
+            manager = FolderManager(data_dir=data_dir, backend=backend)
+            _managers[(data_dir, backend)] = manager
+        return manager
+
+def write_json_atomic(path, data):
+    """Replace a JSON file atomically: write a temp file, fsync, rename, fsync the directory"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
     
-    def __init__(self, data_dir='data'):
-        """Initialize folder manager with data directory"""
+    # Make the rename itself durable (not supported on Windows)
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+class JsonFolderStore:
+    """
+    Folder data kept in folders.json and vm_locations.json
+    
+    The JSON files are snapshots. Changes are appended to folders.journal
+    (one fsynced JSON line per commit, holding the new value of every changed
+    folder or VM location), so a move costs one small append. Once the
+    journal grows past JOURNAL_COMPACT_BYTES it is compacted: both snapshots
+    are rewritten atomically (temp file, fsync, rename) and the journal is
+    truncated. Loading reads the snapshots and replays the journal; since
+    records hold absolute values, replaying one that is already part of the
+    snapshot (crash during compaction) is harmless, and a torn last line
+    (crash during append) is ignored.
+    """
+    
+    # Journal size above which the snapshots are rewritten
+    JOURNAL_COMPACT_BYTES = 256 * 1024
+    
+    def __init__(self, data_dir, create=True):
+        """Initialize the store, creating empty files if needed (and create is set)"""
         self.data_dir = data_dir
         self.folders_file = os.path.join(data_dir, 'folders.json')
         self.vm_locations_file = os.path.join(data_dir, 'vm_locations.json')
+        self.journal_file = os.path.join(data_dir, 'folders.journal')
+        self.lock_file = os.path.join(data_dir, '.folders.lock')
+        self._lock_depth = 0
         
-        # Create data directory if it doesn't exist
-        os.makedirs(data_dir, exist_ok=True)
+        if not create:
+            return
         
         # Initialize files if they don't exist
         if not os.path.exists(self.folders_file):
@@ -22,129 +99,907 @@ class FolderManager:
         if not os.path.exists(self.vm_locations_file):
             self._save_vm_locations({})
     
+    def signature(self):
+        """Identify the current version of the data files by inode, mtime and size"""
+        signature = []
+        for path in (self.folders_file, self.vm_locations_file, self.journal_file):
+            try:
+                st = os.stat(path)
+                signature.append((st.st_ino, st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+    
+    @contextmanager
+    def _file_lock(self, mode):
+        """Hold a flock on .folders.lock (re-entrant within a transaction)"""
+        if fcntl is None or self._lock_depth:
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+            return
+        
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock, mode)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    
+    def transaction(self):
+        """
+        Hold an exclusive lock on the data files for a read-validate-write sequence
+        
+        The lock (flock on .folders.lock) serializes writers from all worker
+        processes; threads of one process are already serialized by the
+        manager's lock, which is always taken first.
+        """
+        return self._file_lock(fcntl.LOCK_EX if fcntl else None)
+    
+    def load(self):
+        """Load all folders and VM locations (snapshots plus journal)"""
+        # A shared lock keeps a concurrent compaction from mixing old and new files
+        with self._file_lock(fcntl.LOCK_SH if fcntl else None):
+            folders = self._load_folders()
+            vm_locations = self._load_vm_locations()
+            for kind, key, value in self._read_journal()[0]:
+                target = folders if kind == 'folder' else vm_locations
+                if value is None:
+                    target.pop(key, None)
+                else:
+                    target[key] = value
+            return folders, vm_locations
+    
+    def write(self, changes, folders, vm_locations):
+        """
+        Persist a change by appending it to the journal
+        
+        Args:
+            changes: List of ('folder', folder_id, folder or None) and
+                     ('vm', vmid, folder_id or None) tuples
+            folders: Complete folder mapping after the change (used for compaction)
+            vm_locations: Complete VM location mapping after the change (used for compaction)
+        """
+        with self.transaction():
+            record = json.dumps({
+                'changes': [
+                    [kind, key, dict(value) if kind == 'folder' and value is not None else value]
+                    for kind, key, value in changes
+                ]
+            })
+            
+            with open(self.journal_file, 'a+b') as f:
+                # Drop a torn record left by a crash, so the new one starts on its own line
+                f.seek(0, os.SEEK_END)
+                if f.tell():
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        f.truncate(self._read_journal()[1])
+                f.write(record.encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+                journal_size = f.tell()
+            
+            if journal_size > self.JOURNAL_COMPACT_BYTES:
+                self.compact(folders, vm_locations)
+    
+    def compact(self, folders, vm_locations):
+        """Write both snapshots atomically, then empty the journal"""
+        with self.transaction():
+            self._save_folders({fid: dict(folder) for fid, folder in folders.items()})
+            self._save_vm_locations(dict(vm_locations))
+            # Only truncated once both snapshots are durable; a crash before this
+            # point just replays records the snapshots already contain
+            with open(self.journal_file, 'wb') as f:
+                os.fsync(f.fileno())
+    
+    def _read_journal(self):
+        """
+        Read the journal
+        
+        Returns:
+            Tuple of (changes, valid_size): the changes of all complete records in
+            order, and the byte length of the journal up to the last complete line
+        """
+        changes = []
+        valid_size = 0
+        try:
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Torn append from a crash; it was never acknowledged
+                        break
+                    valid_size += len(line)
+                    try:
+                        changes.extend(json.loads(line)['changes'])
+                    except (ValueError, KeyError):
+                        print(f"Skipping unreadable record in {self.journal_file}")
+        except FileNotFoundError:
+            pass
+        return changes, valid_size
+    
     def _load_folders(self):
         """Load folders from file"""
         try:
             with open(self.folders_file, 'r') as f:
                 return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            print(f"Error reading {self.folders_file}, starting from an empty folder list: {str(e)}")
             return {}
     
     def _save_folders(self, folders):
         """Save folders to file"""
-        with open(self.folders_file, 'w') as f:
-            json.dump(folders, f, indent=2)
+        write_json_atomic(self.folders_file, folders)
     
     def _load_vm_locations(self):
         """Load VM locations from file"""
         try:
             with open(self.vm_locations_file, 'r') as f:
                 return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError as e:
+            print(f"Error reading {self.vm_locations_file}, starting from empty VM locations: {str(e)}")
             return {}
     
     def _save_vm_locations(self, vm_locations):
         """Save VM locations to file"""
-        with open(self.vm_locations_file, 'w') as f:
-            json.dump(vm_locations, f, indent=2)
+        write_json_atomic(self.vm_locations_file, vm_locations)
+
+class SqliteFolderStore:
+    """
+    Folder data kept in a SQLite database
+    
+    Folders are indexed by parent and VM locations by folder, and every change
+    touches only the affected rows inside one transaction. Writers from other
+    worker processes are serialized by SQLite's write lock (BEGIN IMMEDIATE),
+    and a counter in the meta table, bumped on every commit, tells readers
+    whether their cached copy is current.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS folders (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            parent_id TEXT NOT NULL,
+            created_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_folders_parent ON folders(parent_id);
+        CREATE TABLE IF NOT EXISTS vm_locations (
+            vmid TEXT PRIMARY KEY,
+            folder_id TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_vm_locations_folder ON vm_locations(folder_id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+    """
+    
+    def __init__(self, db_file, import_dir=None):
+        """
+        Open (and create if needed) the database
+        
+        Args:
+            db_file: Path of the SQLite database
+            import_dir: Directory whose folders.json and vm_locations.json are
+                        imported the first time the database is opened
+        """
+        self.db_file = db_file
+        # The manager serializes all access, so the connection may be shared by threads
+        self._conn = sqlite3.connect(db_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        
+        if import_dir:
+            self.import_json(import_dir)
+    
+    def signature(self):
+        """Current value of the commit counter"""
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+    
+    @contextmanager
+    def transaction(self):
+        """Hold the database write lock for a read-validate-write sequence"""
+        if self._conn.in_transaction:
+            yield
+            return
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+    
+    def load(self):
+        """Load all folders and VM locations"""
+        folders = {
+            folder_id: {
+                'id': folder_id,
+                'name': name,
+                'parent_id': parent_id,
+                'created_at': created_at
+            }
+            for folder_id, name, parent_id, created_at in self._conn.execute(
+                'SELECT id, name, parent_id, created_at FROM folders'
+            )
+        }
+        vm_locations = dict(self._conn.execute('SELECT vmid, folder_id FROM vm_locations'))
+        return folders, vm_locations
+    
+    def write(self, changes, folders=None, vm_locations=None):
+        """
+        Apply a change row by row and bump the commit counter
+        
+        Args:
+            changes: List of ('folder', folder_id, folder or None) and
+                     ('vm', vmid, folder_id or None) tuples
+            folders, vm_locations: Unused, accepted for interface compatibility
+        """
+        with self.transaction():
+            for kind, key, value in changes:
+                if kind == 'folder':
+                    if value is None:
+                        self._conn.execute('DELETE FROM folders WHERE id = ?', (key,))
+                    else:
+                        self._conn.execute(
+                            'INSERT OR REPLACE INTO folders (id, name, parent_id, created_at) VALUES (?, ?, ?, ?)',
+                            (key, value['name'], value['parent_id'], value.get('created_at'))
+                        )
+                else:
+                    if value is None:
+                        self._conn.execute('DELETE FROM vm_locations WHERE vmid = ?', (key,))
+                    else:
+                        self._conn.execute(
+                            'INSERT OR REPLACE INTO vm_locations (vmid, folder_id) VALUES (?, ?)',
+                            (key, value)
+                        )
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+    
+    def import_json(self, data_dir):
+        """
+        One-time import of folders.json and vm_locations.json
+        
+        Runs only if the database has never imported before; the JSON files are
+        left untouched so switching back to the JSON backend stays possible.
+        """
+        with self.transaction():
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+                return
+            
+            folders, vm_locations = JsonFolderStore(data_dir, create=False).load()
+            
+            changes = [('folder', folder_id, folder) for folder_id, folder in folders.items()]
+            changes.extend(('vm', str(vmid), folder_id) for vmid, folder_id in vm_locations.items())
+            if changes:
+                self.write(changes)
+                print(f"Imported {len(folders)} folders and {len(vm_locations)} VM locations into {self.db_file}")
+            
+            self._conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', 1)")
+
+class FolderManager:
+    """
+    Manages VM folders and organization
+    
+    Data is persisted by a store: JsonFolderStore (folders.json and
+    vm_locations.json) or SqliteFolderStore (folders.db). The parsed data is
+    kept in memory and only reloaded when the store's signature changes (e.g.
+    after a write by another worker). Mappings handed to callers are read-only
+    snapshots: every change builds new dictionaries instead of editing them.
+    
+    A parent -> children index of folders and a folder -> VMs index are kept
+    alongside, so moves are validated and subtrees are queried without
+    scanning all folders. Every change is validated and written inside the
+    store's transaction after a refresh, so concurrent moves from several
+    workers can't create cycles or lose updates.
+    
+    reconcile() drops (or quarantines) locations of VMs that no longer exist,
+    so the mapping stays proportional to the live inventory.
+    
+    Every folder also has running totals over itself and its subfolders
+    (ROLLUP_FIELDS), fed from cluster/resources by update_vm_stats. Totals
+    are kept per scope, the set of VMs a user may see, so nobody's folder
+    totals include VMs hidden from them. A VM change or move only adjusts the
+    folders on its path to the root in the scopes that contain it
+    (O(depth)); changes to the folder hierarchy recompute them.
+    """
+    
+    def __init__(self, data_dir='data', backend='json'):
+        """Initialize folder manager with data directory and backend ('json' or 'sqlite')"""
+        self.data_dir = data_dir
+        self.backend = backend
+        
+        self._lock = threading.RLock()
+        self._folders = MappingProxyType({})
+        self._vm_locations = MappingProxyType({})
+        self._signature = None
+        self._structure = None
+        
+        # Indexes: parent_id -> set of child folder IDs, folder_id -> set of VM IDs
+        self._children = {}
+        self._members = {}
+        
+        # Latest stats per VM (vmid -> tuple in ROLLUP_FIELDS order) and, per
+        # scope (frozenset of vmids), their totals per folder including
+        # subfolders (folder_id -> list); least recently used scope first
+        self._vm_stats = {}
+        self._scopes = OrderedDict()
+        
+        # Reconciliation: consecutive runs each stale VMID was missing, last report
+        self.quarantine_file = os.path.join(data_dir, 'vm_locations_quarantine.json')
+        self._missing = {}
+        self.last_reconcile = None
+        
+        # Create data directory if it doesn't exist
+        os.makedirs(data_dir, exist_ok=True)
+        
+        if backend == 'sqlite':
+            self.store = SqliteFolderStore(os.path.join(data_dir, 'folders.db'), import_dir=data_dir)
+        elif backend == 'json':
+            self.store = JsonFolderStore(data_dir)
+        else:
+            raise ValueError(f"Unknown folder backend {backend}")
+    
+    def _refresh(self):
+        """Reload the data if the store changed since it was last read"""
+        with self._lock:
+            signature = self.store.signature()
+            if signature != self._signature:
+                folders, vm_locations = self.store.load()
+                self._folders = MappingProxyType({
+                    folder_id: MappingProxyType(folder) for folder_id, folder in folders.items()
+                })
+                self._vm_locations = MappingProxyType(vm_locations)
+                self._signature = signature
+                self._structure = None
+                self._rebuild_index()
+                self._rebuild_rollups()
+    
+    def _rebuild_index(self):
+        """Build the children and members indexes from the current data"""
+        self._children = {}
+        for folder_id, folder in self._folders.items():
+            self._children.setdefault(folder['parent_id'], set()).add(folder_id)
+        self._members = {}
+        for vmid, folder_id in self._vm_locations.items():
+            self._members.setdefault(folder_id, set()).add(vmid)
+    
+    def _update_index(self, changes):
+        """Apply changes to the indexes (called before the new state is installed)"""
+        for kind, key, value in changes:
+            if kind == 'folder':
+                index = self._children
+                old = self._folders.get(key)
+                old_parent = old['parent_id'] if old is not None else None
+                new_parent = value['parent_id'] if value is not None else None
+            else:
+                index = self._members
+                old_parent = self._vm_locations.get(key)
+                new_parent = value
+            
+            if old_parent is not None:
+                index.get(old_parent, set()).discard(key)
+            if new_parent is not None:
+                index.setdefault(new_parent, set()).add(key)
+    
+    def _commit(self, changes):
+        """
+        Persist a list of changes and make the result the current state
+        
+        Args:
+            changes: List of ('folder', folder_id, folder or None) and
+                     ('vm', vmid, folder_id or None) tuples
+        """
+        with self._lock:
+            # Where the moved VMs with known stats were counted so far
+            previous_vm_folders = {
+                key: self._vm_folder(key) for kind, key, _ in changes
+                if kind == 'vm' and key in self._vm_stats
+            }
+            
+            folders = dict(self._folders)
+            vm_locations = dict(self._vm_locations)
+            for kind, key, value in changes:
+                target = folders if kind == 'folder' else vm_locations
+                if value is None:
+                    target.pop(key, None)
+                elif kind == 'folder':
+                    target[key] = MappingProxyType(dict(value))
+                else:
+                    target[key] = value
+            
+            self.store.write(changes, folders, vm_locations)
+            self._update_index(changes)
+            self._folders = MappingProxyType(folders)
+            self._vm_locations = MappingProxyType(vm_locations)
+            self._signature = self.store.signature()
+            self._structure = None
+            
+            if any(kind == 'folder' for kind, _, _ in changes):
+                self._rebuild_rollups()
+            else:
+                for vmid, previous_folder in previous_vm_folders.items():
+                    stats = self._vm_stats[vmid]
+                    self._apply_rollup(vmid, previous_folder, None, stats)
+                    self._apply_rollup(vmid, self._vm_folder(vmid), stats, None)
+    
+    def _vm_folder(self, vmid):
+        """Folder a VM is counted in (unknown folders count as the root)"""
+        folder_id = self._vm_locations.get(vmid, 'root')
+        return folder_id if folder_id in self._folders else 'root'
+    
+    def _apply_rollup(self, vmid, folder_id, new, old, scopes=None):
+        """
+        Replace a VM's old stats with new ones on a folder and all its ancestors
+        
+        Args:
+            scopes: Scopes to update (default: every kept scope containing the VM)
+        """
+        if scopes is None:
+            scopes = [rollups for vmids, rollups in self._scopes.items() if vmid in vmids]
+        if not scopes:
+            return
+        
+        delta = [
+            (new[i] if new else 0) - (old[i] if old else 0)
+            for i in range(len(ROLLUP_FIELDS))
+        ]
+        path = [folder_id] + self._ancestors(folder_id) if folder_id != 'root' else []
+        for rollups in scopes:
+            for fid in path + ['root']:
+                rollup = rollups.setdefault(fid, [0] * len(ROLLUP_FIELDS))
+                for i, value in enumerate(delta):
+                    rollup[i] += value
+    
+    def _build_scope(self, vmids):
+        """Compute the folder totals over the known stats of the given VMs"""
+        rollups = {}
+        for vmid in vmids:
+            stats = self._vm_stats.get(vmid)
+            if stats is not None:
+                self._apply_rollup(vmid, self._vm_folder(vmid), stats, None, scopes=[rollups])
+        return rollups
+    
+    def _rebuild_rollups(self):
+        """Recompute every kept scope's totals from the known VM stats"""
+        for vmids in self._scopes:
+            self._scopes[vmids] = self._build_scope(vmids)
+    
+    @staticmethod
+    def _vm_stats_of(vm):
+        """Stats of a cluster/resources VM entry in ROLLUP_FIELDS order"""
+        maxcpu = vm.get('maxcpu') or 0
+        return (
+            1,
+            1 if vm.get('status') == 'running' else 0,
+            maxcpu,
+            (vm.get('cpu') or 0) * maxcpu,
+            vm.get('maxmem') or 0,
+            vm.get('mem') or 0
+        )
+    
+    def update_vm_stats(self, vms):
+        """
+        Update the folder totals from a cluster/resources listing
+        
+        Only VMs whose stats changed (and VMs that disappeared) touch the
+        totals, each in O(depth).
+        
+        Args:
+            vms: All VMs and containers of the cluster (other entries are ignored)
+        """
+        with self._lock:
+            self._refresh()
+            seen = set()
+            for vm in vms:
+                if vm.get('type') not in ('qemu', 'lxc'):
+                    continue
+                vmid = str(vm.get('vmid'))
+                seen.add(vmid)
+                stats = self._vm_stats_of(vm)
+                previous = self._vm_stats.get(vmid)
+                if stats != previous:
+                    self._vm_stats[vmid] = stats
+                    self._apply_rollup(vmid, self._vm_folder(vmid), stats, previous)
+            
+            for vmid in self._vm_stats.keys() - seen:
+                self._apply_rollup(vmid, self._vm_folder(vmid), None, self._vm_stats.pop(vmid))
+    
+    def reconcile(self, live_vmids, mode='quarantine', grace=2, quarantine_days=30):
+        """
+        Drop the locations of VMs that no longer exist in the cluster
+        
+        Stale mappings are found with one set difference against the live
+        VMIDs. A VMID must be missing on `grace` consecutive runs before its
+        mapping is dropped, so a short API hiccup or a migration doesn't lose
+        placements. In 'quarantine' mode dropped mappings are kept in
+        vm_locations_quarantine.json for quarantine_days and put back if the
+        VMID shows up again (e.g. restored from backup); 'prune' just drops them.
+        
+        Args:
+            live_vmids: IDs of all VMs and containers currently in the cluster
+            mode: 'quarantine' or 'prune'
+            grace: Number of consecutive runs a VMID must be missing
+            quarantine_days: How long quarantined mappings are kept
+        Returns:
+            Drift report (also kept in last_reconcile)
+        """
+        live = {str(vmid) for vmid in live_vmids}
+        
+        with self._lock, self.store.transaction():
+            self._refresh()
+            stale = self._vm_locations.keys() - live
+            
+            # Count consecutive misses; VMs that came back start over
+            self._missing = {vmid: self._missing.get(vmid, 0) + 1 for vmid in stale}
+            dropped = sorted(vmid for vmid in stale if self._missing[vmid] >= grace)
+            changes = [('vm', vmid, None) for vmid in dropped]
+            
+            quarantine = self._load_quarantine() if mode == 'quarantine' else {}
+            restored = []
+            expired = False
+            if mode == 'quarantine':
+                now = time.time()
+                
+                # Put back quarantined VMs that exist again and have no location
+                for vmid in list(quarantine):
+                    entry = quarantine[vmid]
+                    if vmid in live and vmid not in self._vm_locations:
+                        if entry['folder_id'] in self._folders:
+                            changes.append(('vm', vmid, entry['folder_id']))
+                            restored.append(vmid)
+                        del quarantine[vmid]
+                    elif now - entry['removed_at'] > quarantine_days * 86400:
+                        del quarantine[vmid]
+                        expired = True
+                
+                for vmid in dropped:
+                    quarantine[vmid] = {'folder_id': self._vm_locations[vmid], 'removed_at': now}
+            
+            if changes:
+                self._commit(changes)
+            if mode == 'quarantine' and (dropped or restored or expired):
+                write_json_atomic(self.quarantine_file, quarantine)
+            
+            for vmid in dropped:
+                self._missing.pop(vmid, None)
+            
+            self.last_reconcile = {
+                'checked_at': time.time(),
+                'mode': mode,
+                'live_vms': len(live),
+                'mappings': len(self._vm_locations),
+                'stale': len(stale),
+                'pending': sorted(vmid for vmid in stale if vmid not in dropped),
+                'dropped': dropped,
+                'restored': restored,
+                'quarantined': len(quarantine)
+            }
+            return self.last_reconcile
+    
+    def _load_quarantine(self):
+        """Load quarantined VM locations (vmid -> {folder_id, removed_at})"""
+        try:
+            with open(self.quarantine_file, 'r') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            return {}
+    
+    def get_folder_stats(self, folder_id, vmids):
+        """
+        Get the totals of a folder including its subfolders over some VMs
+        
+        O(1) once the scope is kept; a new scope is computed in one pass over
+        its VMs, and the least recently used scope beyond MAX_ROLLUP_SCOPES is
+        dropped.
+        
+        Args:
+            folder_id: Folder to total
+            vmids: frozenset of the IDs (strings) of the VMs to count, e.g.
+                   those the user may see
+        Returns:
+            Dictionary with vm_count, running_count, cpus (vCPUs), cpu_used
+            (vCPUs busy), maxmem and mem (bytes)
+        """
+        with self._lock:
+            self._refresh()
+            rollups = self._scopes.get(vmids)
+            if rollups is None:
+                rollups = self._scopes[vmids] = self._build_scope(vmids)
+                if len(self._scopes) > MAX_ROLLUP_SCOPES:
+                    self._scopes.popitem(last=False)
+            else:
+                self._scopes.move_to_end(vmids)
+            rollup = rollups.get(folder_id) or [0] * len(ROLLUP_FIELDS)
+            return dict(zip(ROLLUP_FIELDS, rollup))
+    
+    def folder_stats_row(self, folder_id, vmids):
+        """
+        Compact folder totals for display (see get_folder_stats)
+        
+        Returns:
+            [vm_count, running_count, cpus, cpu_used, maxmem_gb, mem_gb] with
+            cpu_used and the memory figures rounded to one decimal
+        """
+        stats = self.get_folder_stats(folder_id, vmids)
+        return [
+            stats['vm_count'],
+            stats['running_count'],
+            stats['cpus'],
+            round(stats['cpu_used'], 1),
+            round(stats['maxmem'] / GB, 1),
+            round(stats['mem'] / GB, 1)
+        ]
+    
+    @property
+    def version(self):
+        """Version string of the current folder data, equal across workers for equal data"""
+        self._refresh()
+        if self.backend == 'sqlite':
+            return 'db%x' % self._signature
+        return '-'.join(
+            'none' if part is None else '%x.%x.%x' % part for part in self._signature
+        )
     
     def get_folders(self):
-        """Get all folders"""
-        return self._load_folders()
+        """Get all folders (read-only mapping of folder ID to read-only folder)"""
+        self._refresh()
+        return self._folders
     
     def get_folder(self, folder_id):
-        """Get folder by ID"""
-        folders = self._load_folders()
-        return folders.get(folder_id)
+        """Get folder by ID (read-only)"""
+        self._refresh()
+        return self._folders.get(folder_id)
     
     def create_folder(self, name, parent_id='root'):
         """Create a new folder"""
-        folders = self._load_folders()
-        folder_id = f"folder_{int(time.time())}_{len(folders)}"
-        
-        # Validate parent exists
-        if parent_id != 'root' and parent_id not in folders:
-            raise ValueError(f"Parent folder {parent_id} does not exist")
-        
-        folders[folder_id] = {
-            'id': folder_id,
-            'name': name,
-            'parent_id': parent_id,
-            'created_at': time.time()
-        }
-        
-        self._save_folders(folders)
-        return folder_id
+        with self._lock, self.store.transaction():
+            self._refresh()
+            suffix = len(self._folders)
+            folder_id = f"folder_{int(time.time())}_{suffix}"
+            # After a delete the count can repeat, never replace an existing folder
+            while folder_id in self._folders:
+                suffix += 1
+                folder_id = f"folder_{int(time.time())}_{suffix}"
+            
+            # Validate parent exists
+            if parent_id != 'root' and parent_id not in self._folders:
+                raise ValueError(f"Parent folder {parent_id} does not exist")
+            
+            self._commit([('folder', folder_id, {
+                'id': folder_id,
+                'name': name,
+                'parent_id': parent_id,
+                'created_at': time.time()
+            })])
+            return folder_id
     
     def update_folder(self, folder_id, data):
         """Update a folder"""
-        folders = self._load_folders()
-        
-        if folder_id not in folders:
-            raise ValueError(f"Folder {folder_id} does not exist")
-        
-        # Only update allowed fields
-        for key in ['name', 'parent_id']:
-            if key in data:
-                folders[folder_id][key] = data[key]
-        
-        self._save_folders(folders)
-        return folders[folder_id]
+        with self._lock, self.store.transaction():
+            self._refresh()
+            
+            if folder_id not in self._folders:
+                raise ValueError(f"Folder {folder_id} does not exist")
+            
+            # Only update allowed fields
+            folder = dict(self._folders[folder_id])
+            for key in ['name', 'parent_id']:
+                if key in data:
+                    folder[key] = data[key]
+            
+            if folder['parent_id'] != self._folders[folder_id]['parent_id']:
+                self._validate_move(folder_id, folder['parent_id'])
+            
+            self._commit([('folder', folder_id, folder)])
+            return self._folders[folder_id]
     
     def delete_folder(self, folder_id):
         """Delete a folder and move its contents to parent"""
-        folders = self._load_folders()
-        vm_locations = self._load_vm_locations()
+        with self._lock, self.store.transaction():
+            self._refresh()
+            
+            if folder_id not in self._folders:
+                raise ValueError(f"Folder {folder_id} does not exist")
+            
+            # Get parent ID
+            parent_id = self._folders[folder_id]['parent_id']
+            changes = []
+            
+            # Move child folders to parent
+            for fid in self._children.get(folder_id, ()):
+                changes.append(('folder', fid, {**self._folders[fid], 'parent_id': parent_id}))
+            
+            # Move VMs to parent
+            for vmid in self._members.get(folder_id, ()):
+                changes.append(('vm', vmid, parent_id))
+            
+            # Delete the folder
+            changes.append(('folder', folder_id, None))
+            
+            self._commit(changes)
+            return True
+    
+    def move_folder(self, folder_id, parent_id):
+        """
+        Move a folder under a new parent
         
-        if folder_id not in folders:
-            raise ValueError(f"Folder {folder_id} does not exist")
+        Raises:
+            ValueError: If either folder doesn't exist or the move would put the
+                        folder inside itself or one of its descendants
+        """
+        with self._lock, self.store.transaction():
+            self._refresh()
+            
+            if folder_id not in self._folders:
+                raise ValueError(f"Folder {folder_id} does not exist")
+            
+            self._validate_move(folder_id, parent_id)
+            self._commit([('folder', folder_id, {**self._folders[folder_id], 'parent_id': parent_id})])
+            return self._folders[folder_id]
+    
+    def _validate_move(self, folder_id, parent_id, moved=None):
+        """
+        Check that folder_id may become a child of parent_id (O(depth))
         
-        # Get parent ID
-        parent_id = folders[folder_id]['parent_id']
+        Args:
+            moved: Optional mapping of folder ID to new parent ID for moves not
+                   committed yet, taking precedence over the stored parents
+        """
+        if parent_id == folder_id:
+            raise ValueError("Cannot move a folder to itself")
+        if parent_id == 'root':
+            return
+        if parent_id not in self._folders:
+            raise ValueError(f"Folder {parent_id} does not exist")
+        if folder_id in self._ancestors(parent_id, moved):
+            raise ValueError("Circular reference detected")
+    
+    def _ancestors(self, folder_id, moved=None):
+        """Ancestor IDs of a folder from its parent upwards, without 'root'"""
+        moved = moved or {}
         
-        # Move child folders to parent
-        for fid, folder in list(folders.items()):
-            if folder['parent_id'] == folder_id:
-                folder['parent_id'] = parent_id
+        def parent_of(fid):
+            return moved[fid] if fid in moved else self._folders[fid]['parent_id']
         
-        # Move VMs to parent
-        for vmid, location in vm_locations.items():
-            if location == folder_id:
-                vm_locations[vmid] = parent_id
+        ancestors = []
+        seen = {folder_id}
+        parent_id = parent_of(folder_id) if folder_id in self._folders else 'root'
+        # Stop at the root, at a dangling parent or (for corrupt data) at a cycle
+        while parent_id in self._folders and parent_id not in seen:
+            ancestors.append(parent_id)
+            seen.add(parent_id)
+            parent_id = parent_of(parent_id)
+        return ancestors
+    
+    def move_items(self, moves):
+        """
+        Move many VMs and folders in one transaction
         
-        # Delete the folder
-        del folders[folder_id]
+        Moves are validated in order, each against the result of the previous
+        ones, and either all of them are committed or none.
         
-        self._save_folders(folders)
-        self._save_vm_locations(vm_locations)
-        return True
+        Args:
+            moves: Iterable of (item_type, item_id, parent_id) with item_type
+                   'vm' or 'folder'
+        Returns:
+            Number of items whose location changed
+        Raises:
+            ValueError: If any move is invalid (nothing is moved)
+        """
+        with self._lock, self.store.transaction():
+            self._refresh()
+            folder_parents = {}
+            vm_folders = {}
+            
+            for item_type, item_id, parent_id in moves:
+                try:
+                    if parent_id != 'root' and parent_id not in self._folders:
+                        raise ValueError(f"Folder {parent_id} does not exist")
+                    
+                    if item_type == 'folder':
+                        if item_id not in self._folders:
+                            raise ValueError(f"Folder {item_id} does not exist")
+                        self._validate_move(item_id, parent_id, folder_parents)
+                        folder_parents[item_id] = parent_id
+                    elif item_type == 'vm':
+                        vm_folders[str(item_id)] = parent_id
+                    else:
+                        raise ValueError("Invalid item type")
+                except ValueError as e:
+                    raise ValueError(f"Cannot move {item_type} {item_id}: {str(e)}")
+            
+            # Only write what actually changes
+            changes = [
+                ('folder', folder_id, {**self._folders[folder_id], 'parent_id': parent_id})
+                for folder_id, parent_id in folder_parents.items()
+                if self._folders[folder_id]['parent_id'] != parent_id
+            ]
+            changes.extend(
+                ('vm', vmid, folder_id)
+                for vmid, folder_id in vm_folders.items()
+                if self._vm_locations.get(vmid, 'root') != folder_id
+            )
+            
+            if changes:
+                self._commit(changes)
+            return len(changes)
+    
+    def get_ancestors(self, folder_id):
+        """Get the IDs of a folder's ancestors, nearest first ('root' not included)"""
+        with self._lock:
+            self._refresh()
+            return self._ancestors(folder_id)
+    
+    def get_descendants(self, folder_id):
+        """Get the IDs of all folders below a folder (breadth-first)"""
+        with self._lock:
+            self._refresh()
+            descendants = []
+            seen = {folder_id}
+            pending = deque([folder_id])
+            while pending:
+                current = pending.popleft()
+                for child_id in sorted(self._children.get(current, ())):
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        descendants.append(child_id)
+                        pending.append(child_id)
+            return descendants
+    
+    def get_depth(self, folder_id):
+        """Get the depth of a folder (0 for 'root', 1 for its direct children)"""
+        if folder_id == 'root':
+            return 0
+        return len(self.get_ancestors(folder_id)) + 1
+    
+    def get_folder_vms(self, folder_id):
+        """Get the IDs of the VMs explicitly placed directly in a folder"""
+        with self._lock:
+            self._refresh()
+            return frozenset(self._members.get(folder_id, ()))
     
     def get_vm_location(self, vmid):
         """Get VM's folder location"""
-        vm_locations = self._load_vm_locations()
-        return vm_locations.get(str(vmid), 'root')
+        self._refresh()
+        return self._vm_locations.get(str(vmid), 'root')
     
     def set_vm_location(self, vmid, folder_id):
         """Set VM's folder location"""
-        folders = self._load_folders()
-        vm_locations = self._load_vm_locations()
-        
-        # Validate folder exists (or is 'root')
-        if folder_id != 'root' and folder_id not in folders:
-            raise ValueError(f"Folder {folder_id} does not exist")
-        
-        vm_locations[str(vmid)] = folder_id
-        self._save_vm_locations(vm_locations)
-        return True
+        with self._lock, self.store.transaction():
+            self._refresh()
+            
+            # Validate folder exists (or is 'root')
+            if folder_id != 'root' and folder_id not in self._folders:
+                raise ValueError(f"Folder {folder_id} does not exist")
+            
+            self._commit([('vm', str(vmid), folder_id)])
+            return True
     
     def get_folder_structure(self):
         """
         Get hierarchical folder structure with VMs
-        Returns a nested dictionary of the folder structure
+        Returns a nested dictionary of the folder structure and the VM locations.
+        Both are shared, read-only snapshots and are rebuilt only when the data changes.
         """
-        folders = self._load_folders()
-        vm_locations = self._load_vm_locations()
-        
+        with self._lock:
+            self._refresh()
+            if self._structure is None:
+                self._structure = self._build_structure(self._folders, self._vm_locations)
+            return self._structure
+    
+    def _build_structure(self, folders, vm_locations):
+        """Build the nested folder structure from the folder mapping"""
         # Create structure
         structure = {
             'root': {
@@ -177,110 +1032,162 @@ class FolderManager:
                     key=lambda x: folders[x]['name'].lower()
                 )
         
-        return structure, vm_locations
+        # Freeze the result so the shared snapshot can't be modified by callers
+        frozen = MappingProxyType({
+            folder_id: MappingProxyType({
+                **node,
+                'children': tuple(node['children']),
+                'vms': tuple(node['vms'])
+            })
+            for folder_id, node in structure.items()
+        })
+        
+        return frozen, vm_locations
     
-    # Update the build_folder_html method in your FolderManager class
-
-    def build_folder_html(self, folder_structure, vm_locations, vms):
+    def build_folder_tree(self, folder_structure, vm_locations, vms, fields=None):
+        """
+        Build a compact JSON representation of the folder structure
+        
+        Args:
+            folder_structure: Output from get_folder_structure()
+            vm_locations: VM location mapping
+            vms: List of VM objects with at least id, name, status, and memory properties
+            fields: Short keys of the VM fields to include (see TREE_FIELDS);
+                    the VM ID and folder are always included
+        Returns:
+            Dictionary with:
+            - folders: [id, name, parent_id] rows, parents before children and
+              siblings sorted by name
+            - k: short keys of the VM row columns
+            - vms: VM rows sorted by name, one value per key in k
         """
-        Build HTML representation of folder structure
+        structure, _ = folder_structure
+        columns = [key for key in TREE_FIELDS if key == 'i' or not fields or key in fields]
+        
+        # Folders depth-first from the root, as shown in the sidebar
+        folders = []
+        pending = [(child_id, 'root') for child_id in reversed(structure['root']['children'])]
+        while pending:
+            folder_id, parent_id = pending.pop()
+            folders.append([folder_id, structure[folder_id]['name'], parent_id])
+            pending.extend((child_id, folder_id) for child_id in reversed(structure[folder_id]['children']))
+        
+        rows = []
+        for folder_id, folder_rows in self._group_rows(structure, vm_locations, vms, columns).items():
+            rows.extend(row + [folder_id] for row in folder_rows)
+        
+        name_column = columns.index('n') if 'n' in columns else 0
+        rows.sort(key=lambda row: str(row[name_column]).lower())
+        
+        return {
+            'folders': folders,
+            'k': columns + ['f'],
+            'vms': rows
+        }
+    
+    def build_folder_page(self, folder_structure, vm_locations, vms, folder_id='root',
+                          offset=0, limit=None, fields=None):
+        """
+        Build the compact JSON listing of one folder's direct contents
+        
+        Used to load the sidebar on demand: only expanded folders are fetched,
+        and large folders one page of VMs at a time. Only the listed folder's
+        VMs are turned into rows. Child folder counts come from the members
+        index and totals from the scope's rollups, so a page costs one pass to
+        index the given VMs by ID plus the size of the folder.
+        
         Args:
             folder_structure: Output from get_folder_structure()
             vm_locations: VM location mapping
             vms: List of VM objects with at least id, name, status, and memory properties
+            folder_id: Folder to list ('root' for the top level)
+            offset, limit: Slice of the folder's VMs (sorted by name) to include
+            fields: Short keys of the VM fields to include (see TREE_FIELDS)
         Returns:
-            HTML string representing the folder tree
+            Dictionary with:
+            - folders: [id, name, folder_count, vm_count, *stats] rows of the
+              child folders, sorted by name; vm_count counts the given VMs
+              directly in the folder, stats are the folder's totals over the
+              given VMs including subfolders (see folder_stats_row)
+            - stats: totals of the listed folder itself
+            - k: short keys of the VM row columns
+            - vms: the requested page of VM rows
+            - total: number of VMs directly in the folder
+        Raises:
+            ValueError: If the folder doesn't exist
         """
         structure, _ = folder_structure
+        if folder_id not in structure:
+            raise ValueError(f"Folder {folder_id} does not exist")
         
-        # Group VMs by folder
-        vm_by_folder = {}
+        columns = [key for key in TREE_FIELDS if key == 'i' or not fields or key in fields]
+        positions = [TREE_FIELDS.index(key) for key in columns]
+        
+        # Counts and totals only ever cover the VMs the caller passed in
+        visible = {str(vm.get('vmid', vm.get('id'))): vm for vm in vms}
+        vmids = frozenset(visible)
+        
+        with self._lock:
+            counts = [len(vmids & self._members.get(child_id, set())) for child_id in structure[folder_id]['children']]
+            if folder_id == 'root':
+                # VMs without a (known) folder are listed at the root
+                members = [vmid for vmid in visible if self._vm_folder(vmid) == 'root']
+            else:
+                members = [vmid for vmid in self._members.get(folder_id, ()) if vmid in visible]
+        
+        folders = [
+            [child_id, structure[child_id]['name'], len(structure[child_id]['children']), count]
+            + self.folder_stats_row(child_id, vmids)
+            for child_id, count in zip(structure[folder_id]['children'], counts)
+        ]
+        
+        rows = []
+        for vmid in members:
+            row = self._vm_row(visible[vmid])
+            rows.append([row[position] for position in positions])
+        name_column = columns.index('n') if 'n' in columns else 0
+        # Same-named VMs are ordered by ID, so pages don't shift between requests
+        rows.sort(key=lambda row: (str(row[name_column]).lower(), str(row[0])))
+        end = None if limit is None else offset + limit
+        
+        return {
+            'folders': folders,
+            'stats': self.folder_stats_row(folder_id, vmids),
+            'k': columns,
+            'vms': rows[offset:end],
+            'total': len(rows),
+            'offset': offset
+        }
+    
+    def _group_rows(self, structure, vm_locations, vms, columns):
+        """Group VM rows (projected to columns) by folder; VMs of unknown folders go to the root"""
+        positions = [TREE_FIELDS.index(key) for key in columns]
+        rows_by_folder = {}
         for vm in vms:
-            vm_id = str(vm.get('vmid', vm.get('id')))
-            folder_id = vm_locations.get(vm_id, 'root')
-            
-            if folder_id not in vm_by_folder:
-                vm_by_folder[folder_id] = []
-            
-            vm_by_folder[folder_id].append(vm)
-        
-        # Sort VMs in each folder by name
-        for folder_id in vm_by_folder:
-            vm_by_folder[folder_id].sort(key=lambda x: x.get('name', '').lower())
-        
-        # Helper function to recursively build HTML
-        def build_folder_html_recursive(folder_id):
-            folder = structure[folder_id]
-            html = []
-            
-            # Don't show root folder in HTML
-            if folder_id != 'root':
-                html.append(f"""
-                <div class="folder-item" data-folder-id="{folder_id}" data-id="{folder_id}">
-                    <span class="folder-toggle"><i class="fas fa-caret-down"></i></span>
-                    <i class="fas fa-folder text-warning"></i>
-                    <span class="folder-name">{folder['name']}</span>
-                </div>
-                """)
-            
-            # Create folder content div
-            content_html = []
-            
-            # Add child folders
-            for child_id in folder['children']:
-                content_html.append(build_folder_html_recursive(child_id))
-            
-            # Add VMs in this folder
-            if folder_id in vm_by_folder:
-                for vm in vm_by_folder[folder_id]:
-                    vm_id = vm.get('vmid', vm.get('id'))
-                    vm_name = vm.get('name', f'VM {vm_id}')
-                    vm_status = vm.get('status', 'unknown')
-                    vm_node = vm.get('node', '')
-                    vm_type = vm.get('type', 'qemu')
-                    
-                    # Calculate memory usage (if available)
-                    memory_percent = 0
-                    if 'mem' in vm and 'maxmem' in vm and vm['maxmem'] > 0:
-                        memory_percent = (vm['mem'] / vm['maxmem']) * 100
-                    elif 'memory_usage' in vm:
-                        memory_percent = vm['memory_usage']
-                    
-                    # Status icon
-                    status_icon = 'circle'
-                    status_class = 'vm-status-off'
-                    if vm_status == 'running':
-                        status_class = 'vm-status-on'
-                    
-                    content_html.append(f"""
-                    <div class="vm-item" data-id="{vm_id}" data-name="{vm_name}" data-node="{vm_node}" data-type="{vm_type}">
-                        <div class="vm-status {status_class}">
-                            <i class="fas fa-{status_icon}"></i>
-                        </div>
-                        <div class="vm-info">
-                            <p class="vm-name" title="{vm_name}">{vm_name}</p>
-                            <div class="vm-memory-bar">
-                                <div class="vm-memory-fill" style="width: {memory_percent}%;"></div>
-                            </div>
-                        </div>
-                        <a href="/vm/{vm_node}/{vm_id}?type={vm_type}" class="vm-link">
-                            <i class="fas fa-external-link-alt"></i>
-                        </a>
-                    </div>
-                    """)
-            
-            # Only add content if not root or if it has content
-            if folder_id != 'root' or content_html:
-                content_parent = folder_id if folder_id != 'root' else 'root'
-                content_class = "" if folder_id == 'root' else "folder-content"
-                
-                html.append(f"""
-                <div class="{content_class}" data-parent="{content_parent}">
-                    {"".join(content_html)}
-                </div>
-                """)
-            
-            return "".join(html)
+            row = self._vm_row(vm)
+            folder_id = vm_locations.get(str(row[0]), 'root')
+            if folder_id not in structure:
+                folder_id = 'root'
+            rows_by_folder.setdefault(folder_id, []).append([row[position] for position in positions])
+        return rows_by_folder
+    
+    def _vm_row(self, vm):
+        """Tuple of the VM fields shown in the sidebar"""
+        vm_id = vm.get('vmid', vm.get('id'))
+        
+        # Calculate memory usage (if available)
+        memory_percent = 0
+        if 'mem' in vm and 'maxmem' in vm and vm['maxmem'] > 0:
+            memory_percent = (vm['mem'] / vm['maxmem']) * 100
+        elif 'memory_usage' in vm:
+            memory_percent = vm['memory_usage']
         
-        # Build from root
-        return build_folder_html_recursive('root')
\ No newline at end of file
+        return (
+            vm_id,
+            vm.get('name', f'VM {vm_id}'),
+            vm.get('status', 'unknown'),
+            vm.get('node', ''),
+            vm.get('type', 'qemu'),
+            # One decimal is plenty for the bar and avoids new tree versions on tiny changes
+            round(memory_percent, 1)
+        )
@@ -6,13 +6,57 @@ import time
 import requests
 import json
 import time
+import hashlib
 import threading
-from flask import current_app, g
+from flask import current_app, g, has_app_context
 
 # Global connection pool
 _api_instances = {}
 _api_lock = threading.RLock()
 
+# Upper bound for a single API call, in seconds
+DEFAULT_TIMEOUT = 10
+
+# Default time budget for all API calls made while handling one request, in seconds
+DEFAULT_REQUEST_BUDGET = 25
+
+# Calls are skipped once less than this much of the budget is left
+MIN_CALL_TIMEOUT = 0.1
+
+def set_request_deadline(seconds):
+    """
+    Set the time budget for all Proxmox API calls made by the current request.
+    Every call derives its timeout from what is left of the budget, and calls
+    are skipped (returning None like a failed call) once it is spent.
+    """
+    g.proxmox_deadline = time.monotonic() + seconds
+
+def remaining_budget():
+    """Seconds left of the current request's budget, or None if no deadline is set"""
+    if not has_app_context():
+        return None
+    deadline = g.get('proxmox_deadline')
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def budget_exhausted():
+    """Whether the current request has run out of time for API calls"""
+    remaining = remaining_budget()
+    return remaining is not None and remaining < MIN_CALL_TIMEOUT
+
+def request_timeout(default=DEFAULT_TIMEOUT):
+    """
+    Timeout for the next API call: the default capped by the remaining budget.
+    Returns None if the budget is spent and the call should be skipped.
+    """
+    remaining = remaining_budget()
+    if remaining is None:
+        return default
+    if remaining < MIN_CALL_TIMEOUT:
+        return None
+    return min(default, remaining)
+
 class ProxmoxAPI:
     def __init__(self, host, user, password, port=8006, verify_ssl=True):
         """
@@ -50,9 +94,14 @@ class ProxmoxAPI:
             "password": self.password
         }
         
+        timeout = request_timeout()
+        if timeout is None:
+            print(f"Skipping login to {url}: request deadline exceeded")
+            return False
+        
         try:
             print(f"Attempting to connect to {url}")
-            response = self.session.post(url, data=data, timeout=10)
+            response = self.session.post(url, data=data, timeout=timeout)
             
             if response.status_code == 200:
                 result = response.json()['data']
@@ -90,8 +139,13 @@ class ProxmoxAPI:
         url = f"https://{self.host}:{self.port}/api2/json/{endpoint}"
         headers = {"Cookie": f"PVEAuthCookie={self.token}"}
         
+        timeout = request_timeout()
+        if timeout is None:
+            print(f"Skipping GET request for {endpoint}: request deadline exceeded")
+            return None
+        
         try:
-            response = self.session.get(url, headers=headers, params=params, timeout=10)
+            response = self.session.get(url, headers=headers, params=params, timeout=timeout)
             
             if response.status_code == 200:
                 return response.json()['data']
@@ -113,8 +167,13 @@ class ProxmoxAPI:
             "CSRFPreventionToken": self.csrf_token
         }
         
+        timeout = request_timeout()
+        if timeout is None:
+            print(f"Skipping POST request for {endpoint}: request deadline exceeded")
+            return None
+        
         try:
-            response = self.session.post(url, headers=headers, data=data, timeout=10)
+            response = self.session.post(url, headers=headers, data=data, timeout=timeout)
             
             if response.status_code in [200, 201]:
                 return response.json()['data']
@@ -169,6 +228,11 @@ def get_api():
 # Add teardown function to Flask app
 def init_proxmox_api(app):
     """Initialize the Proxmox API connection pool for a Flask app"""
+    @app.before_request
+    def start_request_budget():
+        """Give every request a default deadline for its Proxmox API calls"""
+        set_request_deadline(app.config.get('PROXMOX_REQUEST_BUDGET', DEFAULT_REQUEST_BUDGET))
+    
     @app.teardown_appcontext
     def close_proxmox_api(exception=None):
         """Close Proxmox API connection at the end of a request"""
@@ -178,6 +242,32 @@ def init_proxmox_api(app):
             # The connection stays in the pool for reuse
             pass
 
+def _request_cached(key, fetch):
+    """
+    Run fetch() at most once per request and reuse its result.
+    
+    Several views ask for the same Proxmox data more than once while building a
+    single page (e.g. node status for the history update and for the dashboard),
+    so results are kept in Flask's g object for the rest of the request.
+    """
+    if not has_app_context():
+        return fetch()
+    
+    cache = g.setdefault('proxmox_cache', {})
+    if key not in cache:
+        cache[key] = fetch()
+    return cache[key]
+
+def data_version(*parts):
+    """
+    Compute a short, stable version string for fetched API data.
+    Equal data always produces the same version, so it can be used as an ETag
+    (see app.views.utils.conditional_json). It serializes all of the data, so
+    only compute it for a response that needs it.
+    """
+    payload = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
 def get_cluster_info():
     """Get information about the cluster and its nodes"""
     api = get_api()
@@ -200,7 +290,7 @@ def get_all_vms():
     api = get_api()
     
     # First try to use the cluster resources endpoint, which gives us all resources in one call
-    cluster_resources = api.get_request("cluster/resources")
+    cluster_resources = _fetch_cluster_resources()
     
     # If that fails, fall back to fetching node by node
     if cluster_resources is None:
@@ -601,6 +691,10 @@ def get_snapshots(node, vmid, vmtype='qemu'):
 
 def get_node_status():
     """Get detailed status for all nodes in the cluster"""
+    return _request_cached('node_status', _fetch_node_status)
+
+def _fetch_node_status():
+    """Fetch node list and per-node status from the API"""
     api = get_api()
     
     # Get cluster nodes
@@ -618,8 +712,11 @@ def get_node_status():
             
         # Try to get detailed status if node is online
         detailed_status = None
+        skipped = False
         if node.get('status') == 'online':
-            detailed_status = api.get_request(f"nodes/{node['node']}/status")
+            skipped = budget_exhausted()
+            if not skipped:
+                detailed_status = api.get_request(f"nodes/{node['node']}/status")
         
         # Combine basic and detailed status
         status = {**node}
@@ -627,6 +724,10 @@ def get_node_status():
         if detailed_status:
             status.update(detailed_status)
             status['online'] = True
+        elif skipped:
+            # Out of time: fall back to the summary figures from the node list
+            status['online'] = True
+            status['partial'] = True
         else:
             status['online'] = False
         
@@ -680,12 +781,14 @@ def get_storage_status():
     
     return storage_status
 
+def _fetch_cluster_resources():
+    """Fetch cluster/resources once per request (None if the call failed)"""
+    return _request_cached('cluster_resources', lambda: get_api().get_request("cluster/resources"))
+
 def get_cluster_resources():
     """Get all resources in the cluster (VMs, storage, nodes)"""
-    api = get_api()
-    
     # Get cluster resources
-    resources = api.get_request("cluster/resources")
+    resources = _fetch_cluster_resources()
     
     if not resources:
         return []
@@ -0,0 +1,939 @@
+#!/usr/bin/env python3
+"""
+Asyncio WebSocket-to-TCP relay for VNC consoles
+
+Every console is a few tasks on one event loop: the browser's WebSocket is
+upgraded here, its target is resolved (a route registered through the
+control API, by token or by URL path plus the route's key, or else a
+single-use token consumed from
+the token store), and a TCP connection is opened to the Proxmox vncproxy
+port. From then on binary frames are pumped in both directions.
+
+Each direction is a Pipe: a fixed ring buffer that one task receives into
+with recv_into and another task drains with sendmsg (writev). Payloads are
+never copied: client frames are unmasked in place (vectorized with NumPy)
+and forwarded as memoryview slices, server data goes out as frame header
+plus payload slice. Reading pauses when a pipe reaches its high watermark
+and resumes at the low watermark, so a slow browser (or a stalled VNC
+server) pushes back on the other side through TCP instead of growing
+memory; every session holds exactly two PIPE_BUFFER rings. Time spent
+paused is recorded per session, see relay_stats.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import socket
+import sys
+import time
+import uuid
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from app.proxmox.token_store import consume_token, cleanup_tokens
+
+logger = logging.getLogger("vnc-relay")
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# Limits
+MAX_HEADER_SIZE = 16 * 1024         # HTTP upgrade request
+PIPE_BUFFER = 256 * 1024            # Ring buffer per session and direction
+HIGH_WATERMARK = 128 * 1024         # Stop reading when this much is unsent
+LOW_WATERMARK = 32 * 1024           # Resume reading once drained to this
+READ_CHUNK = 64 * 1024              # Largest single read (one server frame)
+MIN_READ = 4 * 1024                 # Shorter space at the ring's end is skipped
+MAX_IOV = 512                       # Buffers per sendmsg call
+NUMPY_MIN = 64                      # Smaller payloads are unmasked in Python
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+CLEANUP_INTERVAL = 60
+STATS_INTERVAL = 10                 # Seconds between stats reports of supervised workers
+DRAIN_TIMEOUT = 3600                # Longest wait for open sessions on shutdown
+ROUTE_TTL = int(os.environ.get('RELAY_ROUTE_TTL', 300))  # Lifetime of a route not given a ttl
+LISTEN_BACKLOG = 512
+
+# WebSocket opcodes
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Open sessions by id, for status and debugging
+active_sessions = {}
+
+# Targets registered over the control API, by URL path or token (see apply_control)
+routes = {}
+
+# Totals over closed sessions, see relay_stats
+closed_totals = {'sessions': 0, 'bytes_up': 0, 'bytes_down': 0, 'backpressure_seconds': 0.0, 'pauses': 0}
+
+class HandshakeError(Exception):
+    """The HTTP upgrade request was rejected"""
+    
+    def __init__(self, status, reason):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+def unmask(payload, mask):
+    """Apply (or remove) a 4-byte XOR mask, returning new bytes"""
+    buf = bytearray(payload)
+    unmask_into(buf, 0, len(buf), mask)
+    return bytes(buf)
+
+def unmask_into(buf, offset, length, mask, phase=0):
+    """
+    XOR length bytes of buf (bytearray or memoryview) at offset with the mask, in place
+    
+    Args:
+        phase: Position in the mask of the first byte, for frames whose
+               payload arrives in several reads
+    """
+    if phase:
+        mask = mask[phase:] + mask[:phase]
+    
+    words = length // 8 if np is not None and length >= NUMPY_MIN else 0
+    if words:
+        # Eight bytes at a time, straight on the buffer (no temporary arrays)
+        arr = np.frombuffer(buf, dtype=np.uint64, count=words, offset=offset)
+        arr ^= np.uint64(int.from_bytes(mask * 2, sys.byteorder))
+    
+    done = words * 8
+    if length - done > 8:
+        end = offset + length
+        key = (mask * ((length - done) // 4 + 1))[:length - done]
+        buf[offset + done:end] = (
+            int.from_bytes(buf[offset + done:end], 'big') ^ int.from_bytes(key, 'big')
+        ).to_bytes(length - done, 'big')
+    else:
+        for i in range(done, length):
+            buf[offset + i] ^= mask[i & 3]
+
+def frame_header(opcode, length):
+    """Header of an unmasked, final server frame"""
+    first = 0x80 | opcode
+    if length < 126:
+        return bytes((first, length))
+    if length < 65536:
+        return bytes((first, 126)) + length.to_bytes(2, 'big')
+    return bytes((first, 127)) + length.to_bytes(8, 'big')
+
+async def _writable(loop, sock):
+    """Wait until sock can take more data"""
+    waiter = loop.create_future()
+    loop.add_writer(sock.fileno(), lambda: waiter.done() or waiter.set_result(None))
+    try:
+        await waiter
+    finally:
+        loop.remove_writer(sock.fileno())
+
+async def send_vectored(loop, sock, buffers):
+    """
+    Send several buffers with sendmsg (writev) without joining them
+    
+    Falls back to one joined sock_sendall where sendmsg is not available.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        await loop.sock_sendall(sock, b''.join(buffers))
+        return
+    
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        try:
+            sent = sock.sendmsg(views)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        
+        # Drop what went out, keep the unsent tail of a partly sent buffer
+        while sent and views:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+        if views:
+            await _writable(loop, sock)
+
+def parse_request(raw):
+    """
+    Parse and validate the HTTP upgrade request
+    
+    Returns:
+        (path, headers) with lower-cased header names
+    """
+    lines = raw.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ')
+    if len(parts) != 3 or parts[0] != 'GET':
+        raise HandshakeError(400, 'Bad Request')
+    
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    
+    if headers.get('upgrade', '').lower() != 'websocket' or 'sec-websocket-key' not in headers:
+        raise HandshakeError(426, 'Upgrade Required')
+    return parts[1], headers
+
+def handshake_response(headers):
+    """101 response accepting the upgrade (echoes the 'binary' subprotocol if offered)"""
+    accept = base64.b64encode(hashlib.sha1(headers['sec-websocket-key'].encode() + WS_GUID).digest()).decode()
+    lines = [
+        'HTTP/1.1 101 Switching Protocols',
+        'Upgrade: websocket',
+        'Connection: Upgrade',
+        f'Sec-WebSocket-Accept: {accept}'
+    ]
+    
+    # noVNC asks for 'binary'; the response may only name a protocol the client offered
+    offered = [p.strip() for p in headers.get('sec-websocket-protocol', '').split(',')]
+    if 'binary' in offered:
+        lines.append('Sec-WebSocket-Protocol: binary')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode()
+
+def error_response(status, reason):
+    """Plain HTTP error answering a failed upgrade"""
+    body = reason.encode()
+    return (
+        f'HTTP/1.1 {status} {reason}\r\nContent-Type: text/plain\r\n'
+        f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+    )
+
+async def open_target(loop, host, port):
+    """Connect a non-blocking TCP socket to the VNC server"""
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    error = None
+    for family, type_, proto, _, address in infos:
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, address), CONNECT_TIMEOUT)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except (OSError, asyncio.TimeoutError) as e:
+            sock.close()
+            error = e
+    raise error or OSError(f"No address for {host}")
+
+class Pipe:
+    """
+    One direction of a session: a fixed ring buffer between a reader and a writer
+    
+    The reading task receives into the free part of the ring and queues what
+    is to be sent; the writing task sends queued buffers and frees their
+    space. head and tail are stream offsets (the ring position is offset %
+    size), so the bytes in flight are always tail - head.
+    """
+    
+    def __init__(self, loop, size=PIPE_BUFFER, high=HIGH_WATERMARK, low=LOW_WATERMARK):
+        self.loop = loop
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.size = size
+        self.high = high
+        self.low = low
+        
+        self.head = 0
+        self.tail = 0
+        self.queue = deque()        # (buffers, release_to) in send order
+        self.closed = False
+        self.sent = 0
+        self.peak = 0
+        
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._ready = asyncio.Event()
+        
+        # Back-pressure metrics
+        self.pauses = 0
+        self.paused_at = None
+        self.paused_time = 0.0
+    
+    @property
+    def used(self):
+        return self.tail - self.head
+    
+    @property
+    def backpressure_time(self):
+        """Seconds the reader has spent paused, including a pause still in progress"""
+        if self.paused_at is None:
+            return self.paused_time
+        return self.paused_time + time.monotonic() - self.paused_at
+    
+    async def read_into(self, sock):
+        """
+        Wait until the pipe is below its high watermark, then receive from sock
+        
+        Returns:
+            memoryview of the bytes received, in the ring (empty at end of stream)
+        """
+        if not self._resume.is_set():
+            await self._resume.wait()
+        
+        start = self.tail % self.size
+        if self.size - start < MIN_READ:
+            # Too little room before the end of the ring: skip it, the writer frees it in order
+            self.tail += self.size - start
+            self.push((), self.tail)
+            start = 0
+        room = min(self.size - self.used, self.size - start, READ_CHUNK)
+        
+        received = await self.loop.sock_recv_into(sock, self.view[start:start + room])
+        self.tail += received
+        self.peak = max(self.peak, self.used)
+        if self.used >= self.high and self.paused_at is None:
+            self._resume.clear()
+            self.paused_at = time.monotonic()
+            self.pauses += 1
+        return self.view[start:start + received]
+    
+    def push(self, buffers, release_to=None):
+        """Queue buffers for sending; ring space up to release_to is freed once they are sent"""
+        if self.closed:
+            return
+        self.queue.append((buffers, release_to))
+        self._ready.set()
+    
+    def close(self):
+        """No more data: the writer stops once the queue is sent"""
+        self.closed = True
+        self._ready.set()
+    
+    def _release(self, offset):
+        self.head = offset
+        if self.paused_at is not None and self.used <= self.low:
+            self.paused_time += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self._resume.set()
+    
+    async def write_to(self, sock):
+        """Send queued buffers to sock, batched into sendmsg calls, until closed and drained"""
+        while True:
+            if not self.queue:
+                if self.closed:
+                    return
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            
+            buffers = []
+            release_to = None
+            # Always take the first item, even one with more than MAX_IOV buffers
+            # (a read full of tiny client frames)
+            while self.queue and (not buffers or len(buffers) + len(self.queue[0][0]) <= MAX_IOV):
+                item, release = self.queue.popleft()
+                buffers.extend(item)
+                if release is not None:
+                    release_to = release
+            
+            for start in range(0, len(buffers), MAX_IOV):
+                await send_vectored(self.loop, sock, buffers[start:start + MAX_IOV])
+            self.sent += sum(len(b) for b in buffers)
+            if release_to is not None:
+                self._release(release_to)
+    
+    def stats(self):
+        return {
+            'buffered': self.used,
+            'peak_buffered': self.peak,
+            'bytes_sent': self.sent,
+            'pauses': self.pauses,
+            'backpressure_seconds': round(self.backpressure_time, 3),
+            'paused': self.paused_at is not None
+        }
+
+class ConsoleSession:
+    """
+    One browser console relayed to one VNC server
+    
+    upstream carries browser bytes to the VNC server, downstream carries
+    server bytes to the browser as WebSocket frames. Client frames are
+    parsed incrementally as they arrive in the upstream ring, so a frame
+    header split between two reads is collected in self.header.
+    """
+    
+    def __init__(self, loop, client, peer):
+        self.loop = loop
+        self.client = client
+        self.peer = peer
+        self.server = None
+        self.target = None
+        self.started_at = time.time()
+        
+        self.upstream = Pipe(loop)
+        self.downstream = Pipe(loop)
+        
+        # Client frame being parsed
+        self.header = bytearray()
+        self.opcode = None
+        self.mask = None
+        self.remaining = 0
+        self.phase = 0
+        self.control = bytearray()
+    
+    def send_frame(self, opcode, payload=b''):
+        """Queue one frame to the client"""
+        self.downstream.push((frame_header(opcode, len(payload)), bytes(payload)))
+    
+    async def handshake(self):
+        """Read the upgrade request; returns (path, headers, bytes read past it)"""
+        pipe = self.upstream
+        while True:
+            # The request is far smaller than the ring, so it stays contiguous from 0
+            end = pipe.buf.find(b'\r\n\r\n', 0, pipe.tail)
+            if end >= 0:
+                break
+            if pipe.tail >= MAX_HEADER_SIZE:
+                raise HandshakeError(431, 'Request Header Fields Too Large')
+            if not await pipe.read_into(self.client):
+                raise ConnectionError("Client closed the connection")
+        
+        # Anything after the request already belongs to the WebSocket stream
+        path, headers = parse_request(bytes(pipe.view[:end]))
+        return path, headers, pipe.view[end + 4:pipe.tail]
+    
+    def _header_length(self):
+        """Length of the frame header being collected (so far as it is known)"""
+        if len(self.header) < 2:
+            return 2
+        length = self.header[1] & 0x7F
+        return 2 + (2 if length == 126 else 8 if length == 127 else 0) + 4
+    
+    def _start_frame(self):
+        """Decode the complete header in self.header"""
+        first, second = self.header[0], self.header[1]
+        if not second & 0x80:
+            raise ConnectionError("Client frame is not masked")
+        
+        length = second & 0x7F
+        extra = len(self.header) - 6
+        if extra:
+            length = int.from_bytes(self.header[2:2 + extra], 'big')
+        
+        self.opcode = first & 0x0F
+        self.mask = bytes(self.header[-4:])
+        self.remaining = length
+        self.phase = 0
+        self.header.clear()
+        
+        if self.opcode >= OP_CLOSE:
+            # Control frames are short and never fragmented
+            if length > 125:
+                raise ValueError(f"Control frame of {length} bytes")
+            self.control.clear()
+        elif self.opcode not in (OP_BINARY, OP_TEXT, OP_CONTINUATION):
+            raise ValueError(f"Unknown opcode {self.opcode}")
+    
+    def _control_frame(self):
+        """Act on a complete control frame; returns True for close"""
+        payload = self.control
+        unmask_into(payload, 0, len(payload), self.mask)
+        
+        if self.opcode == OP_PING:
+            self.send_frame(OP_PONG, payload)
+        elif self.opcode == OP_CLOSE:
+            # Echo the status code back and stop
+            self.send_frame(OP_CLOSE, payload[:2])
+            return True
+        elif self.opcode != OP_PONG:
+            raise ValueError(f"Unknown opcode {self.opcode}")
+        return False
+    
+    def parse(self, data):
+        """
+        Parse client bytes (a view into the upstream ring)
+        
+        Data frame payloads are unmasked in place; the VNC stream has no
+        message boundaries, so fragments go straight through.
+        
+        Returns:
+            (payload views to forward to the server, True if the client closed)
+        """
+        forward = []
+        pos = 0
+        while pos < len(data):
+            if self.opcode is None:
+                need = self._header_length()
+                take = min(need - len(self.header), len(data) - pos)
+                self.header += data[pos:pos + take]
+                pos += take
+                if len(self.header) < need or need != self._header_length():
+                    continue
+                self._start_frame()
+            else:
+                take = min(self.remaining, len(data) - pos)
+                if self.opcode >= OP_CLOSE:
+                    self.control += data[pos:pos + take]
+                else:
+                    unmask_into(data, pos, take, self.mask, self.phase)
+                    forward.append(data[pos:pos + take])
+                    self.phase = (self.phase + take) & 3
+                self.remaining -= take
+                pos += take
+            
+            if not self.remaining:
+                closing = self.opcode >= OP_CLOSE and self._control_frame()
+                self.opcode = None
+                if closing:
+                    return forward, True
+        return forward, False
+    
+    async def client_to_server(self, pending=b''):
+        """Pump WebSocket frames from the browser to the VNC server"""
+        pipe = self.upstream
+        data = pending
+        while True:
+            forward, closing = self.parse(data)
+            pipe.push(forward, pipe.tail)
+            if closing:
+                self.downstream.close()
+                pipe.close()
+                return
+            
+            data = await pipe.read_into(self.client)
+            if not data:
+                raise ConnectionError("Client closed the connection")
+    
+    async def server_to_client(self):
+        """Pump data from the VNC server to the browser as binary frames"""
+        pipe = self.downstream
+        while True:
+            data = await pipe.read_into(self.server)
+            if not data:
+                self.send_frame(OP_CLOSE, (1000).to_bytes(2, 'big'))
+                pipe.close()
+                return
+            pipe.push((frame_header(OP_BINARY, len(data)), data), pipe.tail)
+    
+    async def run(self):
+        """Upgrade, resolve the token, then relay until either side closes"""
+        try:
+            path, headers, pending = await asyncio.wait_for(self.handshake(), HANDSHAKE_TIMEOUT)
+            
+            url = urlsplit(path)
+            token = parse_qs(url.query).get('token', [''])[0]
+            target = lookup_route(url.path, token)
+            if target is None:
+                if not token:
+                    raise HandshakeError(401, 'Missing token')
+                
+                # The token store may block (SQLite locks), so keep it off the event loop
+                target = await self.loop.run_in_executor(None, consume_token, token)
+                if not target or not target.get('host') or not target.get('port'):
+                    raise HandshakeError(403, 'Invalid token')
+            
+            self.target = target
+            host, port = target['host'], int(target['port'])
+            try:
+                self.server = await open_target(self.loop, host, port)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning(f"Cannot reach VNC server {host}:{port}: {e}")
+                raise HandshakeError(502, 'Bad Gateway')
+        except HandshakeError as e:
+            logger.info(f"Rejected console connection from {self.peer}: {e.status} {e.reason}")
+            await self.loop.sock_sendall(self.client, error_response(e.status, e.reason))
+            return
+        
+        await self.loop.sock_sendall(self.client, handshake_response(headers))
+        logger.info(f"Console {self.peer} -> {host}:{port} (vmid {target.get('vmid')}) connected, "
+                    f"{len(active_sessions)} active")
+        
+        # A reader and a writer per direction; the session ends once the browser
+        # has been sent a close frame, or as soon as any of them fails
+        pumps = [
+            asyncio.ensure_future(self.client_to_server(pending)),
+            asyncio.ensure_future(self.upstream.write_to(self.server)),
+            asyncio.ensure_future(self.server_to_client()),
+            asyncio.ensure_future(self.downstream.write_to(self.client))
+        ]
+        try:
+            waiting = set(pumps)
+            while not pumps[3].done():
+                done, waiting = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if any(not task.cancelled() and task.exception() for task in done):
+                    break
+        finally:
+            for task in pumps:
+                task.cancel()
+            results = await asyncio.gather(*pumps, return_exceptions=True)
+        
+        for error in results:
+            if isinstance(error, Exception) and not isinstance(error, ConnectionError):
+                logger.warning(f"Console {self.peer} closed with error: {error}")
+                if isinstance(error, ValueError):
+                    await send_vectored(self.loop, self.client, (frame_header(OP_CLOSE, 2), (1002).to_bytes(2, 'big')))
+    
+    def stats(self):
+        """Buffer and back-pressure figures for both directions"""
+        target = self.target or {}
+        return {
+            'peer': f"{self.peer[0]}:{self.peer[1]}",
+            'target': f"{target.get('host')}:{target.get('port')}" if target else None,
+            'vmid': target.get('vmid'),
+            'age_seconds': round(time.time() - self.started_at, 1),
+            'upstream': self.upstream.stats(),
+            'downstream': self.downstream.stats()
+        }
+    
+    def close(self):
+        """Close both sockets"""
+        for sock in (self.server, self.client):
+            if sock is not None:
+                sock.close()
+
+async def handle_client(client, peer):
+    """Serve one accepted console connection"""
+    loop = asyncio.get_running_loop()
+    client.setblocking(False)
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    session = ConsoleSession(loop, client, peer)
+    active_sessions[id(session)] = session
+    try:
+        await session.run()
+    except (ConnectionError, asyncio.TimeoutError):
+        pass
+    except Exception as e:
+        logger.exception(f"Error relaying console for {peer}: {e}")
+    finally:
+        active_sessions.pop(id(session), None)
+        session.close()
+        if session.server is not None:
+            up, down = session.upstream, session.downstream
+            closed_totals['sessions'] += 1
+            closed_totals['bytes_up'] += up.sent
+            closed_totals['bytes_down'] += down.sent
+            closed_totals['backpressure_seconds'] += up.backpressure_time + down.backpressure_time
+            closed_totals['pauses'] += up.pauses + down.pauses
+            logger.info(f"Console {peer} closed after {time.time() - session.started_at:.0f}s, "
+                        f"back-pressured {up.backpressure_time:.1f}s up / {down.backpressure_time:.1f}s down")
+
+def relay_stats():
+    """
+    Buffer and back-pressure figures for the relay
+    
+    Returns:
+        dict with the open sessions' stats and totals over closed sessions
+    """
+    return {
+        'active': len(active_sessions),
+        'sessions': [session.stats() for session in list(active_sessions.values())],
+        'closed': dict(closed_totals)
+    }
+
+def lookup_route(path, token):
+    """
+    Registered target for a URL path or a token, if any
+    
+    A path can be guessed, so a path route also needs its key as the token.
+    """
+    for name in (path, token):
+        target = routes.get(name) if name else None
+        if target is None:
+            continue
+        if target['expires_at'] < time.time():
+            routes.pop(name, None)
+            continue
+        if name == path and not hmac.compare_digest(target.get('key', ''), token or ''):
+            logger.warning(f"Wrong or missing key for route {path}")
+            continue
+        return target
+    return None
+
+def expire_routes():
+    """Drop routes whose ttl has passed; returns how many were dropped"""
+    now = time.time()
+    expired = [name for name, target in routes.items() if target['expires_at'] < now]
+    for name in expired:
+        del routes[name]
+    return len(expired)
+
+def apply_control(command, log=True):
+    """
+    Apply one control command to the route table
+    
+    Commands are dicts with an 'op':
+        register: host, port and optionally path (route by URL path), route
+                  (the name to use, else a new token), ttl in seconds
+                  (default ROUTE_TTL; register again to keep a route) and
+                  extra fields such as vmid, kept with the target. A path
+                  route gets a key (or keeps the one given), which clients
+                  must send as ?token=; it is returned as 'key'
+        unregister: route (a path or token)
+        routes: list the registered routes
+        stats: buffer and back-pressure figures (see relay_stats)
+    
+    Returns:
+        Response dict with 'ok', and 'error' when it is False
+    """
+    op = command.get('op')
+    if op in ('register', 'routes'):
+        expire_routes()
+    
+    if op == 'register':
+        if not command.get('host') or not command.get('port'):
+            return {'ok': False, 'error': 'host and port are required'}
+        
+        name = command.get('route') or command.get('path') or uuid.uuid4().hex
+        target = {k: v for k, v in command.items() if k not in ('op', 'route', 'path', 'ttl', 'expires_at', 'key')}
+        target['port'] = int(target['port'])
+        
+        # Copies made by route_command keep the original expiry
+        if command.get('expires_at'):
+            target['expires_at'] = float(command['expires_at'])
+        else:
+            target['expires_at'] = time.time() + float(command.get('ttl') or ROUTE_TTL)
+        
+        previous = routes.get(name)
+        if name.startswith('/'):
+            target['key'] = str(command.get('key') or (previous or {}).get('key') or secrets.token_urlsafe(16))
+        
+        # Refreshing a route (same name, same target) isn't worth a log line
+        routes[name] = target
+        if log and (previous is None or (previous['host'], previous['port']) != (target['host'], target['port'])):
+            logger.info(f"Route {name} -> {target['host']}:{target['port']}")
+        if 'key' in target:
+            return {'ok': True, 'route': name, 'key': target['key']}
+        return {'ok': True, 'route': name}
+    
+    if op == 'unregister':
+        name = command.get('route') or command.get('path')
+        if routes.pop(name, None) is None:
+            return {'ok': False, 'route': name, 'error': 'No such route'}
+        if log:
+            logger.info(f"Route {name} removed")
+        return {'ok': True, 'route': name}
+    
+    if op == 'routes':
+        return {'ok': True, 'routes': routes}
+    
+    if op == 'stats':
+        return {'ok': True, 'stats': relay_stats()}
+    return {'ok': False, 'error': f"Unknown op {op!r}"}
+
+def route_command(name):
+    """The command that recreates route `name` as it is now (or removes it) elsewhere"""
+    if name in routes:
+        return dict(routes[name], op='register', route=name)
+    return {'op': 'unregister', 'route': name}
+
+async def serve_control(path, handler=apply_control):
+    """
+    Serve the control API on a Unix socket only the owner can use
+    
+    Each line a client sends is one JSON command, answered by one line of
+    JSON from handler(command).
+    
+    Returns:
+        The asyncio server
+    """
+    async def client(reader, writer):
+        try:
+            async for line in reader:
+                try:
+                    response = handler(json.loads(line))
+                except (ValueError, TypeError, AttributeError) as e:
+                    response = {'ok': False, 'error': f"Bad command: {e}"}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    # A socket left behind by a previous run would make the bind fail
+    if os.path.exists(path):
+        os.unlink(path)
+    umask = os.umask(0o177)
+    try:
+        server = await asyncio.start_unix_server(client, path)
+    finally:
+        os.umask(umask)
+    logger.info(f"Relay control API on {path}")
+    return server
+
+async def follow_routes(fd, synced):
+    """
+    Apply route commands arriving on a pipe, one JSON command per line
+    
+    Used by supervised workers; synced is set when the supervisor's
+    snapshot of the table is complete (the 'synced' marker).
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+    async for line in reader:
+        command = json.loads(line)
+        if command.get('op') == 'synced':
+            synced.set()
+        else:
+            # The supervisor has logged the change already
+            apply_control(command, log=False)
+
+class RelayServer:
+    """Accept loop on a listening socket; each connection gets its own task"""
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self._accept_task = None
+        self._clients = set()
+    
+    def start(self):
+        self._accept_task = asyncio.ensure_future(self._accept_loop())
+    
+    async def _accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, peer = await loop.sock_accept(self.sock)
+            except OSError as e:
+                logger.warning(f"Accept failed: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            task = asyncio.ensure_future(handle_client(client, peer))
+            self._clients.add(task)
+            task.add_done_callback(self._clients.discard)
+    
+    async def serve_forever(self):
+        """Wait until the server is closed"""
+        try:
+            await self._accept_task
+        except asyncio.CancelledError:
+            pass
+    
+    def close(self):
+        """Stop accepting; sessions already open keep running"""
+        if self._accept_task is not None:
+            self._accept_task.cancel()
+        self.sock.close()
+    
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        """Stop accepting, then wait up to timeout for the open sessions to end"""
+        self.close()
+        clients = list(self._clients)
+        if not clients:
+            return
+        
+        logger.info(f"Draining {len(clients)} console sessions")
+        try:
+            await asyncio.wait(clients, timeout=timeout)
+        finally:
+            # Sessions still open after the timeout (or a forced stop) are closed
+            for task in clients:
+                task.cancel()
+
+def listen_socket(host='0.0.0.0', port=8765, reuse_port=False):
+    """
+    Create the non-blocking listening socket
+    
+    Args:
+        reuse_port: Set SO_REUSEPORT, so several sockets (one per worker)
+                    can listen on the same port
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+async def cleanup_loop():
+    """Drop expired tokens once a minute"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL)
+        try:
+            await loop.run_in_executor(None, cleanup_tokens)
+        except Exception as e:
+            logger.exception(f"Error cleaning up tokens: {e}")
+
+async def stats_loop(report):
+    """Hand relay_stats() to report every STATS_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        try:
+            report(relay_stats())
+        except Exception as e:
+            logger.exception(f"Error reporting relay stats: {e}")
+
+async def start_relay(host='0.0.0.0', port=8765, sock=None):
+    """
+    Start accepting consoles; returns the RelayServer
+    
+    Args:
+        sock: Listening socket to serve (e.g. inherited from the supervisor)
+              instead of binding host:port
+    """
+    server = RelayServer(sock if sock is not None else listen_socket(host, port))
+    server.start()
+    host, port = server.sock.getsockname()[:2]
+    logger.info(f"VNC relay listening on {host}:{port}")
+    return server
+
+async def run_relay(host='0.0.0.0', port=8765, sock=None, cleanup=True, on_ready=None,
+                    control=None, route_feed=None, on_stats=None):
+    """
+    Run the relay until SIGTERM, then drain
+    
+    SIGTERM stops accepting and lets the open sessions finish (for up to
+    DRAIN_TIMEOUT); a second SIGTERM closes them at once.
+    
+    Args:
+        sock: Listening socket to serve instead of binding host:port
+        cleanup: Also drop expired tokens periodically
+        on_ready: Called once connections are being accepted
+        control: Path of a Unix socket to serve the control API on
+        route_feed: File descriptor of a pipe carrying route commands (from
+                    the supervisor); accepting starts once its snapshot is in
+        on_stats: Called with relay_stats() every STATS_INTERVAL seconds
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [asyncio.ensure_future(cleanup_loop())] if cleanup else []
+    if on_stats is not None:
+        tasks.append(asyncio.ensure_future(stats_loop(on_stats)))
+    if route_feed is not None:
+        synced = asyncio.Event()
+        tasks.append(asyncio.ensure_future(follow_routes(route_feed, synced)))
+        await synced.wait()
+    
+    server = await start_relay(host, port, sock)
+    control_server = await serve_control(control) if control else None
+    
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+    if on_ready is not None:
+        on_ready()
+    
+    try:
+        await stop
+        drain = asyncio.ensure_future(server.drain())
+        tasks.append(drain)
+        
+        # A second SIGTERM stops waiting for the sessions
+        forced = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: forced.done() or forced.set_result(None))
+        await asyncio.wait([drain, forced], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        for task in tasks:
+            task.cancel()
+        if control_server is not None:
+            control_server.close()
+        server.close()
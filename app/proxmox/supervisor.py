@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Supervisor for multi-process VNC relay workers
+
+The supervisor owns one listening socket per worker slot, all bound to the
+same port with SO_REUSEPORT, and runs a relay worker per slot with that
+socket passed as an inherited file descriptor. The kernel spreads new
+connections over the sockets, so console throughput scales with cores.
+
+SIGHUP replaces the workers one slot at a time with freshly started ones
+(picking up new code): the new worker takes over the slot's socket, which
+the supervisor keeps open so no queued connection is lost, and only once it
+is accepting is the old worker sent SIGTERM. A draining worker stops
+accepting but keeps relaying its open sessions until they end. SIGTERM or
+SIGINT drains every worker and exits; a second one stops them at once.
+
+The supervisor also serves the relay's control API. It keeps the route
+table and forwards every change to the workers through their stdin; a new
+worker gets a snapshot of the table before it starts accepting. Workers
+report their stats on stdout every STATS_INTERVAL seconds, and the 'stats'
+op answers with the sum over all of them.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+
+from app.proxmox.relay import listen_socket, routes, apply_control, route_command, serve_control
+
+logger = logging.getLogger("relay-supervisor")
+
+READY_TIMEOUT = 30      # Seconds a new worker has to start accepting
+RESTART_DELAY = 1       # Pause before replacing a worker that died
+OUTPUT_LIMIT = 16 * 1024 * 1024  # Longest line a worker may print (stats of every session)
+
+class Worker:
+    """One relay worker process serving one slot"""
+    
+    def __init__(self, slot, process):
+        self.slot = slot
+        self.process = process
+        self.draining = False
+        self.stats = None       # Last stats the worker reported
+    
+    @property
+    def pid(self):
+        return self.process.pid
+    
+    def signal(self, signum):
+        if self.process.returncode is None:
+            self.process.send_signal(signum)
+    
+    def send(self, command):
+        """Queue a route command on the worker's stdin"""
+        if self.process.returncode is None:
+            self.process.stdin.write(json.dumps(command).encode() + b'\n')
+
+class Supervisor:
+    """
+    Runs and replaces relay workers
+    
+    Args:
+        command: argv that starts a worker; '--fd <n> --slot <i>' is appended
+                 and the worker prints 'ready' on stdout once it accepts
+        control: Path of the Unix socket for the control API
+    """
+    
+    def __init__(self, host, port, workers, command, control=None):
+        self.host = host
+        self.port = port
+        self.count = max(1, workers)
+        self.command = list(command)
+        self.control = control
+        
+        self.sockets = []
+        self.workers = {}           # slot -> current Worker
+        self.retired = set()        # Draining workers of older generations
+        self.starting = set()       # Workers that have their snapshot but aren't ready yet
+        self._watchers = set()
+        self._reload_lock = asyncio.Lock()
+        self._stop = None
+        self.stopping = False
+    
+    def _open_sockets(self):
+        """One SO_REUSEPORT socket per slot, or one shared socket where that is unavailable"""
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.sockets = [listen_socket(self.host, self.port, reuse_port=True) for _ in range(self.count)]
+        else:
+            logger.warning("SO_REUSEPORT is not available, workers share one listening socket")
+            self.sockets = [listen_socket(self.host, self.port)] * self.count
+    
+    async def start_worker(self, slot):
+        """Start a worker on the slot's socket and wait until it is accepting"""
+        fd = self.sockets[slot].fileno()
+        process = await asyncio.create_subprocess_exec(
+            *self.command, '--fd', str(fd), '--slot', str(slot),
+            pass_fds=(fd,), stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            limit=OUTPUT_LIMIT
+        )
+        
+        # The current routes go first; the worker accepts only after 'synced'.
+        # Changes made until it is ready reach it through self.starting.
+        worker = Worker(slot, process)
+        self.starting.add(worker)
+        for name in list(routes):
+            worker.send(route_command(name))
+        worker.send({'op': 'synced'})
+        
+        try:
+            line = await asyncio.wait_for(process.stdout.readline(), READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            line = b''
+        finally:
+            self.starting.discard(worker)
+        if line.strip() != b'ready':
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            raise RuntimeError(f"relay worker for slot {slot} did not start")
+        
+        watcher = asyncio.ensure_future(self._watch(worker))
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+        logger.info(f"Relay worker {slot} started (pid {worker.pid})")
+        return worker
+    
+    async def _watch(self, worker):
+        """Pass the worker's output through, then replace it if it died unexpectedly"""
+        async for line in worker.process.stdout:
+            if line.startswith(b'stats '):
+                worker.stats = json.loads(line[6:])
+                continue
+            sys.stdout.buffer.write(line)
+            sys.stdout.flush()
+        code = await worker.process.wait()
+        self.retired.discard(worker)
+        
+        if worker.draining or self.stopping:
+            logger.info(f"Relay worker {worker.slot} (pid {worker.pid}) finished, exit code {code}")
+            return
+        
+        logger.warning(f"Relay worker {worker.slot} (pid {worker.pid}) exited with code {code}, restarting")
+        while self.workers.get(worker.slot) is worker and not self.stopping:
+            await asyncio.sleep(RESTART_DELAY)
+            try:
+                self.workers[worker.slot] = await self.start_worker(worker.slot)
+            except Exception as e:
+                logger.error(f"Could not restart relay worker {worker.slot}: {e}")
+    
+    def stats(self):
+        """
+        Sum of the stats last reported by the workers, draining ones included
+        
+        Returns:
+            dict like relay_stats(), plus 'workers': pid -> that worker's totals
+        """
+        totals = {'active': 0, 'sessions': [], 'closed': {}, 'workers': {}}
+        for worker in list(self.workers.values()) + list(self.retired):
+            if worker.stats is None:
+                continue
+            totals['workers'][worker.pid] = {
+                'slot': worker.slot, 'draining': worker.draining,
+                'active': worker.stats['active'], 'closed': worker.stats['closed']
+            }
+            totals['active'] += worker.stats['active']
+            totals['sessions'].extend(worker.stats['sessions'])
+            for key, value in worker.stats['closed'].items():
+                totals['closed'][key] = totals['closed'].get(key, 0) + value
+        return totals
+    
+    def handle_control(self, command):
+        """Control API: route changes apply to the supervisor's table and every worker, starting ones included"""
+        if command.get('op') == 'stats':
+            return {'ok': True, 'stats': self.stats()}
+        
+        response = apply_control(command)
+        if response['ok'] and command.get('op') in ('register', 'unregister'):
+            update = route_command(response['route'])
+            for worker in list(self.workers.values()) + list(self.starting):
+                worker.send(update)
+        return response
+    
+    def _retire(self, worker):
+        """Send a worker SIGTERM: it stops accepting and finishes its sessions"""
+        worker.draining = True
+        self.retired.add(worker)
+        worker.signal(signal.SIGTERM)
+    
+    async def reload(self):
+        """Replace every worker, one slot at a time, without dropping sessions"""
+        async with self._reload_lock:
+            logger.info(f"Reloading {self.count} relay workers")
+            for slot in range(self.count):
+                if self.stopping:
+                    return
+                old = self.workers.get(slot)
+                try:
+                    new = await self.start_worker(slot)
+                except Exception as e:
+                    logger.error(f"Keeping the old relay worker {slot}: {e}")
+                    continue
+                
+                self.workers[slot] = new
+                if old is not None:
+                    self._retire(old)
+            logger.info(f"Reload done, {len(self.retired)} old workers draining")
+    
+    def _on_stop(self):
+        if self._stop.done():
+            # Second signal: end the sessions now
+            for worker in list(self.workers.values()) + list(self.retired):
+                worker.signal(signal.SIGTERM)
+            return
+        self.stopping = True
+        self._stop.set_result(None)
+    
+    async def run(self):
+        """Start the workers and supervise them until SIGTERM or SIGINT"""
+        loop = asyncio.get_running_loop()
+        self._stop = loop.create_future()
+        self._open_sockets()
+        
+        for slot in range(self.count):
+            self.workers[slot] = await self.start_worker(slot)
+        logger.info(f"VNC relay on {self.host}:{self.port} with {self.count} workers (supervisor pid {os.getpid()})")
+        control = await serve_control(self.control, self.handle_control) if self.control else None
+        
+        loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload()))
+        loop.add_signal_handler(signal.SIGTERM, self._on_stop)
+        loop.add_signal_handler(signal.SIGINT, self._on_stop)
+        
+        await self._stop
+        if control is not None:
+            control.close()
+        logger.info("Stopping relay workers, open sessions are drained first")
+        for worker in list(self.workers.values()):
+            self._retire(worker)
+        
+        # Nobody will accept any more, so new connections are refused rather than queued
+        for sock in set(self.sockets):
+            sock.close()
+        
+        workers = list(self.retired)
+        await asyncio.gather(*(worker.process.wait() for worker in workers))
+        logger.info("All relay workers stopped")
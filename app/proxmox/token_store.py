@@ -1,134 +1,492 @@
 # app/proxmox/token_store.py
+"""
+Store for VNC console tokens, shared by the Flask app and the relay
+
+A token record is one flat dict: the connection details given when the token
+was issued (host, port, ticket, node, vmid, vmtype and optionally
+verify_ssl) plus created_at and expires_at. Tokens are single use: the relay
+consumes a token when the console connects.
+
+Backends (TOKEN_BACKEND), all implementing TokenStore:
+
+- sqlite (default): a SQLite database in WAL mode shared by every Flask
+  worker and relay process. Writers are serialized by SQLite's own file
+  locks, lookups go through the primary key and expiry through an index.
+- memory: a dict (O(1) lookup) plus a min-heap ordered by expiry (O(log n)
+  insert and expire), for a single process. With TOKEN_MIRROR=1 the issuing
+  process also mirrors its live tokens to websocket_tokens.json for the old
+  debugging scripts; that rewrites the whole file on every change and
+  supports only one issuing process, so setups with several processes use
+  sqlite instead.
+- signed: nothing is stored; the token is the record itself, encrypted and
+  signed (Fernet) with CONSOLE_TOKEN_KEY. Signed tokens can't be made single
+  use, so they expire after SIGNED_TOKEN_TTL.
+
+bench_token_store.py in the project root measures the backends.
+"""
 import os
 import json
 import time
+import uuid
+import heapq
+import base64
+import hashlib
+import sqlite3
 import threading
 import logging
+from abc import ABC, abstractmethod
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
-# Use absolute path for token file
-# Make sure this is an absolute path to avoid any path resolution issues
+# Use absolute path for the optional mirror file of the memory backend
 TOKEN_FILE = os.path.abspath(os.path.join(os.getcwd(), 'websocket_tokens.json'))
-TOKEN_LOCK = threading.Lock()
-
-# Ensure token file exists with proper structure on module import
-def initialize_token_file():
-    """Ensure token file exists and is properly initialized"""
-    if not os.path.exists(TOKEN_FILE):
-        logger.info(f"Creating new token file at {TOKEN_FILE}")
-        os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok=True)
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump({}, f)
-    else:
-        # Verify the file contains valid JSON
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                content = f.read().strip()
-                if not content:  # Empty file
-                    logger.info(f"Empty token file found, initializing with empty object")
-                    with open(TOKEN_FILE, 'w') as f:
-                        json.dump({}, f)
-                else:
-                    json.loads(content)  # Just to validate
-        except json.JSONDecodeError:
-            logger.warning(f"Invalid JSON in token file, reinitializing")
-            with open(TOKEN_FILE, 'w') as f:
-                json.dump({}, f)
-
-# Initialize token file when module is imported
-initialize_token_file()
-
-def save_token(token, data):
-    """Save a token to the shared file"""
-    logger.info(f"Saving token {token} to file {TOKEN_FILE}")
-    
-    # Create directory if it doesn't exist
-    os.makedirs(os.path.dirname(TOKEN_FILE), exist_ok=True)
-    
-    with TOKEN_LOCK:
-        # Load existing tokens
-        tokens = {}
-        if os.path.exists(TOKEN_FILE):
-            try:
-                with open(TOKEN_FILE, 'r') as f:
-                    content = f.read().strip()
-                    if content:
-                        tokens = json.loads(content)
-                    else:
-                        tokens = {}
-            except json.JSONDecodeError:
-                # If file is corrupted, start fresh
-                tokens = {}
-        
-        # Add the new token
-        tokens[token] = {
-            'data': data,
-            'created_at': time.time()
-        }
-        
-        # Save back to file
-        with open(TOKEN_FILE, 'w') as f:
-            json.dump(tokens, f)
+TOKEN_DB = os.path.abspath(os.environ.get('TOKEN_DB', os.path.join(os.getcwd(), 'app', 'data', 'tokens.db')))
+
+# Seconds a token stays valid
+TOKEN_TTL = 300
+SIGNED_TOKEN_TTL = 60
+
+# CONSOLE_TOKEN_MODE=signed is still accepted for TOKEN_BACKEND=signed
+TOKEN_BACKEND = os.environ.get('TOKEN_BACKEND') or (
+    'signed' if os.environ.get('CONSOLE_TOKEN_MODE') == 'signed' else 'sqlite'
+)
+
+# TOKEN_MIRROR=1 writes the memory backend's tokens to TOKEN_FILE (off by default)
+TOKEN_MIRROR = os.environ.get('TOKEN_MIRROR', '0') == '1'
+
+def _record(data, created_at, expires_at):
+    """Build a flat token record"""
+    record = dict(data)
+    record['created_at'] = created_at
+    record['expires_at'] = expires_at
+    return record
+
+class TokenStore(ABC):
+    """
+    Interface of all token backends
+    
+    Subclasses implement put(), get(), consume(), expire(), count() and
+    latest() (a backend missing one can't be instantiated); issue()
+    generates a random token and puts it.
+    """
+    
+    name = None
+    default_ttl = TOKEN_TTL
+    
+    def issue(self, data, ttl=None):
+        """
+        Create a token for a console connection
         
-        logger.info(f"Saved token {token} to file {TOKEN_FILE}")
-        logger.debug(f"File now contains {len(tokens)} tokens")
+        Args:
+            data: Connection details (host, port, ticket, ...)
+            ttl: Seconds until the token expires (default_ttl if not given)
+        Returns:
+            The token to hand to the browser
+        """
+        token = str(uuid.uuid4())
+        self.put(token, data, ttl or self.default_ttl)
+        return token
     
-    return True
-
-def get_token(token):
-    """Get a token from the shared file"""
-    logger.debug(f"Looking up token {token} in file {TOKEN_FILE}")
+    @abstractmethod
+    def put(self, token, data, ttl=TOKEN_TTL):
+        """Save data under a given token"""
+        pass
     
-    if not os.path.exists(TOKEN_FILE):
-        logger.warning(f"Token file {TOKEN_FILE} does not exist")
-        return None
+    @abstractmethod
+    def get(self, token):
+        """Token record without consuming it (None if unknown or expired)"""
+        pass
     
-    with TOKEN_LOCK:
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                tokens = json.load(f)
-                if token in tokens:
-                    logger.debug(f"Found token {token} in file")
-                    return tokens[token]
-                else:
-                    logger.warning(f"Token {token} not found in file")
-                    logger.debug(f"Available tokens: {list(tokens.keys())}")
-        except (json.JSONDecodeError, FileNotFoundError) as e:
-            logger.error(f"Error reading token file: {e}")
-            return None
+    @abstractmethod
+    def consume(self, token):
+        """Token record, invalidating the token so it opens only one connection"""
+        pass
+    
+    @abstractmethod
+    def expire(self):
+        """Remove expired tokens; returns how many were removed"""
+        pass
     
-    return None
+    @abstractmethod
+    def count(self):
+        """Number of live tokens (None if the backend doesn't know)"""
+        pass
+    
+    @abstractmethod
+    def latest(self):
+        """Most recently issued live token record (None if there is none)"""
+        pass
 
-def cleanup_tokens():
-    """Remove expired tokens (older than 5 minutes)"""
-    if not os.path.exists(TOKEN_FILE):
-        return 0
+class MemoryTokenStore(TokenStore):
+    """
+    Tokens kept in this process: a dict plus a min-heap of (expires_at, token)
+    
+    Heap entries are deleted lazily, so re-saving or consuming a token leaves
+    a stale entry behind that is skipped when it reaches the top.
+    """
+    
+    name = 'memory'
+    
+    def __init__(self, mirror_file=None):
+        """
+        Args:
+            mirror_file: File this process's live tokens are mirrored to, for
+                         relays running in another process (None to disable)
+        """
+        self.mirror_file = mirror_file
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._expiry = []
+        self._consumed = {}     # token -> expires_at, so a reloaded mirror can't revive it
+        self._mirror_owner = False
+        self._mirror_mtime = None
     
-    with TOKEN_LOCK:
+    def _expire(self, now):
+        """Drop tokens whose expiry has passed; returns how many were live"""
+        removed = 0
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, token = heapq.heappop(self._expiry)
+            
+            # Skip heap entries for tokens that were re-saved or already consumed
+            record = self._tokens.get(token)
+            if record is not None and record['expires_at'] == expires_at:
+                del self._tokens[token]
+                removed += 1
+            if self._consumed.get(token) == expires_at:
+                del self._consumed[token]
+        return removed
+    
+    def _write_mirror(self):
+        """Replace the mirror file with this process's live tokens"""
+        if not self.mirror_file:
+            return
+        
+        temp_path = f"{self.mirror_file}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self._tokens, f)
+            os.replace(temp_path, self.mirror_file)
+            self._mirror_mtime = os.stat(self.mirror_file).st_mtime_ns
+        except OSError as e:
+            logger.error(f"Error writing token mirror {self.mirror_file}: {e}")
+    
+    def _read_mirror(self, now):
+        """Load tokens issued by another process if the mirror file changed"""
+        if not self.mirror_file:
+            return
+        try:
+            mtime = os.stat(self.mirror_file).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._mirror_mtime:
+            return
+        
         try:
-            with open(TOKEN_FILE, 'r') as f:
+            with open(self.mirror_file, 'r') as f:
                 tokens = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"Error reading token mirror {self.mirror_file}: {e}")
+            return
+        self._mirror_mtime = mtime
+        
+        for token, record in tokens.items():
+            if token in self._tokens or token in self._consumed or not isinstance(record, dict):
+                continue
+            if record.get('expires_at', 0) > now:
+                self._tokens[token] = record
+                heapq.heappush(self._expiry, (record['expires_at'], token))
+    
+    def put(self, token, data, ttl=TOKEN_TTL):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            
+            record = _record(data, now, now + ttl)
+            self._tokens[token] = record
+            self._consumed.pop(token, None)
+            heapq.heappush(self._expiry, (record['expires_at'], token))
+            
+            self._mirror_owner = True
+            self._write_mirror()
+    
+    def get(self, token):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
             
-            current_time = time.time()
-            expired = []
+            if token not in self._tokens and token not in self._consumed:
+                self._read_mirror(now)
+            return self._tokens.get(token)
+    
+    def consume(self, token):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            
+            if token not in self._tokens and token not in self._consumed:
+                self._read_mirror(now)
+            
+            record = self._tokens.pop(token, None)
+            if record is None:
+                return None
             
-            for token, data in tokens.items():
-                if current_time - data.get('created_at', 0) > 300:  # 5 minutes
-                    expired.append(token)
+            self._consumed[token] = record['expires_at']
+            if self._mirror_owner:
+                self._write_mirror()
+            return record
+    
+    def expire(self):
+        with self._lock:
+            removed = self._expire(time.time())
             
-            if expired:
-                for token in expired:
-                    del tokens[token]
-                
-                with open(TOKEN_FILE, 'w') as f:
-                    json.dump(tokens, f)
-                
-                logger.info(f"Cleaned up {len(expired)} expired tokens")
-                return len(expired)
-        except Exception as e:
-            logger.error(f"Error cleaning up tokens: {e}")
-            return 0
-    
-    return 0
\ No newline at end of file
+            # Only the issuing process owns the mirror file
+            if removed and self._mirror_owner:
+                self._write_mirror()
+            return removed
+    
+    def count(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._tokens)
+    
+    def latest(self):
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            self._read_mirror(now)
+            return max(self._tokens.values(), key=lambda r: r['created_at'], default=None)
+
+class SqliteTokenStore(TokenStore):
+    """
+    Tokens kept in a SQLite database shared between processes
+    
+    Every process opens its own connection (re-opened after a fork, as
+    websockify forks per client), and consume() deletes the row inside a
+    write transaction so two relays can never both accept the same token.
+    """
+    
+    name = 'sqlite'
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tokens (
+            token TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tokens_expires ON tokens(expires_at);
+    """
+    
+    def __init__(self, db_file):
+        """
+        Args:
+            db_file: Path of the SQLite database (created if needed)
+        """
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+    
+    def _connection(self):
+        """This process's connection (callers hold self._lock)"""
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file, timeout=30, isolation_level=None, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(self.SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+    
+    @staticmethod
+    def _row_record(row):
+        """Turn a (data, created_at, expires_at) row into a token record"""
+        return _record(json.loads(row[0]), row[1], row[2]) if row else None
+    
+    def put(self, token, data, ttl=TOKEN_TTL):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Expired rows go in the same transaction, through the expiry index
+                conn.execute('DELETE FROM tokens WHERE expires_at <= ?', (now,))
+                conn.execute(
+                    'INSERT OR REPLACE INTO tokens (token, data, created_at, expires_at) VALUES (?, ?, ?, ?)',
+                    (token, json.dumps(data), now, now + ttl)
+                )
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+    
+    def get(self, token):
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT data, created_at, expires_at FROM tokens WHERE token = ? AND expires_at > ?',
+                (token, time.time())
+            ).fetchone()
+        return self._row_record(row)
+    
+    def consume(self, token):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT data, created_at, expires_at FROM tokens WHERE token = ? AND expires_at > ?',
+                    (token, time.time())
+                ).fetchone()
+                if row:
+                    conn.execute('DELETE FROM tokens WHERE token = ?', (token,))
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        return self._row_record(row)
+    
+    def expire(self):
+        with self._lock:
+            return self._connection().execute('DELETE FROM tokens WHERE expires_at <= ?', (time.time(),)).rowcount
+    
+    def count(self):
+        with self._lock:
+            return self._connection().execute(
+                'SELECT COUNT(*) FROM tokens WHERE expires_at > ?', (time.time(),)
+            ).fetchone()[0]
+    
+    def latest(self):
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT data, created_at, expires_at FROM tokens WHERE expires_at > ? '
+                'ORDER BY created_at DESC LIMIT 1',
+                (time.time(),)
+            ).fetchone()
+        return self._row_record(row)
+
+class SignedTokenStore(TokenStore):
+    """
+    Stateless tokens: the record itself, encrypted and signed with a shared key
+    
+    Relays validate tokens with the key alone, so they share no state and
+    scale horizontally. cryptography is only imported when this store is used.
+    """
+    
+    name = 'signed'
+    default_ttl = SIGNED_TOKEN_TTL
+    
+    def __init__(self, secret):
+        """
+        Args:
+            secret: Shared secret; the 32-byte Fernet key is derived from it
+        """
+        try:
+            from cryptography.fernet import Fernet, InvalidToken
+        except ImportError:
+            raise RuntimeError("TOKEN_BACKEND=signed requires the 'cryptography' package")
+        if not secret:
+            raise RuntimeError("TOKEN_BACKEND=signed requires CONSOLE_TOKEN_KEY")
+        
+        key = base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest())
+        self._fernet = Fernet(key)
+        self._invalid_token = InvalidToken
+    
+    def issue(self, data, ttl=None):
+        now = time.time()
+        record = _record(data, now, now + (ttl or self.default_ttl))
+        return self._fernet.encrypt(json.dumps(record, separators=(',', ':')).encode()).decode()
+    
+    def put(self, token, data, ttl=TOKEN_TTL):
+        raise ValueError("Signed tokens carry their data and can only be created by issue()")
+    
+    def get(self, token):
+        try:
+            record = json.loads(self._fernet.decrypt(token.encode()))
+        except (self._invalid_token, ValueError) as e:
+            logger.warning(f"Rejected signed token: {e.__class__.__name__}")
+            return None
+        
+        if record['expires_at'] <= time.time():
+            logger.warning("Rejected signed token: expired")
+            return None
+        return record
+    
+    def consume(self, token):
+        # Nothing to invalidate; reuse is bounded by the short expiry
+        return self.get(token)
+    
+    def expire(self):
+        return 0
+    
+    def count(self):
+        return None
+    
+    def latest(self):
+        return None
+
+def create_token_store(backend=None):
+    """
+    Create a token store
+    
+    Args:
+        backend: 'sqlite', 'memory' or 'signed' (TOKEN_BACKEND if not given)
+    Returns:
+        TokenStore instance
+    """
+    backend = backend or TOKEN_BACKEND
+    if backend == 'sqlite':
+        return SqliteTokenStore(TOKEN_DB)
+    if backend == 'memory':
+        return MemoryTokenStore(TOKEN_FILE if TOKEN_MIRROR else None)
+    if backend == 'signed':
+        return SignedTokenStore(os.environ.get('CONSOLE_TOKEN_KEY'))
+    raise ValueError(f"Unknown token backend: {backend}")
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_token_store():
+    """The token store of this process, created on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_token_store()
+    return _store
+
+def issue_token(data, ttl=None):
+    """Create a token for a console connection and return it"""
+    return get_token_store().issue(data, ttl)
+
+def save_token(token, data, ttl=TOKEN_TTL):
+    """Save a token"""
+    get_token_store().put(token, data, ttl)
+    return True
+
+def get_token(token):
+    """Get a token record without consuming it (None if unknown or expired)"""
+    record = get_token_store().get(token)
+    if record is None:
+        logger.warning(f"Token {token} not found")
+    return record
+
+def consume_token(token):
+    """Get a token record and invalidate it, so it can only open one connection"""
+    record = get_token_store().consume(token)
+    if record is None:
+        logger.warning(f"Token {token} not found or already used")
+    return record
+
+def cleanup_tokens():
+    """Remove expired tokens; returns how many were removed"""
+    removed = get_token_store().expire()
+    if removed:
+        logger.info(f"Cleaned up {removed} expired tokens")
+    return removed
+
+if __name__ == '__main__':
+    # Used by check_network.sh: print host and port of the newest token
+    record = get_token_store().latest()
+    if record:
+        print(record.get('host', ''), record.get('port', ''))
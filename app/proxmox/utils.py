@@ -0,0 +1,90 @@
+import numpy as np
+
+
+def lttb_indices(values, max_points):
+    """
+    Pick the indices of the points to keep when downsampling a series with
+    Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The remaining points are split
+    into max_points - 2 buckets and from each bucket the point forming the
+    largest triangle with the previously selected point and the average of the
+    next bucket is chosen, which preserves visual peaks and dips.
+
+    Args:
+        values: Sequence of numbers (None is treated as 0)
+        max_points: Maximum number of points to keep
+
+    Returns:
+        Sorted numpy array of indices into values
+    """
+    n = len(values)
+    if max_points is None or max_points >= n or n <= 2:
+        return np.arange(n)
+    if max_points < 3:
+        return np.array([0, n - 1])[:max(max_points, 1)]
+
+    y = np.array([0 if v is None else v for v in values], dtype=np.float64)
+    x = np.arange(n, dtype=np.float64)
+
+    # Bucket boundaries for the points between the first and the last one
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+
+    # Average point of every bucket, used as the third triangle vertex
+    counts = np.diff(edges)
+    sums_x = np.add.reduceat(x[:n - 1], edges[:-1])
+    sums_y = np.add.reduceat(y[:n - 1], edges[:-1])
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        bx = x[start:end]
+        by = y[start:end]
+        cx, cy = avg_x[i + 1], avg_y[i + 1]
+
+        # Twice the triangle area for every candidate in the bucket at once
+        areas = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return selected
+
+
+def downsample_series(timestamps, series, max_points):
+    """
+    Downsample several series that share the same timestamps.
+
+    Every series is reduced with LTTB on its own and the union of the chosen
+    indices is kept, so a peak in one series is never dropped because another
+    series was flat at that point. The result can therefore hold up to
+    max_points per series.
+
+    Args:
+        timestamps: List of labels shared by all series
+        series: Dictionary mapping a series name to its list of values
+        max_points: Maximum number of points to keep per series
+
+    Returns:
+        Tuple of (timestamps, series) with the downsampled lists
+    """
+    if not max_points or len(timestamps) <= max_points:
+        return timestamps, series
+
+    if series:
+        keep = np.unique(np.concatenate([
+            lttb_indices(values, max_points) for values in series.values()
+        ]))
+    else:
+        keep = np.unique(np.linspace(0, len(timestamps) - 1, max_points).astype(np.int64))
+    keep = keep.tolist()
+
+    return (
+        [timestamps[i] for i in keep],
+        {name: [values[i] for i in keep] for name, values in series.items()}
+    )
@@ -31,6 +31,11 @@ document.addEventListener('DOMContentLoaded', function() {
     function initContextMenuListeners() {
         // Apply to VM items
         document.querySelectorAll('.vm-item').forEach(vmItem => {
+            // Elements kept across tree refreshes are already bound
+            if (vmItem.dataset.contextBound) {
+                return;
+            }
+            vmItem.dataset.contextBound = 'true';
             vmItem.addEventListener('contextmenu', function(e) {
                 e.preventDefault();
                 e.stopPropagation();
@@ -40,6 +45,10 @@ document.addEventListener('DOMContentLoaded', function() {
         
         // Apply to folder items
         document.querySelectorAll('.folder-item').forEach(folderItem => {
+            if (folderItem.dataset.contextBound) {
+                return;
+            }
+            folderItem.dataset.contextBound = 'true';
             folderItem.addEventListener('contextmenu', function(e) {
                 e.preventDefault();
                 e.stopPropagation();
@@ -183,36 +192,30 @@ document.addEventListener('DOMContentLoaded', function() {
         `;
         treeContainer.appendChild(rootItem);
         
-        // Create a flat list of all folders
-        const allFolders = [];
-        document.querySelectorAll('.folder-item').forEach(folder => {
-            const folderId = folder.getAttribute('data-folder-id');
-            const folderName = folder.querySelector('.folder-name').textContent.trim();
-            
-            // Skip the current folder and its children if we're moving a folder
-            if (itemType === 'folder' && folderId === itemId) {
-                return;
-            }
-            
-            // Find parent id
-            let parentId = 'root';
-            const folderContent = folder.closest('.folder-content');
-            if (folderContent) {
-                parentId = folderContent.getAttribute('data-parent') || 'root';
-            }
-            
-            allFolders.push({
-                id: folderId,
-                name: folderName,
-                parentId: parentId
+        // Create a flat list of all folders (from the server, as the sidebar
+        // only holds the folders loaded so far)
+        fetch('/api/folders')
+            .then(response => response.json())
+            .then(data => {
+                const allFolders = [];
+                Object.values(data.folders || {}).forEach(folder => {
+                    // Skip the current folder and its children if we're moving a folder
+                    if (itemType === 'folder' && folder.id === itemId) {
+                        return;
+                    }
+                    
+                    allFolders.push({
+                        id: folder.id,
+                        name: folder.name,
+                        parentId: folder.parent_id || 'root'
+                    });
+                });
+                allFolders.sort((a, b) => a.name.localeCompare(b.name));
+                
+                // Build folder tree
+                buildFolderTreeFromList(treeContainer, allFolders, 'root', 0);
+                initFolderTreeView();
             });
-        });
-        
-        // Log all folders for debugging
-        console.log('All folders:', allFolders);
-        
-        // Build folder tree
-        buildFolderTreeFromList(treeContainer, allFolders, 'root', 0);
         
         // Set up expand all button
         document.getElementById('expandAllFolders').onclick = function() {
@@ -227,34 +230,37 @@ document.addEventListener('DOMContentLoaded', function() {
             });
         };
         
-        // Make folder tree radio labels clickable
-        document.querySelectorAll('#folderTreeView .form-check-label').forEach(label => {
-            label.addEventListener('click', function() {
-                const radio = document.getElementById(this.getAttribute('for'));
-                if (radio) {
-                    radio.checked = true;
-                }
+        // Bind the tree view once it is built
+        function initFolderTreeView() {
+            // Make folder tree radio labels clickable
+            document.querySelectorAll('#folderTreeView .form-check-label').forEach(label => {
+                label.addEventListener('click', function() {
+                    const radio = document.getElementById(this.getAttribute('for'));
+                    if (radio) {
+                        radio.checked = true;
+                    }
+                });
             });
-        });
-        
-        // Set up folder toggle clicks
-        document.querySelectorAll('.folder-tree-toggle').forEach(toggle => {
-            toggle.onclick = function(e) {
-                e.preventDefault();
-                e.stopPropagation();
-                
-                const children = this.closest('.folder-tree-item').nextElementSibling;
-                if (children && children.classList.contains('folder-tree-children')) {
-                    if (children.style.display === 'none') {
-                        children.style.display = 'block';
-                        this.querySelector('i').className = 'fas fa-caret-down';
-                    } else {
-                        children.style.display = 'none';
-                        this.querySelector('i').className = 'fas fa-caret-right';
+            
+            // Set up folder toggle clicks
+            document.querySelectorAll('.folder-tree-toggle').forEach(toggle => {
+                toggle.onclick = function(e) {
+                    e.preventDefault();
+                    e.stopPropagation();
+                    
+                    const children = this.closest('.folder-tree-item').nextElementSibling;
+                    if (children && children.classList.contains('folder-tree-children')) {
+                        if (children.style.display === 'none') {
+                            children.style.display = 'block';
+                            this.querySelector('i').className = 'fas fa-caret-down';
+                        } else {
+                            children.style.display = 'none';
+                            this.querySelector('i').className = 'fas fa-caret-right';
+                        }
                     }
-                }
-            };
-        });
+                };
+            });
+        }
         
         // Set up the confirm button
         document.getElementById('confirmFolderMove').onclick = function() {
@@ -403,15 +409,20 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Move item to folder
     function moveItemToFolder(itemId, itemType, folderId) {
-        fetch('/api/move-item', {
+        moveItems([{item_id: itemId, item_type: itemType, parent_id: folderId}]);
+    }
+    
+    // Move many items (and rule matches, e.g. {tag: 'web', parent_id: 'folder_1'})
+    // with a single request and a single transaction on the server
+    function moveItems(moves, rules) {
+        return fetch('/api/move-items', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                item_id: itemId,
-                item_type: itemType,
-                parent_id: folderId
+                moves: moves || [],
+                rules: rules || []
             })
         })
         .then(response => response.json())
@@ -420,15 +431,19 @@ document.addEventListener('DOMContentLoaded', function() {
                 // Reload the VM tree
                 loadVMTree();
             } else {
-                alert('Failed to move item: ' + (data.error || 'Unknown error'));
+                alert('Failed to move items: ' + (data.error || 'Unknown error'));
             }
+            return data;
         })
         .catch(error => {
-            console.error('Error moving item:', error);
-            alert('Error moving item: ' + error);
+            console.error('Error moving items:', error);
+            alert('Error moving items: ' + error);
         });
     }
     
+    // Allow batch moves from other scripts (e.g. drag and drop of a selection)
+    window.moveItems = moveItems;
+    
     // Delete folder
     function deleteFolder(folderId) {
         fetch(`/api/folders/${folderId}`, {
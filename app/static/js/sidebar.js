@@ -32,6 +32,11 @@ document.addEventListener('DOMContentLoaded', function() {
 function initFolderToggles() {
     // Make entire folder item clickable to toggle folders
     document.querySelectorAll('.folder-item').forEach(folderItem => {
+        // Elements kept across tree refreshes are already bound
+        if (folderItem.dataset.toggleBound) {
+            return;
+        }
+        folderItem.dataset.toggleBound = 'true';
         folderItem.addEventListener('click', function(e) {
             // If clicking the toggle icon, let the original handler work
             if (e.target.closest('.folder-toggle')) {
@@ -54,6 +59,10 @@ function initFolderToggles() {
 
     // Still keep original toggle functionality
     document.querySelectorAll('.folder-toggle').forEach(toggle => {
+        if (toggle.dataset.bound) {
+            return;
+        }
+        toggle.dataset.bound = 'true';
         toggle.addEventListener('click', function(e) {
             e.preventDefault();
             e.stopPropagation();
@@ -68,6 +77,8 @@ function initFolderToggles() {
                     this.innerHTML = '<i class="fas fa-caret-down"></i>';
                     // Store state in localStorage
                     localStorage.setItem(`folder_${folderId}_open`, 'true');
+                    // Fetch the contents of a lazily loaded folder
+                    ensureVMTreeFolderLoaded(folderId);
                 } else {
                     folderContent.style.display = 'none';
                     this.innerHTML = '<i class="fas fa-caret-right"></i>';
@@ -85,7 +96,8 @@ function initFolderToggles() {
         const toggle = folder.querySelector('.folder-toggle');
         
         if (folderContent && toggle) {
-            const isOpen = localStorage.getItem(`folder_${folderId}_open`) !== 'false';
+            // Folders are loaded on demand and default to closed
+            const isOpen = localStorage.getItem(`folder_${folderId}_open`) === 'true';
             
             if (!isOpen) {
                 folderContent.style.display = 'none';
@@ -93,6 +105,7 @@ function initFolderToggles() {
             } else {
                 folderContent.style.display = 'block';
                 toggle.innerHTML = '<i class="fas fa-caret-down"></i>';
+                ensureVMTreeFolderLoaded(folderId);
             }
         }
     });
@@ -102,6 +115,10 @@ function initFolderToggles() {
 function initVMClickHandlers() {
     // Make the entire VM item clickable
     document.querySelectorAll('.vm-item').forEach(vmItem => {
+        if (vmItem.dataset.clickBound) {
+            return;
+        }
+        vmItem.dataset.clickBound = 'true';
         vmItem.addEventListener('click', function(e) {
             // Don't trigger if clicking the link icon
             if (e.target.closest('.vm-link')) {
@@ -118,32 +135,355 @@ function initVMClickHandlers() {
     });
 }
 
-// Load VM tree via AJAX
+// VM fields requested from /api/vm-tree (name, status, node, type, memory percent)
+const VM_TREE_FIELDS = 'n,s,o,t,m';
+
+// VMs loaded per page when a folder is expanded
+const VM_TREE_PAGE_SIZE = 200;
+
+// What is currently rendered, so a refresh only touches changed elements:
+// folders and vms map IDs to their elements, children maps a folder to the
+// IDs shown in it, loaded maps every loaded folder to its page limit and version
+let vmTreeState = null;
+
+// Create the tree state and an empty root container if needed
+function ensureVMTreeState() {
+    const tree = document.getElementById('vm-folder-tree');
+    if (!vmTreeState || !tree.contains(vmTreeState.root)) {
+        tree.innerHTML = '<div class="" data-parent="root"></div>';
+        vmTreeState = {
+            root: tree.firstElementChild,
+            folders: {},
+            vms: {},
+            children: {},
+            order: {},
+            loaded: {},
+            more: {},
+            full: false,
+            fullVersion: null
+        };
+    }
+    return vmTreeState;
+}
+
+// Load VM tree via AJAX: only the folders loaded so far (initially just the
+// top level), or the whole tree once a search needed it
 function loadVMTree() {
-    fetch('/api/vm-tree')
+    const state = ensureVMTreeState();
+    if (state.full) {
+        return loadFullVMTree();
+    }
+    
+    const folderIds = Object.keys(state.loaded).filter(folderId => folderId !== 'root');
+    return Promise.all(['root'].concat(folderIds).map(folderId => loadVMTreeFolder(folderId)));
+}
+
+// Load the child folders and a page of VMs of one folder
+function loadVMTreeFolder(folderId) {
+    const state = ensureVMTreeState();
+    const loaded = state.loaded[folderId] = state.loaded[folderId] || {limit: VM_TREE_PAGE_SIZE, version: null};
+    const url = `/api/vm-tree?format=json&fields=${VM_TREE_FIELDS}` +
+        `&folder=${encodeURIComponent(folderId)}&limit=${loaded.limit}`;
+    
+    return fetch(url)
         .then(response => response.json())
         .then(data => {
-            if (data.success) {
-                document.getElementById('vm-folder-tree').innerHTML = data.html;
-                // Initialize needed functionality
-                initFolderToggles();
-                initVMClickHandlers();
-                
-                // Initialize context menu if available
-                if (window.initContextMenuAfterLoad) {
-                    window.initContextMenuAfterLoad();
+            if (!data.success) {
+                if (folderId === 'root') {
+                    showVMTreeError(`Failed to load VM tree: ${data.error}`);
+                } else {
+                    // Deleted in the meantime; its parent's refresh removes it
+                    delete state.loaded[folderId];
                 }
-            } else {
-                document.getElementById('vm-folder-tree').innerHTML = 
-                    `<div class="alert alert-danger">Failed to load VM tree: ${data.error}</div>`;
+                return;
+            }
+            
+            // Unchanged folder (e.g. served from a 304 revalidation): keep the DOM as is
+            if (data.version && data.version === loaded.version) {
+                return;
             }
+            loaded.version = data.version || null;
+            
+            patchVMTreeFolder(folderId, data.folders, data.vms, columnIndex(data.k), data.total);
+            afterVMTreeChange();
         })
         .catch(error => {
-            document.getElementById('vm-folder-tree').innerHTML = 
-                `<div class="alert alert-danger">Error loading VM tree: ${error}</div>`;
+            if (folderId === 'root') {
+                showVMTreeError(`Error loading VM tree: ${error}`);
+            } else {
+                console.error(`Error loading folder ${folderId}:`, error);
+            }
         });
 }
 
+// Load every folder and VM at once (needed to search VMs that aren't loaded)
+function loadFullVMTree() {
+    return fetch(`/api/vm-tree?format=json&fields=${VM_TREE_FIELDS}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                showVMTreeError(`Failed to load VM tree: ${data.error}`);
+                return;
+            }
+            
+            const state = ensureVMTreeState();
+            state.full = true;
+            if (data.version && data.version === state.fullVersion) {
+                return;
+            }
+            state.fullVersion = data.version || null;
+            
+            // Split the tree into per-folder listings, parents before children
+            const column = columnIndex(data.k);
+            const folders = {root: []};
+            const vms = {root: []};
+            const rows = {};
+            data.folders.forEach(([folderId, name, parentId]) => {
+                rows[folderId] = [folderId, name, 0, 0];
+                folders[folderId] = [];
+                vms[folderId] = [];
+                (folders[parentId] || folders.root).push(rows[folderId]);
+            });
+            data.vms.forEach(row => {
+                (vms[row[column.f]] || vms.root).push(row);
+            });
+            Object.keys(rows).forEach(folderId => {
+                rows[folderId][2] = folders[folderId].length;
+                rows[folderId][3] = vms[folderId].length;
+            });
+            
+            Object.keys(folders).forEach(folderId => {
+                patchVMTreeFolder(folderId, folders[folderId], vms[folderId], column, vms[folderId].length);
+                state.loaded[folderId] = {limit: Infinity, version: null};
+            });
+            afterVMTreeChange();
+        })
+        .catch(error => showVMTreeError(`Error loading VM tree: ${error}`));
+}
+
+// Load a folder's contents the first time it is expanded
+function ensureVMTreeFolderLoaded(folderId) {
+    if (vmTreeState && vmTreeState.folders[folderId] && !vmTreeState.loaded[folderId]) {
+        loadVMTreeFolder(folderId);
+    }
+}
+
+// Map short keys to their column in the VM rows
+function columnIndex(keys) {
+    const column = {};
+    keys.forEach((key, index) => column[key] = index);
+    return column;
+}
+
+// Replace the tree with an error message
+function showVMTreeError(message) {
+    vmTreeState = null;
+    document.getElementById('vm-folder-tree').innerHTML = 
+        `<div class="alert alert-danger">${message}</div>`;
+}
+
+// Re-initialize handlers and the active search after the tree changed
+function afterVMTreeChange() {
+    // Initialize needed functionality (only binds new elements)
+    initFolderToggles();
+    initVMClickHandlers();
+    
+    // Initialize context menu if available
+    if (window.initContextMenuAfterLoad) {
+        window.initContextMenuAfterLoad();
+    }
+    
+    const search = document.getElementById('searchVMs');
+    if (search && search.value) {
+        searchVMs(search.value);
+    }
+}
+
+// Patch the contents of one folder, touching only elements whose data changed
+function patchVMTreeFolder(folderId, folderRows, vmRows, column, total) {
+    const state = vmTreeState;
+    const content = folderId === 'root' ? state.root : (state.folders[folderId] || {}).content;
+    if (!content) {
+        return;
+    }
+    const elements = [];
+    const ids = new Set();
+    
+    // Child folders: create new ones, update names and counts
+    folderRows.forEach(([childId, name, folderCount, vmCount, ...stats]) => {
+        const folder = state.folders[childId] = state.folders[childId] || createFolderElements(childId);
+        if (folder.name !== name) {
+            folder.item.querySelector('.folder-name').textContent = name;
+            folder.name = name;
+        }
+        const count = stats.length ? stats.join('|') : String(vmCount);
+        if (folder.count !== count) {
+            updateFolderCount(folder.item.querySelector('.folder-count'), vmCount, stats);
+            folder.count = count;
+        }
+        elements.push(folder.item, folder.content);
+        ids.add(childId);
+    });
+    
+    // VMs: create new rows and update the ones whose values changed
+    vmRows.forEach(row => {
+        const vmId = String(row[column.i]);
+        const rowKey = row.join('\u0001');
+        const vm = state.vms[vmId] = state.vms[vmId] || {element: createVMElement(), key: null};
+        if (vm.key !== rowKey) {
+            updateVMElement(vm.element, vmId, row, column);
+            vm.key = rowKey;
+        }
+        elements.push(vm.element);
+        ids.add(vmId);
+    });
+    
+    // Link to the next page when the folder holds more VMs than loaded
+    const remaining = total - vmRows.length;
+    if (remaining > 0) {
+        const more = state.more[folderId] = state.more[folderId] || createMoreElement(folderId);
+        more.setAttribute('data-id', `more:${remaining}`);
+        more.textContent = `Show more (${remaining})`;
+        elements.push(more);
+    } else if (state.more[folderId]) {
+        state.more[folderId].remove();
+        delete state.more[folderId];
+    }
+    
+    // Re-order only when the list of children changed
+    const order = elements.map(element => element.getAttribute('data-id') || element.getAttribute('data-parent')).join('|');
+    if (state.order[folderId] !== order) {
+        elements.forEach(element => content.appendChild(element));
+        state.order[folderId] = order;
+    }
+    
+    // Remove what this folder no longer holds (unless it moved elsewhere already)
+    (state.children[folderId] || new Set()).forEach(id => {
+        if (ids.has(id)) {
+            return;
+        }
+        if (state.folders[id] && state.folders[id].item.parentNode === content) {
+            forgetVMTreeFolder(id);
+        } else if (state.vms[id] && state.vms[id].element.parentNode === content) {
+            state.vms[id].element.remove();
+            delete state.vms[id];
+        }
+    });
+    state.children[folderId] = ids;
+}
+
+// Remove a folder and forget everything rendered inside it
+function forgetVMTreeFolder(folderId) {
+    const state = vmTreeState;
+    const folder = state.folders[folderId];
+    
+    (state.children[folderId] || new Set()).forEach(id => {
+        if (state.folders[id] && folder.content.contains(state.folders[id].item)) {
+            forgetVMTreeFolder(id);
+        } else if (state.vms[id] && folder.content.contains(state.vms[id].element)) {
+            delete state.vms[id];
+        }
+    });
+    
+    folder.item.remove();
+    folder.content.remove();
+    ['folders', 'children', 'order', 'loaded', 'more'].forEach(key => delete state[key][folderId]);
+}
+
+// Create the header and content elements of a folder (content loaded on expand)
+function createFolderElements(folderId) {
+    const item = document.createElement('div');
+    item.className = 'folder-item';
+    item.setAttribute('data-folder-id', folderId);
+    item.setAttribute('data-id', folderId);
+    item.innerHTML = `
+        <span class="folder-toggle"><i class="fas fa-caret-right"></i></span>
+        <i class="fas fa-folder text-warning"></i>
+        <span class="folder-name"></span>
+        <span class="folder-count badge bg-secondary ms-1"></span>
+    `;
+    
+    const content = document.createElement('div');
+    content.className = 'folder-content';
+    content.setAttribute('data-parent', folderId);
+    content.setAttribute('data-lazy', 'true');
+    content.style.display = 'none';
+    
+    return {item: item, content: content, name: null, count: null};
+}
+
+// Show a folder's totals (including subfolders) when the server sent them:
+// [vm_count, running_count, cpus, cpu_used, maxmem_gb, mem_gb]
+function updateFolderCount(badge, vmCount, stats) {
+    if (!stats.length) {
+        badge.textContent = vmCount;
+        badge.title = '';
+        return;
+    }
+    const [total, running, cpus, cpuUsed, maxmem, mem] = stats;
+    badge.textContent = `${running}/${total}`;
+    badge.title = `${total} VMs, ${running} running\n` +
+        `vCPU: ${cpuUsed} of ${cpus} used\n` +
+        `Memory: ${mem} of ${maxmem} GB used`;
+}
+
+// Create the "Show more" entry of a folder
+function createMoreElement(folderId) {
+    const more = document.createElement('div');
+    more.className = 'vm-tree-more text-muted small p-1';
+    more.style.cursor = 'pointer';
+    more.addEventListener('click', function() {
+        vmTreeState.loaded[folderId].limit += VM_TREE_PAGE_SIZE;
+        loadVMTreeFolder(folderId);
+    });
+    return more;
+}
+
+// Create an empty VM row
+function createVMElement() {
+    const element = document.createElement('div');
+    element.className = 'vm-item';
+    element.innerHTML = `
+        <div class="vm-status vm-status-off">
+            <i class="fas fa-circle"></i>
+        </div>
+        <div class="vm-info">
+            <p class="vm-name"></p>
+            <div class="vm-memory-bar">
+                <div class="vm-memory-fill" style="width: 0%;"></div>
+            </div>
+        </div>
+        <a class="vm-link">
+            <i class="fas fa-external-link-alt"></i>
+        </a>
+    `;
+    return element;
+}
+
+// Update a VM row from a compact tree row
+function updateVMElement(element, vmId, row, column) {
+    const value = (key, fallback) => key in column ? row[column[key]] : fallback;
+    const name = value('n', `VM ${vmId}`);
+    const node = value('o', '');
+    const type = value('t', 'qemu');
+    
+    element.setAttribute('data-id', vmId);
+    element.setAttribute('data-name', name);
+    element.setAttribute('data-node', node);
+    element.setAttribute('data-type', type);
+    
+    const status = element.querySelector('.vm-status');
+    status.classList.toggle('vm-status-on', value('s', '') === 'running');
+    status.classList.toggle('vm-status-off', value('s', '') !== 'running');
+    
+    const nameElement = element.querySelector('.vm-name');
+    nameElement.textContent = name;
+    nameElement.title = name;
+    
+    element.querySelector('.vm-memory-fill').style.width = `${value('m', 0)}%`;
+    element.querySelector('.vm-link').href = `/vm/${node}/${vmId}?type=${type}`;
+}
+
 // Load folder options for new folder modal
 function loadFolderOptions() {
     const select = document.getElementById('parentFolder');
@@ -153,15 +493,22 @@ function loadFolderOptions() {
         select.remove(1);
     }
     
-    // Get all folders from the DOM
-    document.querySelectorAll('.folder-item').forEach(folder => {
-        const folderId = folder.getAttribute('data-folder-id');
-        const folderName = folder.querySelector('.folder-name').textContent.trim();
-        const option = document.createElement('option');
-        option.value = folderId;
-        option.text = folderName;
-        select.appendChild(option);
-    });
+    // Get all folders from the server (the sidebar only holds the loaded ones)
+    fetch('/api/folders')
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                return;
+            }
+            Object.values(data.folders)
+                .sort((a, b) => a.name.localeCompare(b.name))
+                .forEach(folder => {
+                    const option = document.createElement('option');
+                    option.value = folder.id;
+                    option.text = folder.name;
+                    select.appendChild(option);
+                });
+        });
 }
 
 // Create new folder
@@ -208,6 +555,13 @@ function createNewFolder() {
 function searchVMs(query) {
     query = query.toLowerCase();
     
+    // Searching needs every VM, not just the ones in expanded folders
+    if (query && vmTreeState && !vmTreeState.full &&
+        document.getElementById('vm-folder-tree').contains(vmTreeState.root)) {
+        vmTreeState.full = true;
+        loadFullVMTree();
+    }
+    
     // Show/hide VMs based on search
     document.querySelectorAll('.vm-item').forEach(vm => {
         const vmName = vm.querySelector('.vm-name').textContent.toLowerCase();
@@ -236,7 +590,8 @@ function searchVMs(query) {
             const toggle = folder.querySelector('.folder-toggle');
             
             if (folderContent && toggle) {
-                const isOpen = localStorage.getItem(`folder_${folderId}_open`) !== 'false';
+                // Same default as initFolderToggles: closed unless opened before
+                const isOpen = localStorage.getItem(`folder_${folderId}_open`) === 'true';
                 
                 if (!isOpen) {
                     folderContent.style.display = 'none';
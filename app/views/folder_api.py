@@ -1,11 +1,38 @@
-from flask import Blueprint, jsonify, request, session, render_template_string
-from app.models.folder import FolderManager
-from app.proxmox.api import get_user_vms
+import os
+import re
+import json
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows: every process may reconcile
+    fcntl = None
+from flask import Blueprint, jsonify, request, session
+from app.models.folder import get_folder_manager, write_json_atomic
+from app.proxmox.api import get_user_vms, get_all_vms, get_cluster_resources, data_version
+from app.views.utils import conditional_json
 
 bp = Blueprint('folder_api', __name__, url_prefix='/api')
 
-# Initialize folder manager
-folder_manager = FolderManager(data_dir='app/data')
+# Shared folder manager (same instance as the main views)
+folder_manager = get_folder_manager(data_dir='app/data')
+
+# VMs per page when the sidebar loads a folder on demand
+VM_TREE_PAGE_SIZE = 200
+VM_TREE_MAX_PAGE_SIZE = 1000
+
+# Background reconciliation of VM locations against the cluster inventory
+# (set in .env like FOLDER_BACKEND; app.config entries of the same name win)
+FOLDER_RECONCILE_INTERVAL = int(os.environ.get('FOLDER_RECONCILE_INTERVAL', 300))
+FOLDER_RECONCILE_MODE = os.environ.get('FOLDER_RECONCILE_MODE', 'quarantine')
+FOLDER_RECONCILE_GRACE = int(os.environ.get('FOLDER_RECONCILE_GRACE', 2))
+
+# Only the process holding this lock reconciles; its report is shared through the file
+RECONCILE_LOCK_FILE = os.path.join(folder_manager.data_dir, 'folder_reconciler.lock')
+RECONCILE_REPORT_FILE = os.path.join(folder_manager.data_dir, 'folder_drift.json')
+
+_reconciler_thread = None
+_reconciler_lock = None
 
 @bp.route('/folders', methods=['GET'])
 def get_folders():
@@ -17,7 +44,7 @@ def get_folders():
         folders = folder_manager.get_folders()
         return jsonify({
             'success': True,
-            'folders': folders
+            'folders': {folder_id: dict(folder) for folder_id, folder in folders.items()}
         })
     except Exception as e:
         return jsonify({
@@ -65,7 +92,7 @@ def update_folder(folder_id):
         folder = folder_manager.update_folder(folder_id, data)
         return jsonify({
             'success': True,
-            'folder': folder
+            'folder': dict(folder)
         })
     except Exception as e:
         return jsonify({
@@ -111,26 +138,9 @@ def move_item():
     
     try:
         if item_type == 'folder':
-            # Don't allow moving a folder to itself or a child
-            if item_id == parent_id:
-                return jsonify({
-                    'success': False,
-                    'error': 'Cannot move a folder to itself'
-                }), 400
-            
-            # Check for circular reference
-            if parent_id != 'root':
-                current = folder_manager.get_folder(parent_id)
-                while current and current.get('parent_id') != 'root':
-                    if current.get('parent_id') == item_id:
-                        return jsonify({
-                            'success': False,
-                            'error': 'Circular reference detected'
-                        }), 400
-                    current = folder_manager.get_folder(current.get('parent_id'))
-            
-            # Update folder
-            folder_manager.update_folder(item_id, {'parent_id': parent_id})
+            # Validated against the in-memory folder index inside the store's
+            # lock: a folder can't be moved to itself or one of its children
+            folder_manager.move_folder(item_id, parent_id)
             print(f"Successfully moved folder {item_id} to {parent_id}")
         elif item_type == 'vm':
             # Move VM to new folder
@@ -145,6 +155,11 @@ def move_item():
         return jsonify({
             'success': True
         })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
     except Exception as e:
         import traceback
         print(f"Error moving item: {str(e)}")
@@ -154,9 +169,117 @@ def move_item():
             'error': str(e)
         }), 500
 
+# VM fields a move rule can match on (cluster/resources field names)
+MOVE_RULE_FIELDS = ('tag', 'pool', 'node', 'type', 'status')
+
+def split_tags(tags):
+    """Split a Proxmox tag string (separated by ';', ',' or spaces) into a set"""
+    return {tag.lower() for tag in re.split(r'[;,\s]+', tags or '') if tag}
+
+def vm_matches_rule(vm, rule):
+    """Check whether a VM matches every criterion of a move rule"""
+    for field in MOVE_RULE_FIELDS:
+        if field not in rule:
+            continue
+        if field == 'tag':
+            if str(rule['tag']).lower() not in split_tags(vm.get('tags')):
+                return False
+        elif str(vm.get(field, '')) != str(rule[field]):
+            return False
+    return True
+
+@bp.route('/move-items', methods=['POST'])
+def move_items():
+    """
+    Move many VMs and folders at once
+    
+    Request body:
+        moves: List of {item_id, item_type, parent_id}
+        rules: List of {parent_id, tag/pool/node/type/status}; every VM of the
+               user matching all given fields is moved to parent_id. Rules are
+               applied first, so explicit moves take precedence.
+    
+    Everything is validated first and committed in a single transaction;
+    if anything is invalid nothing is moved.
+    """
+    if 'user' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    data = request.json or {}
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': 'Request body must be a JSON object'}), 400
+    
+    rules = data.get('rules') or []
+    requested = data.get('moves') or []
+    for name, entries in (('rules', rules), ('moves', requested)):
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            return jsonify({'success': False, 'error': f"'{name}' must be a list of objects"}), 400
+    
+    moves = []
+    matched = 0
+    
+    try:
+        if rules:
+            user = session['user']
+            vms = get_user_vms(user['username'], user['groups'])
+            
+            for rule in rules:
+                if not any(field in rule for field in MOVE_RULE_FIELDS):
+                    return jsonify({
+                        'success': False,
+                        'error': f"A rule needs at least one of: {', '.join(MOVE_RULE_FIELDS)}"
+                    }), 400
+                
+                parent_id = rule.get('parent_id', 'root')
+                for vm in vms:
+                    if vm.get('type') in ('qemu', 'lxc') and vm_matches_rule(vm, rule):
+                        moves.append(('vm', str(vm.get('vmid')), parent_id))
+                        matched += 1
+        
+        for move in requested:
+            if not move.get('item_id') or not move.get('item_type'):
+                return jsonify({
+                    'success': False,
+                    'error': 'Item ID and type are required'
+                }), 400
+            moves.append((move['item_type'], move['item_id'], move.get('parent_id', 'root')))
+        
+        moved = folder_manager.move_items(moves)
+        print(f"API: Moved {moved} items ({len(moves)} requested, {matched} from rules)")
+        
+        return jsonify({
+            'success': True,
+            'moved': moved,
+            'matched': matched
+        })
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    except Exception as e:
+        import traceback
+        print(f"Error moving items: {str(e)}")
+        print(traceback.format_exc())
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 @bp.route('/vm-tree', methods=['GET'])
 def get_vm_tree():
-    """Get VM folder tree as HTML"""
+    """
+    Get VM folder tree as compact JSON (see FolderManager.build_folder_tree);
+    the sidebar renders it in the browser
+    
+    Query parameters:
+        fields: Comma-separated short keys of the VM fields to include,
+                e.g. 'n,s,m' (default: all)
+        folder: List just this folder's child folders (with counts) and VMs
+                (see FolderManager.build_folder_page)
+        offset, limit: Page of the folder's VMs to include (default 0 and
+                       VM_TREE_PAGE_SIZE)
+    """
     if 'user' not in session:
         return jsonify({'error': 'Not authenticated'}), 401
     
@@ -164,20 +287,145 @@ def get_vm_tree():
         user = session['user']
         vms = get_user_vms(user['username'], user['groups'])
         
-        # Get folder structure
+        # Keep the per-VM stats behind the folder totals current (same
+        # cluster/resources fetch, memoized per request). The totals shown are
+        # only ever summed over `vms`, the VMs this user may see. An empty
+        # result is more likely a failed call than an empty cluster
+        all_vms = get_all_vms()
+        if all_vms:
+            folder_manager.update_vm_stats(all_vms)
+        
+        # Get folder structure (version first, so a concurrent change can only
+        # make the data newer than its version, never older)
+        tree_version = folder_manager.version
         folder_structure = folder_manager.get_folder_structure()
         
-        # Build HTML
-        html = folder_manager.build_folder_html(folder_structure, folder_structure[1], vms)
+        fields = [field for field in request.args.get('fields', '').split(',') if field]
         
-        return jsonify({
-            'success': True,
-            'html': html
-        })
+        # One folder's direct contents, for loading the sidebar on demand
+        folder_id = request.args.get('folder')
+        if folder_id:
+            offset = max(request.args.get('offset', 0, type=int), 0)
+            limit = min(max(request.args.get('limit', VM_TREE_PAGE_SIZE, type=int), 1), VM_TREE_MAX_PAGE_SIZE)
+            try:
+                page = folder_manager.build_folder_page(
+                    folder_structure, folder_structure[1], vms, folder_id, offset, limit, fields
+                )
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 404
+            
+            version = data_version(tree_version, page)
+            
+            def build_page():
+                return {'success': True, 'folder': folder_id, 'limit': limit, **page}
+            
+            key = f"vm-tree:{user['username']}:json:{','.join(page['k'])}:{folder_id}:{offset}:{limit}"
+            return conditional_json(key, version, build_page)
+        
+        tree = folder_manager.build_folder_tree(folder_structure, folder_structure[1], vms, fields)
+        
+        # The compact rows are cheap to build and hold exactly what is shown
+        version = data_version(tree_version, tree)
+        
+        def build_json_tree():
+            return {'success': True, **tree}
+        
+        key = f"vm-tree:{user['username']}:json:{','.join(tree['k'])}"
+        return conditional_json(key, version, build_json_tree)
     except Exception as e:
         import traceback
         return jsonify({
             'success': False,
             'error': str(e),
             'traceback': traceback.format_exc()
-        }), 500
\ No newline at end of file
+        }), 500
+
+@bp.route('/folders/drift', methods=['GET'])
+def get_folder_drift():
+    """Report from the last reconciliation of VM locations against the cluster"""
+    if 'user' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    # The last run may have happened in another worker process
+    drift = folder_manager.last_reconcile
+    if drift is None:
+        try:
+            with open(RECONCILE_REPORT_FILE, 'r') as f:
+                drift = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            drift = None
+    return jsonify({'drift': drift})
+
+def reconcile_vm_locations(app):
+    """
+    Compare VM locations with the VMs that currently exist and drop stale ones
+    
+    Only cluster/resources is trusted here: the node-by-node fallback can't
+    tell a VM on an unreachable node from a deleted one.
+    """
+    with app.app_context():
+        resources = get_cluster_resources()
+        if not resources:
+            print("Skipping folder reconciliation: cluster/resources unavailable")
+            return None
+        
+        live_vmids = {r['vmid'] for r in resources if r.get('type') in ('qemu', 'lxc') and 'vmid' in r}
+        if not live_vmids:
+            # An empty inventory is far more likely an API problem than reality
+            return None
+        
+        folder_manager.update_vm_stats(get_all_vms())
+        report = folder_manager.reconcile(
+            live_vmids,
+            mode=app.config.get('FOLDER_RECONCILE_MODE', FOLDER_RECONCILE_MODE),
+            grace=int(app.config.get('FOLDER_RECONCILE_GRACE', FOLDER_RECONCILE_GRACE))
+        )
+        write_json_atomic(RECONCILE_REPORT_FILE, report)
+        if report['stale'] or report['restored']:
+            print(f"Folder drift: {report['stale']} stale mappings, "
+                  f"{len(report['dropped'])} {report['mode']}d, {len(report['restored'])} restored")
+        return report
+
+def holds_reconciler_lock():
+    """
+    Whether this process is the one that reconciles
+    
+    With several workers (e.g. gunicorn) every one starts the thread, but
+    only the holder of an exclusive lock on RECONCILE_LOCK_FILE reconciles.
+    The lock is kept until the process exits; the other workers keep trying,
+    so one of them takes over if it dies.
+    """
+    global _reconciler_lock
+    if fcntl is None or _reconciler_lock is not None:
+        return True
+    
+    lock = open(RECONCILE_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _reconciler_lock = lock
+    return True
+
+def start_folder_reconciler(app):
+    """Start the background thread that keeps VM locations in step with the cluster"""
+    global _reconciler_thread
+    
+    interval = int(app.config.get('FOLDER_RECONCILE_INTERVAL', FOLDER_RECONCILE_INTERVAL))
+    if not interval or _reconciler_thread is not None:
+        return None
+    
+    def reconcile_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                if holds_reconciler_lock():
+                    reconcile_vm_locations(app)
+            except Exception as e:
+                print(f"Error reconciling folder mappings: {str(e)}")
+    
+    _reconciler_thread = threading.Thread(target=reconcile_loop, name='folder-reconciler')
+    _reconciler_thread.daemon = True
+    _reconciler_thread.start()
+    return _reconciler_thread
@@ -4,9 +4,11 @@ from app.proxmox.api import (
     get_user_vms, get_vm_status, start_vm, stop_vm, 
     create_snapshot, get_snapshots, get_cluster_info,
     get_node_status, get_storage_status, get_cluster_resources,
-    reboot_vm, get_api
+    reboot_vm, get_api, data_version, set_request_deadline
 )
-from app.models.folder import FolderManager
+from app.proxmox.utils import downsample_series
+from app.views.utils import conditional_json, fragment_cache, FragmentTimeout
+from app.models.dashboard import dashboard_aggregator
 import datetime
 import time
 import os
@@ -17,9 +19,6 @@ import logging
 logger = logging.getLogger("websocket-server")
 bp = Blueprint('main', __name__)
 
-# Initialize folder manager
-folder_manager = FolderManager(data_dir='app/data')
-
 # Store historical data for charts with multiple time resolutions
 # Using a hierarchical time-based storage approach
 HISTORY_FILE = 'app/data/performance_history.json'
@@ -32,6 +31,9 @@ MONTH_BUCKET = 12 * 3600  # 12 hours in seconds
 YEAR_BUCKET = 24 * 3600  # 1 day in seconds
 FIVE_YEAR_BUCKET = 7 * 24 * 3600  # 1 week in seconds
 
+# Smallest max_points accepted by /api/cluster-stats (LTTB keeps first and last point)
+MIN_CHART_POINTS = 3
+
 # Initialize history storage structure
 history = {
     'hour': {
@@ -161,13 +163,9 @@ def update_history_data():
         
         if node_status:
             # Calculate cluster CPU and memory usage
-            cluster_cpu_total = sum(node.get('maxcpu', 0) for node in node_status if node.get('online'))
-            cluster_cpu_used = sum(node.get('cpu', 0) * node.get('maxcpu', 0) for node in node_status if node.get('online'))
-            cluster_cpu_percent = round((cluster_cpu_used / cluster_cpu_total * 100) if cluster_cpu_total > 0 else 0, 1)
-            
-            cluster_mem_total = sum(node.get('maxmem', 0) for node in node_status if node.get('online'))
-            cluster_mem_used = sum(node.get('mem', 0) for node in node_status if node.get('online'))
-            cluster_mem_percent = round((cluster_mem_used / cluster_mem_total * 100) if cluster_mem_total > 0 else 0, 1)
+            summary = dashboard_aggregator.summarize([], node_status)
+            cluster_cpu_percent = summary['cluster_cpu_percent']
+            cluster_mem_percent = summary['cluster_mem_percent']
             
             # Current time as datetime for formatting
             now = datetime.datetime.now()
@@ -202,6 +200,55 @@ def index():
         return redirect(url_for('auth.login'))
     return redirect(url_for('main.dashboard'))
 
+# Dashboard fragments, each loaded by the browser on its own.
+# 'source' names the cached data a fragment is rendered from, so fragments sharing
+# the same Proxmox calls share one fetch; ttl, timeout and budget are in seconds.
+DASHBOARD_FRAGMENTS = {
+    'summary': {'template': 'fragments/dashboard_summary.html', 'source': 'cluster'},
+    'nodes': {'template': 'fragments/dashboard_nodes.html', 'source': 'cluster'},
+    'storage': {'template': 'fragments/dashboard_storage.html', 'source': 'storage'},
+}
+
+# 'budget' bounds the total time of the Proxmox calls made by one background load.
+FRAGMENT_SOURCES = {
+    'cluster': {'ttl': 15, 'timeout': 5, 'budget': 20, 'per_user': True},
+    'storage': {'ttl': 60, 'timeout': 5, 'budget': 20, 'per_user': False},
+}
+
+def load_cluster_fragment_data(user):
+    """Load VM counts, cluster totals and node status for the dashboard"""
+    vms = get_user_vms(user['username'], user['groups'])
+    cluster_info = get_cluster_info()
+    node_status = get_node_status()
+    
+    summary = dashboard_aggregator.summarize(vms, node_status)
+    
+    return {
+        'cluster_info': cluster_info,
+        'node_status': summary['nodes'],
+        'vm_count': summary['vm_count'],
+        'running_vm_count': summary['running_vm_count'],
+        'cluster_cpu_total': summary['cluster_cpu_total'],
+        'cluster_cpu_used': summary['cluster_cpu_used'],
+        'cluster_cpu_percent': summary['cluster_cpu_percent'],
+        'cluster_mem_total': summary['cluster_mem_total'],
+        'cluster_mem_used': summary['cluster_mem_used'],
+        'cluster_mem_percent': summary['cluster_mem_percent']
+    }
+
+def load_storage_fragment_data(user):
+    """Load storage status for the dashboard"""
+    storage_status = get_storage_status()
+    summary = dashboard_aggregator.summarize([], [], storage_status)
+    return {
+        'storage_status': summary['storage']
+    }
+
+FRAGMENT_LOADERS = {
+    'cluster': load_cluster_fragment_data,
+    'storage': load_storage_fragment_data,
+}
+
 @bp.route('/dashboard')
 def dashboard():
     if 'user' not in session:
@@ -214,116 +261,56 @@ def dashboard():
     if time_period not in ['hour', 'day', 'week', 'month']:
         time_period = 'hour'
     
+    # Render only the page shell; the browser loads the sidebar tree
+    # (/api/vm-tree), charts (/api/cluster-stats) and the remaining sections
+    # (/dashboard/fragment/<name>) in parallel
+    return render_template(
+        'dashboard.html', 
+        user=user, 
+        current_time_period=time_period
+    )
+
+@bp.route('/dashboard/fragment/<name>')
+def dashboard_fragment(name):
+    """Render one independently loaded section of the dashboard"""
+    if 'user' not in session:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    fragment = DASHBOARD_FRAGMENTS.get(name)
+    if fragment is None:
+        return jsonify({'error': f'Unknown fragment {name}'}), 404
+    
+    user = session['user']
+    source = fragment['source']
+    options = FRAGMENT_SOURCES[source]
+    cache_key = f"{source}:{user['username']}" if options['per_user'] else source
+    
+    def load():
+        # Loads run outside this request, so they get their own deadline
+        set_request_deadline(options['budget'])
+        return FRAGMENT_LOADERS[source](user)
+    
     try:
-        # Get all the cluster information we need
-        update_history_data()
-        
-        # Get user VMs
-        vms = get_user_vms(user['username'], user['groups'])
-        running_vms = [vm for vm in vms if vm.get('status') == 'running']
-        
-        # Get cluster info
-        cluster_info = get_cluster_info()
-        
-        # Get node status
-        node_status = get_node_status()
-        
-        # Get storage status
-        storage_status = get_storage_status()
-        
-        # Get resource usage
-        resources = get_cluster_resources()
-        
-        # Calculate cluster totals
-        cluster_cpu_total = sum(node.get('maxcpu', 0) for node in node_status if node.get('online'))
-        cluster_cpu_used = sum(node.get('cpu', 0) * node.get('maxcpu', 0) for node in node_status if node.get('online'))
-        cluster_cpu_percent = round((cluster_cpu_used / cluster_cpu_total * 100) if cluster_cpu_total > 0 else 0, 1)
-        
-        cluster_mem_total = round(sum(node.get('maxmem', 0) / (1024**3) for node in node_status if node.get('online')), 1)
-        cluster_mem_used = round(sum(node.get('mem', 0) / (1024**3) for node in node_status if node.get('online')), 1)
-        cluster_mem_percent = round((cluster_mem_used / cluster_mem_total * 100) if cluster_mem_total > 0 else 0, 1)
-        
-        # Format node information for display
-        for node in node_status:
-            # Format uptime
-            uptime_seconds = node.get('uptime', 0)
-            if uptime_seconds > 0:
-                days, remainder = divmod(uptime_seconds, 86400)
-                hours, remainder = divmod(remainder, 3600)
-                minutes, seconds = divmod(remainder, 60)
-                
-                if days > 0:
-                    node['uptime_formatted'] = f"{int(days)}d {int(hours)}h {int(minutes)}m"
-                elif hours > 0:
-                    node['uptime_formatted'] = f"{int(hours)}h {int(minutes)}m"
-                else:
-                    node['uptime_formatted'] = f"{int(minutes)}m {int(seconds)}s"
-            else:
-                node['uptime_formatted'] = "N/A"
-            
-            # Calculate CPU and memory percentages
-            node['cpu_percent'] = round(node.get('cpu', 0) * 100, 1)
-            
-            mem_total = node.get('maxmem', 0) / (1024**3)
-            mem_used = node.get('mem', 0) / (1024**3)
-            node['mem_total'] = round(mem_total, 1)
-            node['mem_used'] = round(mem_used, 1)
-            node['mem_percent'] = round((mem_used / mem_total * 100) if mem_total > 0 else 0, 1)
-            
-            # Count VMs on this node
-            node['vm_count'] = len([vm for vm in vms if vm.get('node') == node.get('node')])
-        
-        # Format storage information
-        for storage in storage_status:
-            storage['total'] = round(storage.get('total', 0) / (1024**3), 1)
-            storage['used'] = round(storage.get('used', 0) / (1024**3), 1)
-            storage['avail'] = round(storage.get('avail', 0) / (1024**3), 1)
-            storage['usage_percent'] = round((storage.get('used', 0) / storage.get('total', 0) * 100) if storage.get('total', 0) > 0 else 0, 1)
-        
-        # Get VM folder tree
-        folder_structure = folder_manager.get_folder_structure()
-        vm_folder_tree = folder_manager.build_folder_html(folder_structure, folder_structure[1], vms)
-        
-        # Get performance data for the selected time period
-        cpu_history = history[time_period]['cpu']
-        memory_history = history[time_period]['memory']
-        timestamps = history[time_period]['timestamps']
-        
-        return render_template(
-            'dashboard.html', 
-            user=user, 
-            vms=vms, 
-            cluster_info=cluster_info,
-            node_status=node_status,
-            storage_status=storage_status,
-            vm_folder_tree=vm_folder_tree,
-            
-            # Cluster resource summaries
-            cluster_cpu_total=cluster_cpu_total,
-            cluster_cpu_used=round(cluster_cpu_used, 1),
-            cluster_cpu_percent=cluster_cpu_percent,
-            
-            cluster_mem_total=cluster_mem_total,
-            cluster_mem_used=cluster_mem_used,
-            cluster_mem_percent=cluster_mem_percent,
-            
-            # Historical data for charts
-            cpu_history=cpu_history,
-            memory_history=memory_history,
-            history_timestamps=timestamps,
-            current_time_period=time_period
+        data = fragment_cache.get(
+            cache_key,
+            load,
+            ttl=options['ttl'],
+            timeout=options['timeout']
         )
+        return render_template(fragment['template'], **data)
+    except FragmentTimeout:
+        # Still loading in the background; the browser retries shortly
+        return render_template_string(
+            '<div class="alert alert-warning">Still loading {{ name }}...</div>', name=name
+        ), 503, {'Retry-After': '2'}
     except Exception as e:
         import traceback
-        # Handle errors gracefully
-        flash(f"Error connecting to Proxmox API: {str(e)}", "error")
         print(traceback.format_exc())
-        return render_template(
-            'dashboard.html', 
-            user=user, 
-            vms=[], 
-            api_error=True
-        )
+        return render_template_string(
+            '<div class="alert alert-danger"><strong>Connection Error:</strong> '
+            'Unable to load {{ name }} from the Proxmox API: {{ error }}</div>',
+            name=name, error=str(e)
+        ), 500
 
 # Add an API endpoint for updating dashboard data
 @bp.route('/api/cluster-stats', methods=['GET'])
@@ -337,35 +324,69 @@ def get_cluster_stats():
     if time_period not in ['hour', 'day', 'week', 'month', 'year', 'fiveyear']:
         time_period = 'hour'
     
+    # Optional limit on the number of points per series (downsampled with LTTB)
+    max_points = request.args.get('max_points', type=int)
+    if max_points is not None:
+        max_points = max(max_points, MIN_CHART_POINTS)
+    
     try:
         update_history_data()
         
+        # Resource key for ETag/delta handling: everything in the query except 'since'
+        user = session['user']
+        cache_key = f"cluster-stats:{user['username']}:{chart_type}:{time_period}:{max_points}"
+        history_version = data_version(
+            history[time_period]['cpu'],
+            history[time_period]['memory'],
+            history[time_period]['timestamps']
+        )
+        
+        def build_history(series_names):
+            """Copy (and downsample) the requested history series"""
+            timestamps, series = downsample_series(
+                list(history[time_period]['timestamps']),
+                {name: list(history[time_period][name]) for name in series_names},
+                max_points
+            )
+            return timestamps, series
+        
         # If a specific chart type is requested, return only data for that chart
         if chart_type in ['cpu', 'memory']:
-            return jsonify({
-                'success': True,
-                'cpu_history': history[time_period]['cpu'] if chart_type == 'cpu' else [],
-                'memory_history': history[time_period]['memory'] if chart_type == 'memory' else [],
-                'history_timestamps': history[time_period]['timestamps'],
-                'time_period': time_period
-            })
+            def build_chart():
+                timestamps, series = build_history([chart_type])
+                return {
+                    'success': True,
+                    'cpu_history': series['cpu'] if chart_type == 'cpu' else [],
+                    'memory_history': series['memory'] if chart_type == 'memory' else [],
+                    'history_timestamps': timestamps,
+                    'time_period': time_period
+                }
+            
+            return conditional_json(cache_key, history_version, build_chart)
         
         # Otherwise return all stats for the dashboard
-        user = session['user']
         vms = get_user_vms(user['username'], user['groups'])
         node_status = get_node_status()
+        summary_version = data_version(vms, node_status)
         
-        return jsonify({
-            'success': True,
-            'vm_count': len(vms),
-            'running_vm_count': len([vm for vm in vms if vm.get('status') == 'running']),
-            'node_count': len(node_status),
-            'online_node_count': len([node for node in node_status if node.get('online')]),
-            'cpu_history': history[time_period]['cpu'],
-            'memory_history': history[time_period]['memory'],
-            'history_timestamps': history[time_period]['timestamps'],
-            'time_period': time_period
-        })
+        def build_stats():
+            summary = dashboard_aggregator.summarize(vms, node_status)
+            timestamps, series = build_history(['cpu', 'memory'])
+            return {
+                'success': True,
+                'vm_count': summary['vm_count'],
+                'running_vm_count': summary['running_vm_count'],
+                'node_count': summary['node_count'],
+                'online_node_count': summary['online_node_count'],
+                'cpu_history': series['cpu'],
+                'memory_history': series['memory'],
+                'history_timestamps': timestamps,
+                'time_period': time_period
+            }
+        
+        return conditional_json(
+            cache_key, data_version(summary_version, history_version), build_stats
+        )
     except Exception as e:
         import traceback
         print(f"Error in API: {str(e)}")
@@ -384,12 +405,8 @@ def vm_details(node, vmid):
     user = session['user']
     
     try:
-        # Get VMs for sidebar
-        vms = get_user_vms(user['username'], user['groups'])
-        
-        # Get VM folder tree
-        folder_structure = folder_manager.get_folder_structure()
-        vm_folder_tree = folder_manager.build_folder_html(folder_structure, folder_structure[1], vms)
+        # The sidebar loads the expanded folders itself (see /api/vm-tree?folder=),
+        # so the page size doesn't grow with the number of VMs
         
         # Get VM status and details
         vm_status = get_vm_status(node, vmid, vmtype)
@@ -402,8 +419,7 @@ def vm_details(node, vmid):
             snapshots=snapshots,
             node=node,
             vmid=vmid,
-            vmtype=vmtype,
-            vm_folder_tree=vm_folder_tree
+            vmtype=vmtype
         )
     except Exception as e:
         flash(f"Error retrieving VM details: {str(e)}", "error")
@@ -522,8 +538,7 @@ def vm_vncproxy(node, vmid):
     
     try:
         # Import token storage - use the consolidated token store
-        from app.proxmox.token_store import save_token
-        from app.proxmox.websocket import generate_token
+        from app.proxmox.token_store import issue_token
         
         # Get Proxmox API instance
         api = get_api()
@@ -546,12 +561,6 @@ def vm_vncproxy(node, vmid):
         logger.info(f"VNC info received: {vnc_info}")
         
         if vnc_info:
-            # Generate a token for the WebSocket connection
-            token = generate_token()
-            
-            logger.info(f"FLASK: Token {token} created at {time.time()}")
-            logger.info(f"Current working directory: {os.getcwd()}")
-
             # Structure the token data correctly - avoid nested 'data' fields
             token_data = {
                 'ticket': vnc_info['ticket'],
@@ -565,41 +574,10 @@ def vm_vncproxy(node, vmid):
             
             logger.info(f"Proxmox VNC info: host={api.host}, port={vnc_info.get('port', 0)}")
             
-            # Save token to shared file
-            save_token(token, token_data)
+            # Stored tokens go to the shared token store, signed ones carry token_data
+            token = issue_token(token_data)
+            logger.info(f"FLASK: Issued console token for {node}/{vmid}")
             
-            # Clean up old tokens
-            try:
-                token_file = os.path.abspath('websocket_tokens.json')
-                if os.path.exists(token_file):
-                    with open(token_file, 'r') as f:
-                        current_tokens = json.load(f)
-                        
-                        # Remove any old tokens (older than 5 minutes)
-                        current_time = time.time()
-                        for token_id in list(current_tokens.keys()):
-                            if token_id == token:  # Skip the token we just created
-                                continue
-                            token_info = current_tokens[token_id]
-                            if 'created_at' in token_info and current_time - token_info['created_at'] > 300:
-                                logger.info(f"Removing old token: {token_id}")
-                                del current_tokens[token_id]
-                        
-                        # Write back
-                        with open(token_file, 'w') as f:
-                            json.dump(current_tokens, f, indent=2)
-            except Exception as e:
-                logger.info(f"Error cleaning up tokens: {e}")
-            
-            logger.info(f"FLASK: Token file path: {os.path.abspath('websocket_tokens.json')}")
-            logger.info(f"FLASK: Saved token {token} to file")
-            # If possible, dump the contents of the file
-            try:
-                with open(os.path.abspath('websocket_tokens.json'), 'r') as f:
-                    logger.info(f"FLASK: File contents: {f.read()}")
-            except Exception as e:
-                logger.info(f"FLASK: Error reading file: {str(e)}")
-
             # Return the token to the client
             return jsonify({
                 'success': True,
@@ -628,15 +606,10 @@ def vm_vncproxy(node, vmid):
 @bp.route('/api/debug/websocket-test')
 def websocket_test():
     """Create a test token for WebSocket debugging"""
-    from app.proxmox.websocket import generate_token
-    from app.proxmox.token_store import save_token, get_token
-    import os
-    
-    token = generate_token()
-    print(f"DEBUG: Generated token {token} for WebSocket test")
+    from app.proxmox.token_store import issue_token, get_token, TOKEN_BACKEND
     
     # Save the token
-    save_token(token, {
+    token = issue_token({
         'ticket': 'test-ticket',
         'node': 'test',
         'vmid': '999',
@@ -644,20 +617,12 @@ def websocket_test():
         'host': 'localhost',
         'port': '8006'
     })
+    print(f"DEBUG: Generated token {token} for WebSocket test ({TOKEN_BACKEND} store)")
     
     # Verify the token was saved
     token_data = get_token(token)
     print(f"DEBUG: Token data for {token}: {token_data}")
     
-    # Check if the token file exists
-    token_file = os.path.join(os.path.dirname(__file__), '../websocket_tokens.json')
-    print(f"DEBUG: Token file path: {token_file}")
-    print(f"DEBUG: Token file exists: {os.path.exists(token_file)}")
-    
-    if os.path.exists(token_file):
-        with open(token_file, 'r') as f:
-            print(f"DEBUG: Token file content: {f.read()}")
-    
     # Generate WebSocket URL
     ws_url = f"ws://{request.host.split(':')[0]}:8765/api/ws/vnc?token={token}&type=qemu"
     
@@ -670,20 +635,21 @@ def websocket_test():
 
 @bp.route('/api/debug/check-tokens')
 def debug_check_tokens():
-    """Check tokens in both systems"""
-    # Import directly to ensure we're accessing the same objects
-    from app.proxmox.websocket import connection_tokens
+    """Check the shared token store"""
+    from app.proxmox.token_store import get_token_store
     
+    store = get_token_store()
     return jsonify({
         'success': True,
-        'tokens': list(connection_tokens.keys()),
-        'token_count': len(connection_tokens)
+        'backend': store.name,
+        'token_count': store.count()
     })
 
 @bp.route('/api/debug/create-token')
 def debug_create_token():
     """Create a direct token for testing"""
-    from app.proxmox.websocket import generate_token, store_vnc_connection, connection_tokens
+    from app.proxmox.websocket import generate_token, store_vnc_connection
+    from app.proxmox.token_store import get_token_store
     
     token = generate_token()
     store_vnc_connection(
@@ -700,7 +666,7 @@ def debug_create_token():
     return jsonify({
         'success': True,
         'token': token,
-        'all_tokens': list(connection_tokens.keys())
+        'token_count': get_token_store().count()
     })
 
 @bp.route('/debug/websocket')
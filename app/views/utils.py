@@ -0,0 +1,175 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from flask import request, jsonify, make_response, current_app
+
+
+class PayloadCache:
+    """
+    Remembers recently sent JSON payloads by (key, version).
+    Used to answer ?since=<version> requests with only the fields that changed.
+    """
+
+    def __init__(self, max_entries=512):
+        """Initialize the cache holding at most max_entries payloads"""
+        self.max_entries = max_entries
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Get a remembered payload or None"""
+        with self._lock:
+            payload = self._payloads.get((key, version))
+            if payload is not None:
+                self._payloads.move_to_end((key, version))
+            return payload
+
+    def put(self, key, version, payload):
+        """Remember a payload, evicting the least recently used ones"""
+        with self._lock:
+            self._payloads[(key, version)] = payload
+            self._payloads.move_to_end((key, version))
+            while len(self._payloads) > self.max_entries:
+                self._payloads.popitem(last=False)
+
+
+# Shared cache of payloads sent by the dashboard JSON APIs
+payload_cache = PayloadCache()
+
+
+def payload_delta(old, new):
+    """
+    Compare two payload dictionaries at the top level
+
+    Returns:
+        Tuple of (changed, removed): changed maps keys whose value is new or
+        different to the new value, removed lists keys no longer present
+    """
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    return changed, removed
+
+
+def conditional_json(key, version, build):
+    """
+    Send a JSON payload with an ETag, answering conditional and delta requests.
+
+    - If-None-Match matching the version (or ?since= equal to it) gets a 304
+      without building the payload.
+    - ?since=<older version> gets only the changed top-level fields when that
+      older payload is still remembered, and the full payload otherwise.
+
+    Args:
+        key: Identifies the resource (endpoint, user and query parameters except since)
+        version: Version of the underlying data (see app.proxmox.api.data_version)
+        build: Callable returning the payload dictionary; only called when needed
+
+    Returns:
+        Flask response
+    """
+    etag = version
+    since = request.args.get('since')
+
+    if etag in request.if_none_match or since == version:
+        response = make_response('', 304)
+    else:
+        payload = payload_cache.get(key, version)
+        if payload is None:
+            payload = build()
+            payload_cache.put(key, version, payload)
+
+        previous = payload_cache.get(key, since) if since else None
+        if previous is not None:
+            changed, removed = payload_delta(previous, payload)
+            response = jsonify({
+                'success': True,
+                'delta': True,
+                'since': since,
+                'version': version,
+                'changed': changed,
+                'removed': removed
+            })
+        else:
+            response = jsonify({**payload, 'version': version})
+
+    response.set_etag(etag)
+    # Browsers must revalidate every time, which turns unchanged polls into 304s
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+class FragmentTimeout(Exception):
+    """Raised when a fragment is not ready within its timeout and nothing is cached"""
+    pass
+
+
+class FragmentCache:
+    """
+    Cache for independently loaded page fragments.
+
+    Every entry has its own TTL. Expired entries are reloaded on a worker
+    thread; the caller waits at most `timeout` seconds and otherwise gets the
+    stale value (or FragmentTimeout when there is none). A load that outlives
+    its caller keeps running and fills the cache for the next request, so a
+    slow Proxmox call never blocks more than its own fragment.
+    """
+
+    def __init__(self, max_workers=8):
+        """Initialize the cache with a pool of max_workers loader threads"""
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fragment')
+        self._entries = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, ttl, timeout):
+        """
+        Get a fragment value, loading it if missing or older than ttl
+
+        Args:
+            key: Cache key (fragment name plus anything the value depends on)
+            loader: Callable producing the value; runs inside an app context
+            ttl: Seconds a loaded value stays fresh
+            timeout: Seconds to wait for a reload before falling back
+
+        Returns:
+            The fragment value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] < ttl:
+                return entry[0]
+
+            future = self._pending.get(key)
+            if future is None:
+                app = current_app._get_current_object()
+                future = self._executor.submit(self._load, app, key, loader)
+                self._pending[key] = future
+
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            if entry is not None:
+                return entry[0]
+            raise FragmentTimeout(f"Fragment {key} not ready after {timeout}s")
+        except Exception:
+            # A failed reload still leaves the last good value usable
+            if entry is not None:
+                return entry[0]
+            raise
+
+    def _load(self, app, key, loader):
+        """Run a loader and store its result"""
+        try:
+            with app.app_context():
+                value = loader()
+            with self._lock:
+                self._entries[key] = (value, time.time())
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+
+# Shared cache for the dashboard fragments
+fragment_cache = FragmentCache()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the VNC relay
+
+Streams data through a relay between a local WebSocket client and a local
+TCP stand-in for the VNC server, in both directions, and reports MB/s of
+wall time and MB/s per CPU second used by the relay (i.e. per core). The
+built-in asyncio relay is compared with websockify, the engine behind
+websockify_proxy.py, when websockify is installed.
+
+Every run starts a fresh relay process so its CPU time can be read from
+getrusage(RUSAGE_CHILDREN); an idle run is subtracted as the baseline.
+"""
+import os
+import sys
+import time
+import socket
+import base64
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+# Add the app path to the import search path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+# The relay under test reads tokens from a private database
+BENCH_DIR = tempfile.mkdtemp(prefix='bench_relay_')
+os.environ['TOKEN_BACKEND'] = 'sqlite'
+os.environ['TOKEN_DB'] = os.path.join(BENCH_DIR, 'tokens.db')
+
+from app.proxmox.relay import run_relay, unmask
+from app.proxmox.token_store import issue_token
+
+try:
+    import websockify.websocketproxy
+except ImportError:
+    websockify = None
+
+MB = 1024 * 1024
+CHUNK = 64 * 1024
+
+def vnc_server(listener, total):
+    """Stand-in VNC server: per connection either streams `total` bytes or counts them"""
+    def serve(conn):
+        mode = conn.recv(1)
+        if mode == b'D':
+            data = os.urandom(CHUNK)
+            for _ in range(total // CHUNK):
+                conn.sendall(data)
+        else:
+            buf = bytearray(MB)
+            received = 0
+            while received < total:
+                n = conn.recv_into(buf)
+                if not n:
+                    break
+                received += n
+            conn.sendall(b'k')
+        conn.recv(1)
+        conn.close()
+    
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+class WebSocketClient:
+    """Minimal blocking WebSocket client for the benchmark"""
+    
+    def __init__(self, port, path):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.sock.sendall((
+            f"GET {path} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+            f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n"
+            f"Sec-WebSocket-Protocol: binary\r\n\r\n"
+        ).encode())
+        
+        self.rfile = self.sock.makefile('rb', buffering=MB)
+        status = self.rfile.readline()
+        if b' 101 ' not in status:
+            raise RuntimeError(f"Upgrade failed: {status!r}")
+        while self.rfile.readline() not in (b'\r\n', b''):
+            pass
+        
+        self.payload = os.urandom(CHUNK)
+        self.mask = os.urandom(4)
+    
+    def send(self, data):
+        """Send one masked binary frame"""
+        n = len(data)
+        if n < 126:
+            header = bytes((0x82, 0x80 | n))
+        elif n < 65536:
+            header = bytes((0x82, 0x80 | 126)) + n.to_bytes(2, 'big')
+        else:
+            header = bytes((0x82, 0x80 | 127)) + n.to_bytes(8, 'big')
+        self.sock.sendall(header + self.mask + unmask(data, self.mask))
+    
+    def receive(self, total):
+        """Read frames until `total` payload bytes have arrived"""
+        buf = memoryview(bytearray(MB))
+        received = 0
+        while received < total:
+            first, second = self.rfile.read(2)
+            length = second & 0x7F
+            if length == 126:
+                length = int.from_bytes(self.rfile.read(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(self.rfile.read(8), 'big')
+            if first & 0x0F == 0x8:
+                raise RuntimeError("Relay closed the connection")
+            remaining = length
+            while remaining:
+                remaining -= self.rfile.readinto(buf[:min(remaining, len(buf))])
+            received += length
+    
+    def upload(self, total):
+        """Send `total` bytes in CHUNK frames; returns when the server has them all"""
+        frame = None
+        for _ in range(total // CHUNK):
+            if frame is None:
+                # Mask once and resend the same frame: the client isn't what we measure
+                header = bytes((0x82, 0x80 | 127)) + CHUNK.to_bytes(8, 'big')
+                frame = header + self.mask + unmask(self.payload, self.mask)
+            self.sock.sendall(frame)
+        self.receive(1)
+    
+    def close(self):
+        # The buffered reader holds the socket open too
+        self.rfile.close()
+        self.sock.close()
+
+def run_builtin(port, target_port):
+    """Relay process: the built-in asyncio relay"""
+    import asyncio
+    logging.disable(logging.WARNING)
+    asyncio.run(run_relay('127.0.0.1', port))
+
+def run_websockify(port, target_port):
+    """Relay process: websockify proxying straight to the target"""
+    logging.disable(logging.WARNING)
+    server = websockify.websocketproxy.WebSocketProxy(
+        listen_host='127.0.0.1', listen_port=port,
+        target_host='127.0.0.1', target_port=target_port,
+        daemon=False, verbose=False, web=None
+    )
+    server.start_server()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_listening(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Relay did not start on port {port}")
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(engine, target_port, direction, total):
+    """
+    Run one relay process for one transfer
+    
+    Returns:
+        (wall seconds, relay CPU seconds); direction None measures an idle relay
+    """
+    port = free_port()
+    relay = multiprocessing.Process(target=engine, args=(port, target_port))
+    cpu_before = children_cpu()
+    relay.start()
+    wait_listening(port)
+    
+    elapsed = 0
+    if direction:
+        path = f"/api/ws/vnc?token={issue_token({'host': '127.0.0.1', 'port': target_port})}"
+        client = WebSocketClient(port, path)
+        
+        # The first byte tells the stand-in server which way to stream
+        client.send(b'D' if direction == 'down' else b'U')
+        start = time.perf_counter()
+        if direction == 'down':
+            client.receive(total)
+        else:
+            client.upload(total)
+        elapsed = time.perf_counter() - start
+        client.close()
+        # Let the relay (and websockify's per-client process) wind down so it is counted
+        time.sleep(0.5)
+    
+    relay.terminate()
+    relay.join()
+    return elapsed, children_cpu() - cpu_before
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark VNC relay throughput")
+    parser.add_argument("--mb", type=int, default=256, help="Megabytes per direction")
+    parser.add_argument("--engine", action="append", choices=['builtin', 'websockify'],
+                        help="Relay to measure (repeatable; default all available)")
+    args = parser.parse_args()
+    
+    total = args.mb * MB
+    engines = args.engine or ['builtin', 'websockify']
+    
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    threading.Thread(target=vnc_server, args=(listener, total), daemon=True).start()
+    target_port = listener.getsockname()[1]
+    
+    print(f"{'engine':<11} {'direction':<15} {'MB/s':>9} {'relay CPU s':>12} {'MB/s per core':>14}")
+    for name in engines:
+        if name == 'websockify' and websockify is None:
+            print(f"{name:<11} skipped: websockify is not installed")
+            continue
+        engine = run_builtin if name == 'builtin' else run_websockify
+        
+        _, idle_cpu = measure(engine, target_port, None, total)
+        for direction, label in (('down', 'server->browser'), ('up', 'browser->server')):
+            elapsed, cpu = measure(engine, target_port, direction, total)
+            cpu = max(cpu - idle_cpu, 1e-6)
+            print(f"{name:<11} {label:<15} {args.mb / elapsed:>9,.0f} {cpu:>12.2f} {args.mb / cpu:>14,.0f}")
+
+if __name__ == "__main__":
+    main()
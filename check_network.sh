@@ -4,26 +4,16 @@
 echo "==== Network Connectivity Tests ===="
 echo ""
 
-# Get host and port from token file if it exists
-if [ -f "websocket_tokens.json" ]; then
-    # Try to extract host and port using Python
-    HOST=$(python3 -c 'import json; import sys; f=open("websocket_tokens.json"); t=json.load(f); k=list(t.keys())[0] if t else None; print(t[k].get("host", "") if k else "")' 2>/dev/null)
-    PORT=$(python3 -c 'import json; import sys; f=open("websocket_tokens.json"); t=json.load(f); k=list(t.keys())[0] if t else None; print(t[k].get("port", "") if k else "")' 2>/dev/null)
-    
-    # If that failed, try the nested data structure
-    if [ -z "$HOST" ]; then
-        HOST=$(python3 -c 'import json; import sys; f=open("websocket_tokens.json"); t=json.load(f); k=list(t.keys())[0] if t else None; print(t[k]["data"]["host"] if k and "data" in t[k] else "")' 2>/dev/null)
-        PORT=$(python3 -c 'import json; import sys; f=open("websocket_tokens.json"); t=json.load(f); k=list(t.keys())[0] if t else None; print(t[k]["data"]["port"] if k and "data" in t[k] else "")' 2>/dev/null)
-    fi
-    
-    if [ -n "$HOST" ]; then
-        echo "Found server in token file: $HOST:$PORT"
-    fi
+# Get host and port from the newest console token, whatever the token backend
+TARGET=$(python3 -m app.proxmox.token_store 2>/dev/null)
+if [ -n "$TARGET" ]; then
+    read HOST PORT <<< "$TARGET"
+    echo "Found server in token store: $HOST:$PORT"
 else
-    echo "No token file found"
+    echo "No console tokens found"
 fi
 
-# If we couldn't get host/port from token file, try .env
+# If we couldn't get host/port from the token store, try .env
 if [ -z "$HOST" ] && [ -f ".env" ]; then
     HOST=$(grep -E "^PROXMOX_HOST" .env | cut -d= -f2)
     
@@ -1,36 +1,30 @@
 #!/usr/bin/env python3
 """
-Direct VNC Bridge - authenticates with Proxmox API and creates a websockify connection
+Direct VNC Bridge - authenticates with Proxmox API and routes a console through the VNC relay
 
 This script:
 1. Authenticates with Proxmox API
 2. Gets a VNC proxy ticket
-3. Creates a websockify server to bridge the connection
+3. Registers the VNC target with the running relay (run_websocket.py)
+   through its control socket, keeps it registered while running and
+   removes it again on exit
 """
 import os
 import sys
 import json
 import requests
 import time
-import threading
 import socket
-import argparse
-import subprocess
 import signal
-import atexit
+import argparse
 
-# Global variables
-proxy_process = None
+# Control API of the relay (see app/proxmox/relay.py, apply_control)
+CONTROL_SOCKET = os.environ.get('RELAY_CONTROL_SOCKET', 'app/data/relay.sock')
 
-def cleanup():
-    """Clean up resources on exit"""
-    global proxy_process
-    if proxy_process:
-        print("Stopping websockify process...")
-        try:
-            proxy_process.terminate()
-        except:
-            pass
+# Routes expire after ROUTE_TTL seconds unless registered again, so a bridge
+# that dies without unregistering doesn't leave its route behind
+ROUTE_TTL = int(os.environ.get('RELAY_ROUTE_TTL', 300))
+ROUTE_REFRESH = ROUTE_TTL / 3
 
 def get_proxmox_credentials():
     """Get Proxmox credentials from .env file"""
@@ -114,65 +108,91 @@ def get_vnc_proxy_ticket(host, user, password, node, vmid, vmtype='qemu'):
         print(f"Error: {e}")
         return None
 
-def start_websockify_server(listen_port, target_host, target_port):
+def control_request(command, control=CONTROL_SOCKET):
+    """Send one command to the relay's control socket and return its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(control)
+        sock.sendall(json.dumps(command).encode() + b'\n')
+        return json.loads(sock.makefile('rb').readline())
+
+def register_target(target_host, target_port, path=None, control=CONTROL_SOCKET, **info):
     """
-    Start a websockify server to proxy WebSocket to TCP
+    Register a VNC target with the relay
+    
+    Returns:
+        (route, key): the route name (the path, or a token for ?token=) and,
+        for a path route, the key clients must send as ?token=; (None, None)
+        on failure
     """
-    global proxy_process
+    print(f"Registering {target_host}:{target_port} with the VNC relay...")
+    command = dict(info, op='register', host=target_host, port=int(target_port), ttl=ROUTE_TTL)
+    if path:
+        command['path'] = path
     
-    # Check if target is reachable
-    print(f"Testing connection to {target_host}:{target_port}...")
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(3)
-        s.connect((target_host, int(target_port)))
-        s.close()
-        print("Target is reachable!")
-    except Exception as e:
-        print(f"Warning: Could not connect to target: {e}")
-        print("Continuing anyway in case the connection is just restricted...")
-    
-    # Start websockify process
-    print(f"Starting websockify on port {listen_port} pointing to {target_host}:{target_port}...")
+        response = control_request(command, control)
+    except OSError as e:
+        print(f"Could not reach the relay control socket {control}: {e}")
+        print("Is the relay running? Start it with: python run_websocket.py")
+        return None, None
     
+    if not response.get('ok'):
+        print(f"Relay refused the route: {response.get('error')}")
+        return None, None
+    return response['route'], response.get('key')
+
+def unregister_target(route, control=CONTROL_SOCKET):
+    """Remove a route from the relay"""
     try:
-        # First check if the port is available
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('0.0.0.0', int(listen_port)))
-        s.close()
-        print(f"Port {listen_port} is available")
-    except Exception as e:
-        print(f"Port {listen_port} is not available: {e}")
-        print("Stopping any existing websockify processes...")
-        try:
-            subprocess.run(["pkill", "-f", "websockify"], check=False)
-            time.sleep(1)
-        except:
-            pass
-    
-    # Start websockify
+        control_request({'op': 'unregister', 'route': route}, control)
+        print(f"Route {route} removed")
+    except OSError as e:
+        print(f"Could not remove route {route}: {e}")
+
+def refresh_route(route, target, control=CONTROL_SOCKET):
+    """Register the route again (restarting its ttl); True if the relay took it"""
     try:
-        target = f"{target_host}:{target_port}"
-        cmd = ["websockify", str(listen_port), target]
-        proxy_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # Register cleanup function
-        atexit.register(cleanup)
-        
-        # Give it a moment to start
-        time.sleep(2)
-        
-        # Check if it's still running
-        if proxy_process.poll() is None:
-            print(f"Websockify started with PID {proxy_process.pid}")
-            return True
-        else:
-            stdout, stderr = proxy_process.communicate()
-            print(f"Websockify failed to start: {stderr.decode()}")
-            return False
-    except Exception as e:
-        print(f"Error starting websockify: {e}")
+        response = control_request(dict(target, op='register', route=route, ttl=ROUTE_TTL), control)
+    except OSError as e:
+        print(f"Could not refresh route {route}: {e}")
         return False
+    if not response.get('ok'):
+        print(f"Relay refused to refresh route {route}: {response.get('error')}")
+    return response.get('ok', False)
+
+def serve_route(route, listen_port, control, target):
+    """
+    Print where to connect, then keep the route until Ctrl+C
+    
+    Args:
+        target: host, port, key (path routes) and extra fields the route was
+                registered with, to register it again every ROUTE_REFRESH
+                seconds (the key survives a relay restart that way)
+    """
+    if route.startswith('/'):
+        url = f"ws://localhost:{listen_port}{route}?token={target['key']}"
+    else:
+        url = f"ws://localhost:{listen_port}/?token={route}"
+    print("\nDirect VNC Bridge is running!")
+    print(f"Connect to: {url}")
+    print("Press Ctrl+C to stop...")
+    
+    # Being killed removes the route too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        # Keep the route registered while the script runs (this also restores
+        # it after a relay restart)
+        refresh_at = time.time() + ROUTE_REFRESH
+        while True:
+            time.sleep(1)
+            if time.time() >= refresh_at:
+                refresh_route(route, target, control)
+                refresh_at = time.time() + ROUTE_REFRESH
+    except KeyboardInterrupt:
+        print("\nStopping...")
+    finally:
+        unregister_target(route, control)
 
 def main():
     parser = argparse.ArgumentParser(description="Direct VNC Bridge")
@@ -182,7 +202,11 @@ def main():
     parser.add_argument("--node", help="Proxmox node")
     parser.add_argument("--vmid", help="VM ID")
     parser.add_argument("--type", default="qemu", help="VM type (qemu or lxc)")
-    parser.add_argument("--port", type=int, default=8765, help="Local port to listen on")
+    parser.add_argument("--port", type=int, default=int(os.environ.get('WEBSOCKET_PORT', 8765)),
+                        help="Port the relay listens on")
+    parser.add_argument("--path", help="Route by this URL path (e.g. /vnc/100) instead of a token; "
+                                       "clients still need the route's key as ?token=")
+    parser.add_argument("--control", default=CONTROL_SOCKET, help="Relay control socket")
     parser.add_argument("--direct", action="store_true", help="Skip API and connect directly")
     parser.add_argument("--target-port", type=int, help="Target port (only with --direct)")
     
@@ -204,19 +228,14 @@ def main():
             return 1
         
         print(f"Direct connection mode: {host}:{args.target_port}")
-        start_websockify_server(listen_port, host, args.target_port)
-        
-        print("\nDirect VNC Bridge is running!")
-        print(f"Connect to: ws://localhost:{listen_port}")
-        print("Press Ctrl+C to stop...")
-        
-        try:
-            # Keep the script running
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            print("\nStopping...")
+        route, key = register_target(host, args.target_port, args.path, args.control)
+        if not route:
+            return 1
         
+        target = {'host': host, 'port': args.target_port}
+        if key:
+            target['key'] = key
+        serve_route(route, listen_port, args.control, target)
         return 0
     
     # Regular API mode - verify required parameters
@@ -261,60 +280,17 @@ def main():
         print("No port specified in proxy data")
         return 1
     
-    # Start websockify
-    if not start_websockify_server(listen_port, target_host, target_port):
-        print("Failed to start websockify server. Aborting.")
+    # Route the console through the relay; the ticket travels with the target
+    info = {'ticket': proxy_data.get('ticket', ''), 'node': node, 'vmid': vmid, 'vmtype': vmtype}
+    route, key = register_target(target_host, target_port, args.path, args.control, **info)
+    if not route:
+        print("Failed to register the console with the VNC relay. Aborting.")
         return 1
     
-    # Save ticket information to token file
-    try:
-        token_file = os.path.join(os.getcwd(), 'websocket_tokens.json')
-        token_id = f"direct-{int(time.time())}"
-        
-        token_data = {
-            "ticket": proxy_data.get('ticket', ''),
-            "host": host,
-            "port": target_port,
-            "node": node,
-            "vmid": vmid,
-            "vmtype": vmtype,
-            "created_at": time.time()
-        }
-        
-        tokens = {}
-        if os.path.exists(token_file):
-            with open(token_file, 'r') as f:
-                try:
-                    tokens = json.load(f)
-                except:
-                    tokens = {}
-        
-        tokens[token_id] = token_data
-        
-        with open(token_file, 'w') as f:
-            json.dump(tokens, f, indent=2)
-            
-        print(f"Saved token information to {token_file}")
-    except Exception as e:
-        print(f"Warning: Could not save token information: {e}")
-    
-    print("\nDirect VNC Bridge is running!")
-    print(f"Connect to: ws://localhost:{listen_port}")
-    print("Press Ctrl+C to stop...")
-    
-    try:
-        # Keep the script running
-        while True:
-            time.sleep(1)
-            
-            # Check if websockify is still running
-            if proxy_process and proxy_process.poll() is not None:
-                stdout, stderr = proxy_process.communicate()
-                print(f"Websockify process terminated: {stderr.decode()}")
-                break
-    except KeyboardInterrupt:
-        print("\nStopping...")
-    
+    target = dict(info, host=target_host, port=target_port)
+    if key:
+        target['key'] = key
+    serve_route(route, listen_port, args.control, target)
     return 0
 
 if __name__ == "__main__":
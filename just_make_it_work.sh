@@ -44,6 +44,16 @@ else
     echo "Approach 2: Using Proxmox API VNC proxy"
     echo "----------------------------------------"
     
+    # The bridge registers the console with the VNC relay, so start that first
+    mkdir -p app/data
+    rm -f app/data/relay.sock
+    python run_websocket.py > /dev/null 2>&1 &
+    RELAY_PID=$!
+    for i in $(seq 30); do
+        [ -S app/data/relay.sock ] && break
+        sleep 0.5
+    done
+    
     # Start the bridge
     python direct_vnc_bridge.py &
     BRIDGE_PID=$!
@@ -64,5 +74,5 @@ echo "Press Ctrl+C to stop the VNC connection."
 echo "===================================="
 
 # Wait for Ctrl+C
-trap "echo 'Stopping VNC connection...'; kill $WEBSOCKIFY_PID 2>/dev/null; kill $BRIDGE_PID 2>/dev/null" INT
+trap "echo 'Stopping VNC connection...'; kill $WEBSOCKIFY_PID 2>/dev/null; kill $BRIDGE_PID 2>/dev/null; kill $RELAY_PID 2>/dev/null" INT
 wait
@@ -1,16 +1,28 @@
 #!/usr/bin/env python3
 """
 WebSocket server for ProxGui VNC connections
+
+Runs the relay supervisor, which starts RELAY_WORKERS relay processes (one
+per core by default) on the WebSocket port. Send SIGHUP to reload the
+workers without dropping open consoles, SIGTERM to drain and stop.
+Targets can be registered at runtime through the control API on
+RELAY_CONTROL_SOCKET (see direct_vnc_bridge.py).
 """
 import os
 import sys
+import json
+import signal
+import socket
+import asyncio
 import logging
+import argparse
 
 # Add the app path to the import search path
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-# Import the module with the WebSocket handling logic
-from app.proxmox.websocket import start_websocket_server, stop_websocket_server
+# Import the asyncio VNC relay and its process supervisor
+from app.proxmox.relay import run_relay
+from app.proxmox.supervisor import Supervisor
 
 # Configure logging
 logging.basicConfig(
@@ -23,31 +35,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger("websocket-server")
 
+def run_worker(fd, slot):
+    """Serve consoles on a listening socket inherited from the supervisor"""
+    sock = socket.socket(fileno=fd)
+    sock.setblocking(False)
+    
+    # Ctrl+C reaches the whole process group; the supervisor answers it by
+    # draining the workers with SIGTERM, so open consoles must survive it here
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    # Tell the supervisor this worker is accepting, so it can retire the old one
+    ready = lambda: print('ready', flush=True)
+    
+    # Periodic stats go the same way; the supervisor sums them for the control API
+    report = lambda stats: print('stats ' + json.dumps(stats), flush=True)
+    
+    # One worker is enough to expire old tokens; routes arrive on stdin
+    asyncio.run(run_relay(sock=sock, cleanup=slot == 0, on_ready=ready,
+                          route_feed=sys.stdin.fileno(), on_stats=report))
+
 async def main():
-    try:
-        # Get host and port from environment variables if set
-        host = os.environ.get('WEBSOCKET_HOST', '0.0.0.0')
-        port = int(os.environ.get('WEBSOCKET_PORT', 8765))
-        
-        # Start the WebSocket server
-        server = start_websocket_server(host, port)
-        logger.info(f"WebSocket server running on {host}:{port}")
-        
-        # Keep the main thread alive
-        import asyncio
-        await asyncio.Future()  # Run forever
-            
-    except Exception as e:
-        logger.error(f"WebSocket server error: {e}")
-        logger.exception(e)
+    # Get host, port and worker count from environment variables if set
+    host = os.environ.get('WEBSOCKET_HOST', '0.0.0.0')
+    port = int(os.environ.get('WEBSOCKET_PORT', 8765))
+    workers = int(os.environ.get('RELAY_WORKERS', os.cpu_count() or 1))
+    control = os.environ.get('RELAY_CONTROL_SOCKET', 'app/data/relay.sock')
+    
+    # Workers are this script again, started with --fd/--slot
+    os.makedirs(os.path.dirname(control) or '.', exist_ok=True)
+    supervisor = Supervisor(host, port, workers, [sys.executable, os.path.abspath(__file__)], control)
+    logger.info(f"WebSocket server running on {host}:{port}")
+    await supervisor.run()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VNC relay: supervisor, or a worker with --fd")
+    parser.add_argument("--fd", type=int, help="Listening socket passed by the supervisor")
+    parser.add_argument("--slot", type=int, default=0, help="Worker slot")
+    args = parser.parse_args()
+    
     try:
-        import asyncio
-        asyncio.run(main())
+        if args.fd is not None:
+            run_worker(args.fd, args.slot)
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("WebSocket server stopped by user")
-        stop_websocket_server()
     except Exception as e:
         logger.error(f"WebSocket server error: {e}")
-        logger.exception(e)
\ No newline at end of file
+        logger.exception(e)
@@ -1,23 +1,26 @@
 #!/bin/bash
 # Start script for ProxGui with WebSocket server
+#
+#   ./start.sh          start the VNC relay and the Flask application
+#   ./start.sh reload   restart the relay workers without dropping consoles
 
-# Make sure token file is initialized
-echo "Initializing token file..."
-if [ ! -f "websocket_tokens.json" ]; then
-    echo "{}" > websocket_tokens.json
-fi
+RELAY_PID_FILE=app/data/relay.pid
 
-# Check if websockify is installed
-pip install websockify > /dev/null 2>&1
-if [ $? -ne 0 ]; then
-    echo "Installing websockify..."
-    pip install websockify
+if [ "$1" = "reload" ]; then
+    # New workers take over the listening sockets, old ones finish their sessions
+    kill -HUP "$(cat $RELAY_PID_FILE)" && echo "Reloading VNC relay workers..."
+    exit $?
 fi
 
-# Start the websockify proxy server in the background
+# Console tokens are shared through app/data/tokens.db (see TOKEN_BACKEND)
+mkdir -p app/data
+
+# Start the VNC relay supervisor in the background; it runs RELAY_WORKERS
+# worker processes (default: one per core) sharing the port
 echo "Starting WebSocket proxy server..."
-python websockify_proxy.py &
+python run_websocket.py &
 WEBSOCKET_PID=$!
+echo $WEBSOCKET_PID > $RELAY_PID_FILE
 
 # Give the WebSocket server a moment to start up
 sleep 2
@@ -26,6 +29,7 @@ sleep 2
 echo "Starting Flask application..."
 python run.py
 
-# When Flask exits, also kill the WebSocket server
+# When Flask exits, stop the relay; open consoles are drained first
 echo "Stopping WebSocket server..."
-kill $WEBSOCKET_PID
\ No newline at end of file
+kill -TERM $WEBSOCKET_PID
+rm -f $RELAY_PID_FILE
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Regression checks for the asyncio VNC relay
+
+Runs the relay in-process between a local WebSocket client and a local TCP
+echo server and checks that data comes back intact, including a single
+read that carries more client frames than one sendmsg call can take
+(MAX_IOV).
+"""
+import os
+import sys
+import base64
+import asyncio
+import tempfile
+
+# Add the app path to the import search path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+# Tokens for the test go to a private database
+os.environ['TOKEN_BACKEND'] = 'sqlite'
+os.environ['TOKEN_DB'] = os.path.join(tempfile.mkdtemp(prefix='test_relay_'), 'tokens.db')
+
+from app.proxmox import relay
+from app.proxmox.token_store import issue_token
+
+TIMEOUT = 10
+
+def masked_frame(payload, opcode=relay.OP_BINARY):
+    """A client (masked) frame"""
+    mask = os.urandom(4)
+    header = bytearray(relay.frame_header(opcode, len(payload)))
+    header[1] |= 0x80
+    return bytes(header) + mask + relay.unmask(payload, mask)
+
+async def read_frame(reader):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), 'big')
+    return first & 0x0F, await reader.readexactly(length)
+
+async def echo(reader, writer):
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            break
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+async def open_console(relay_port, target_port):
+    """Upgrade a connection through the relay to the echo server"""
+    token = issue_token({'host': '127.0.0.1', 'port': target_port})
+    reader, writer = await asyncio.open_connection('127.0.0.1', relay_port)
+    key = base64.b64encode(os.urandom(16)).decode()
+    writer.write((
+        f"GET /?token={token} HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+        f"Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n"
+    ).encode())
+    status = (await reader.readuntil(b'\r\n\r\n')).split(b'\r\n')[0]
+    if b' 101 ' not in status:
+        raise RuntimeError(f"Upgrade failed: {status!r}")
+    return reader, writer
+
+async def check_echo(relay_port, target_port, frames, size):
+    """Send `frames` frames of `size` bytes in one write; True if all come back"""
+    reader, writer = await open_console(relay_port, target_port)
+    payloads = [os.urandom(size) for _ in range(frames)]
+    writer.write(b''.join(masked_frame(p) for p in payloads))
+    
+    expected = b''.join(payloads)
+    received = b''
+    try:
+        while len(received) < len(expected):
+            _, payload = await asyncio.wait_for(read_frame(reader), TIMEOUT)
+            received += payload
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        writer.close()
+    return received == expected
+
+async def main():
+    target = await asyncio.start_server(echo, '127.0.0.1', 0)
+    target_port = target.sockets[0].getsockname()[1]
+    server = await relay.start_relay(sock=relay.listen_socket('127.0.0.1', 0))
+    relay_port = server.sock.getsockname()[1]
+    
+    checks = [
+        ("one large frame", 1, 300000),
+        ("100 small frames", 100, 7),
+        (f"{relay.MAX_IOV + 88} small frames in one read", relay.MAX_IOV + 88, 7),
+        ("5000 small frames", 5000, 7)
+    ]
+    failed = 0
+    for name, frames, size in checks:
+        ok = await check_echo(relay_port, target_port, frames, size)
+        print(f"{'✅' if ok else '❌'} {name}")
+        failed += not ok
+    
+    # Let the sessions (and the echo handlers) finish before the loop stops
+    await asyncio.sleep(0.5)
+    server.close()
+    target.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
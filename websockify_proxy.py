@@ -8,6 +8,7 @@ using tokens for authentication.
 import os
 import sys
 import json
+import asyncio
 import time
 import logging
 import threading
@@ -15,6 +16,11 @@ import websockify.websocketproxy
 from urllib.parse import parse_qs
 import socket
 
+# Add the app path to the import search path
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from app.proxmox.token_store import consume_token, TOKEN_BACKEND, TOKEN_DB, TOKEN_FILE, TOKEN_MIRROR
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -26,73 +32,152 @@ logging.basicConfig(
 )
 logger = logging.getLogger("websockify-proxy")
 
-# Constants
-TOKEN_FILE = os.path.abspath(os.path.join(os.getcwd(), 'websocket_tokens.json'))
+# Tokens come from the store shared with the Flask app
+TOKEN_SOURCE = {'sqlite': TOKEN_DB, 'memory': TOKEN_FILE}.get(TOKEN_BACKEND, TOKEN_BACKEND)
+
+# Target reachability probes
+PROBE_TTL = int(os.environ.get('PROBE_TTL', 30))   # Seconds a probe result stays fresh
+PROBE_TIMEOUT = 3
+REPORT_INTERVAL = 60
+
+class ReachabilityMonitor(object):
+    """
+    Probes console targets in the background, caching results per (host, port)
+    
+    websockify runs lookup() in a forked child per connection, so the child
+    only drops the target into a datagram socket shared with the parent and
+    moves on. A thread in the parent probes each target at most once per
+    PROBE_TTL with a non-blocking connect, and reports failures through its
+    counters and the log instead of delaying the console.
+    """
+    
+    def __init__(self, ttl=PROBE_TTL, timeout=PROBE_TIMEOUT):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.results = {}       # (host, port) -> latest probe result
+        self.counters = {'requested': 0, 'cached': 0, 'probes': 0, 'failures': 0}
+        self._probing = set()
+        self._tasks = set()
+        
+        self._receiver, self._sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        threading.Thread(target=lambda: asyncio.run(self._serve()), name='reachability', daemon=True).start()
+    
+    def check(self, host, port):
+        """Request a probe of host:port (never blocks)"""
+        try:
+            self._sender.send(f"{host} {port}".encode())
+        except OSError:
+            # Queue full: a skipped probe only costs a metric sample
+            pass
+    
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        self._receiver.setblocking(False)
+        self._tasks.add(asyncio.ensure_future(self._report()))
+        
+        while True:
+            data = await loop.sock_recv(self._receiver, 1024)
+            try:
+                host, port = data.decode().rsplit(' ', 1)
+                key = (host, int(port))
+            except ValueError as e:
+                # UnicodeDecodeError is a ValueError too; one bad request must not stop probing
+                logger.error(f"Ignoring malformed probe request {data[:100]!r}: {e}")
+                continue
+            self.counters['requested'] += 1
+            
+            result = self.results.get(key)
+            if key in self._probing or (result and time.time() - result['checked_at'] < self.ttl):
+                self.counters['cached'] += 1
+                continue
+            
+            self._probing.add(key)
+            task = asyncio.ensure_future(self._probe(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _probe(self, key):
+        """Connect to the target once and record the outcome"""
+        host, port = key
+        self.counters['probes'] += 1
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+            writer.close()
+            error = None
+        except (OSError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        finally:
+            self._probing.discard(key)
+        
+        previous = self.results.get(key)
+        failures = previous['failures'] if previous else 0
+        if error:
+            self.counters['failures'] += 1
+            failures += 1
+            logger.warning(f"VNC target {host}:{port} unreachable: {error}")
+        elif previous and not previous['reachable']:
+            logger.info(f"VNC target {host}:{port} reachable again")
+        
+        self.results[key] = {
+            'reachable': error is None,
+            'error': error,
+            'checked_at': time.time(),
+            'failures': failures
+        }
+    
+    def stats(self):
+        """Counters plus the targets whose latest probe failed"""
+        return dict(self.counters, unreachable=sorted(
+            f"{host}:{port}" for (host, port), result in self.results.items() if not result['reachable']
+        ))
+    
+    async def _report(self):
+        """Log the counters whenever they changed"""
+        last = None
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            stats = self.stats()
+            if stats != last:
+                logger.info(f"Target reachability: {json.dumps(stats)}")
+                last = stats
 
 class ProxmoxTokenPlugin(object):
     """Proxmox token authentication plugin for websockify"""
     
     def __init__(self, src=None):
         self.source = src
+        self.monitor = ReachabilityMonitor()
         logger.info(f"Token plugin initialized with source: {src}")
-        logger.info(f"Using token file: {TOKEN_FILE}")
+        logger.info(f"Using {TOKEN_BACKEND} token store: {TOKEN_SOURCE}")
+        if TOKEN_BACKEND == 'memory' and not TOKEN_MIRROR:
+            logger.warning("TOKEN_BACKEND=memory: tokens issued by the Flask app are not visible here, use sqlite")
     
     def lookup(self, token):
         """Look up a token and return host:port for the connection target"""
         logger.info(f"Looking up token: {token}")
         
         try:
-            if not os.path.exists(TOKEN_FILE):
-                logger.error(f"Token file does not exist: {TOKEN_FILE}")
+            # Shared with the Flask app; consuming makes the token single use
+            token_data = consume_token(token)
+            if token_data is None:
+                logger.warning(f"Token not found: {token}")
                 return None
             
-            with open(TOKEN_FILE, 'r') as f:
-                try:
-                    tokens = json.load(f)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error parsing token file: {e}")
-                    return None
-                
-                logger.info(f"Token file contains {len(tokens)} tokens")
-                
-                if token not in tokens:
-                    logger.warning(f"Token not found: {token}")
-                    return None
-                
-                token_data = tokens[token]
-                logger.info(f"Found token data: {token_data}")
-                
-                # Extract connection information - handle both formats
-                # Format 1: {'host': '...', 'port': '...'}
-                # Format 2: {'data': {'host': '...', 'port': '...'}}
-                host = token_data.get('host', '')
-                port = token_data.get('port', 0)
-                
-                # Check if we're dealing with the nested format
-                if not host and 'data' in token_data and isinstance(token_data['data'], dict):
-                    data = token_data['data']
-                    host = data.get('host', '')
-                    port = data.get('port', 0)
-                    logger.info(f"Using nested data format: host={host}, port={port}")
-                
-                if not host or not port:
-                    logger.error(f"Token missing host or port: {token_data}")
-                    return None
-                
-                # Return connection target
-                connection = f"{host}:{port}"
-                logger.info(f"Returning connection target: {connection}")
-                # Explicitly try connecting to confirm it's reachable
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.settimeout(3)
-                    logger.info(f"Testing direct connection to {host}:{port}...")
-                    sock.connect((host, int(port)))
-                    logger.info(f"Successfully connected to {host}:{port}")
-                    sock.close()
-                except Exception as e:
-                    logger.warning(f"Could not establish direct connection to {host}:{port}: {e}")
-                return connection
+            host = token_data.get('host', '')
+            port = token_data.get('port', 0)
+            
+            if not host or not port:
+                logger.error(f"Token missing host or port: {token_data}")
+                return None
+            
+            # Reachability is probed in the background; websockify's own
+            # connect reports the error if the target is really down
+            self.monitor.check(host, port)
+            
+            connection = f"{host}:{port}"
+            logger.info(f"Returning connection target: {connection}")
+            return connection
         except Exception as e:
             logger.exception(f"Error looking up token: {e}")
             return None
@@ -131,7 +216,7 @@ def main():
     server = ProxmoxWebsockifyServer(
         listen_host=host,
         listen_port=port,
-        token_plugin=ProxmoxTokenPlugin(src=TOKEN_FILE),
+        token_plugin=ProxmoxTokenPlugin(src=TOKEN_SOURCE),
         daemon=False,
         ssl_only=False,
         web=None,